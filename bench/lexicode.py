@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+"""
+lexicode.py - benchmark lexicode.lexicode against the notebook's
+conways_lexicode (analyses/primer-design-3/index-design-3.ipynb)
+
+The notebook version compares every candidate against the whole pool, so it
+is only run (and checked against) for short indices (--naive-max-len).
+
+Usage: python bench/lexicode.py [--lengths 8 10 12] [-d 3]
+"""
+
+import sys
+import time
+import argparse
+import itertools
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'src'))
+import lexicode as lx
+
+try:
+    from Levenshtein import distance
+except ImportError:
+    def distance(a, b):
+        "Levenshtein distance (pure python fallback)"
+        prev = list(range(len(b) + 1))
+        for i, x in enumerate(a, 1):
+            cur = [i]
+            for j, y in enumerate(b, 1):
+                cur.append(min(prev[j] + 1, cur[j - 1] + 1, prev[j - 1] + (x != y)))
+            prev = cur
+        return prev[-1]
+
+#===============================================================================
+
+def conways_lexicode(all_idx, d=3):
+    "The notebook's implementation, kept for reference"
+    pool = []
+    pool.append(next(all_idx))
+    for test_idx in all_idx:
+        for pool_idx in pool:
+            if distance(test_idx, pool_idx) < d:
+                break
+        else:
+            pool.append(test_idx)
+    return pool
+
+
+#===============================================================================
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Benchmark the lexicode engine against the notebook\'s pairwise version')
+    parser.add_argument('--lengths',
+                        type=int,
+                        nargs='+',
+                        default=[8, 10, 12],
+                        help='index lengths to test')
+    parser.add_argument('-d',
+                        '--dist',
+                        dest='dist',
+                        type=int,
+                        default=3,
+                        help='minimum edit distance (default = 3)')
+    parser.add_argument('--naive-max-len',
+                        dest='naive_max_len',
+                        type=int,
+                        default=6,
+                        help='also run (and check against) the pairwise version up to this length')
+    args = parser.parse_args()
+
+    print('length\tdist\tn_candidates\tn_indices\tengine_s\tpairwise_s\tspeedup')
+    for length in args.lengths:
+        start = time.perf_counter()
+        pool = lx.lexicode(length, args.dist)
+        engine_t = time.perf_counter() - start
+
+        naive = '-\t-'
+        if length <= args.naive_max_len:
+            start = time.perf_counter()
+            ref = conways_lexicode((''.join(x) for x in itertools.product('ACGT', repeat=length)), args.dist)
+            naive_t = time.perf_counter() - start
+            assert ref == pool, f'lexicode differs from the pairwise version at length {length}'
+            naive = f'{naive_t:.3f}\t{naive_t / engine_t:.1f}x'
+        print(f'{length}\t{args.dist}\t{4 ** length}\t{len(pool)}\t{engine_t:.3f}\t{naive}')
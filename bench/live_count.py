@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+"""
+live_count.py - replay a run's fastqs into a folder a chunk at a time (as a
+sequencer/bcl2fastq would) while live_count.LiveRun polls it, then check the
+final live counts against counting the finished fastqs in one go
+
+With no fastqs given, a synthetic run is written first (see synthetic.py).
+
+Usage: python bench/live_count.py [--samples 96] [--reads 20000] [--chunk 65536]
+       python bench/live_count.py --fastq-dir <run> --conditions <conditions.csv>
+"""
+
+import sys
+import csv
+import time
+import random
+import shutil
+import argparse
+import tempfile
+import threading
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'src'))
+import count_bcs as cb
+import correct_bcs as cc
+import run_pipeline as rp
+import live_count as lc
+import fastq_manifest as fm
+import synthetic as syn
+
+#===============================================================================
+
+def synthetic_run(out_dir, n_samples, n_reads, bc_map=syn.BC_MAP, seed=0):
+    """
+    Write a conditions.csv and one gzipped R1 fastq per sample (see
+    synthetic.synthetic_fastq).
+
+    Output:
+    -------
+    conditions :: str
+        path to the conditions.csv
+    """
+    rng = random.Random(seed)
+    bc_sets = sorted(cc.read_bc_map(bc_map))
+    out_dir = Path(out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+
+    rows = []
+    for i in range(n_samples):
+        sample_id = f'Plate1-{"ABCDEFGHIJKLMNOP"[i // 24 % 16]}{i % 24 + 1:02}'
+        bc_set = rng.choice(bc_sets)
+        rows.append({'Sample_ID': sample_id, 'bc_set': bc_set, 'bc_len': 26})
+        seqs, probs = syn.barcode_mix(bc_set, bc_map=bc_map)
+        syn.synthetic_fastq(out_dir / f'{sample_id}_S{i + 1}_L001_R1_001.fastq.gz', n_reads, seqs, probs, seed=seed + i)
+
+    conditions = out_dir / 'conditions.csv'
+    with open(conditions, 'w', newline='') as fh:
+        writer = csv.DictWriter(fh, fieldnames=['Sample_ID', 'bc_set', 'bc_len'])
+        writer.writeheader()
+        writer.writerows(rows)
+    return str(conditions)
+
+
+def replay(fastqs, dest_dir, chunk_size, delay, done_file):
+    """
+    Append chunk_size bytes of every fastq to dest_dir per tick (new files
+    appear as they are first written), then touch done_file.
+    """
+    dest_dir = Path(dest_dir)
+    dest_dir.mkdir(parents=True, exist_ok=True)
+    sources = {x: open(x, 'rb') for x in fastqs}
+    try:
+        while sources:
+            for src, fh in list(sources.items()):
+                data = fh.read(chunk_size)
+                if not data:
+                    fh.close()
+                    del sources[src]
+                    continue
+                with open(dest_dir / Path(src).name, 'ab') as out:
+                    out.write(data)
+            time.sleep(delay)
+    finally:
+        for fh in sources.values():
+            fh.close()
+    Path(done_file).touch()
+
+
+#===============================================================================
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Replay fastqs into a folder while counting them live, and check the final counts')
+    parser.add_argument('--fastq-dir',
+                        dest='fastq_dir',
+                        type=str,
+                        help='folder of R1 fastqs to replay (default = write a synthetic run)')
+    parser.add_argument('--conditions',
+                        type=str,
+                        help='conditions.csv of --fastq-dir')
+    parser.add_argument('--bc-map',
+                        dest='bc_map',
+                        type=str,
+                        default=str(syn.BC_MAP),
+                        help='barcode map (default = data/barcode-map.csv)')
+    parser.add_argument('--samples',
+                        type=int,
+                        default=96,
+                        help='synthetic samples')
+    parser.add_argument('--reads',
+                        type=int,
+                        default=20000,
+                        help='synthetic reads per sample')
+    parser.add_argument('--chunk',
+                        type=int,
+                        default=1 << 16,
+                        help='bytes appended to each fastq per tick')
+    parser.add_argument('--delay',
+                        type=float,
+                        default=0.05,
+                        help='seconds between ticks')
+    parser.add_argument('--poll',
+                        type=float,
+                        default=0.1,
+                        help='seconds between polls')
+    args = parser.parse_args()
+
+    tmp = Path(tempfile.mkdtemp(prefix='live_count_'))
+    try:
+        if args.fastq_dir:
+            src_dir, conditions = Path(args.fastq_dir), args.conditions
+        else:
+            src_dir = tmp / 'src'
+            start = time.perf_counter()
+            conditions = synthetic_run(src_dir, args.samples, args.reads, args.bc_map)
+            print(f'wrote {args.samples} x {args.reads} synthetic reads in {time.perf_counter() - start:.1f}s', file=sys.stderr)
+        conds = rp.read_conditions(conditions)
+        bc_sets = cc.read_bc_map(args.bc_map)
+        src_fastqs = fm.load(src_dir)
+        fastqs = sorted(x for row in conds for x in src_fastqs.fastqs(row['Sample_ID']))
+
+        run_dir = tmp / 'run'
+        base_calls = run_dir / 'Data' / 'Intensities' / 'BaseCalls'
+        base_calls.mkdir(parents=True)
+        done_file = run_dir / 'CopyComplete.txt'
+        live_file = tmp / 'live.csv'
+
+        live = lc.LiveRun(run_dir, conds, bc_sets)
+        writer = threading.Thread(target=replay, args=(fastqs, base_calls, args.chunk, args.delay, done_file))
+        start = time.perf_counter()
+        writer.start()
+        lc.watch(live, live_file, done_file, args.poll, publish_interval=1)
+        writer.join()
+        live_t = time.perf_counter() - start
+
+        # everything at once, after the fact
+        start = time.perf_counter()
+        run_fastqs = fm.load(base_calls)
+        rows = ''.join(rp.correct_rows(row['Sample_ID'], cb.count_barcodes(run_fastqs.fastqs(row['Sample_ID']), int(row['bc_len'])),
+                                       bc_sets[row['bc_set']], cc.MAX_DIST)
+                       for row in conds)
+        batch_t = time.perf_counter() - start
+        with open(live_file) as fh:
+            assert fh.read() == rp.HEADER + rows, 'live counts differ from counting the finished fastqs'
+
+        size = sum(Path(x).stat().st_size for x in fastqs)
+        print('n_fastqs\tbytes\tn_reads\treplay_and_live_s\tbatch_after_s')
+        print(f'{len(fastqs)}\t{size}\t{live.n_reads}\t{live_t:.2f}\t{batch_t:.2f}')
+    finally:
+        shutil.rmtree(tmp)
@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+"""
+plate_map_formats.py - time reading the same plate maps from an *.xlsx, a
+folder of csv tabs, and a long csv/parquet table (plate_maps.read_plate_map_set
+without the cache), check they parse to the same wells, and report the peak
+python memory of each
+
+Usage: python bench/plate_map_formats.py [--size 1536] [--plates 4] [--suffixes 2]
+"""
+
+import sys
+import csv
+import argparse
+import tempfile
+import tracemalloc
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'src'))
+import plate_maps as pm
+import synthetic as syn
+from plate_maps_to_df import best_of
+
+#===============================================================================
+
+def write_grid_dir(sheets, folder):
+    "Write every tab of a workbook (see plate_maps.read_workbook) as <tab>.csv"
+    folder = Path(folder)
+    folder.mkdir(parents=True, exist_ok=True)
+    for name, rows in sheets.items():
+        with open(folder / f'{name}.csv', 'w', newline='') as fh:
+            csv.writer(fh, lineterminator='\n').writerows(['' if x is None else x for x in row] for row in rows)
+
+
+def peak_mb(fun):
+    "Peak python allocations (MB) of a call"
+    tracemalloc.start()
+    try:
+        fun()
+        return tracemalloc.get_traced_memory()[1] / 1e6
+    finally:
+        tracemalloc.stop()
+
+
+def same_wells(df, ref):
+    "True if two plate_maps_to_df tables hold the same values (any column order)"
+    cols = sorted(ref.columns)
+    if sorted(df.columns) != cols:
+        return False
+    return df[cols].astype(str).equals(ref[cols].astype(str))
+
+
+#===============================================================================
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Time reading plate maps from xlsx vs csv tabs vs a long csv/parquet table')
+    parser.add_argument('--size',
+                        type=int,
+                        default=1536,
+                        help='wells per plate')
+    parser.add_argument('--plates',
+                        type=int,
+                        default=4,
+                        help='number of plates')
+    parser.add_argument('--suffixes',
+                        type=int,
+                        default=2,
+                        help='i5/i7 pairs per well')
+    parser.add_argument('-r',
+                        '--repeats',
+                        type=int,
+                        default=3,
+                        help='take the best of this many runs')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix='plate-map-formats-') as tmp:
+        tmp = Path(tmp)
+        xlsx = tmp / 'plate-map.xlsx'
+        syn.synthetic_workbook(xlsx, args.size, args.plates, args.suffixes)
+        ref = pm.plate_maps_to_df(pm.read_plate_map_set(xlsx))
+
+        write_grid_dir(pm.read_workbook(xlsx), tmp / 'tabs')
+        ref.to_csv(tmp / 'long.csv', index=False)
+        ref.to_parquet(tmp / 'long.parquet', index=False)
+
+        print('format\tpath\tseconds\tpeak_py_mb\tspeedup\tsame_wells')
+        base = None
+        for label, path in [('xlsx', xlsx), ('csv tabs', tmp / 'tabs'), ('long csv', tmp / 'long.csv'), ('long parquet', tmp / 'long.parquet')]:
+            t, plate_maps = best_of(lambda: pm.read_plate_map_set(path), args.repeats)
+            mb = peak_mb(lambda: pm.read_plate_map_set(path))
+            base = base or t
+            same = same_wells(pm.plate_maps_to_df(plate_maps), ref)
+            print(f'{label}\t{path.name}\t{t:.4f}\t{mb:.1f}\t{base / t:.1f}x\t{same}')
@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+"""
+plate_maps_to_df.py - benchmark plate_maps.plate_maps_to_df (from a dict and
+from a prebuilt PlateMapSet) against the old melt/concat implementation on
+synthetic plate maps
+
+Usage: python bench/plate_maps_to_df.py [--sizes 96 384 1536] [--plates 10 40]
+"""
+
+import sys
+import time
+import random
+import argparse
+from copy import deepcopy
+from pathlib import Path
+
+import pandas as pd
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'src'))
+import plate_maps as pm
+
+#===============================================================================
+
+def melt_plate_maps_to_df(plate_maps):
+    "The original melt/concat/lambda-sort implementation, kept for reference"
+    pm.check_plates_x_vars(plate_maps)
+
+    plate_maps = deepcopy(plate_maps)
+    plate_sizes = pm.get_plate_sizes(plate_maps)
+    plate_maps['Sample_Well'] = {plate_id:[f'{row}{col:02}' for row in pm.row_letters(plate_size) for col in range(1, pm.ncol_pl(plate_size) + 1)] for plate_id, plate_size in plate_sizes.items()}
+
+    # Temporarily rename "index" column
+    rename_index = False
+    if 'index' in plate_maps:
+        rename_index = True
+        plate_maps['__index__'] = deepcopy(plate_maps['index'])
+        del plate_maps['index']
+
+    df = pd.concat([pd.DataFrame(x).reset_index().melt(id_vars = 'index', var_name = "Plate_ID", value_name = var_name).set_index(['index', 'Plate_ID']) for var_name, x in plate_maps.items()], axis=1, sort=True)
+
+    df = df.reset_index().drop('index', axis=1).assign(foo = lambda df: df['Plate_ID'].map(lambda x: int(x.replace('Plate', '')))).sort_values(['foo', 'Sample_Well']).reset_index(drop=True).drop('foo', axis = 1)
+
+    if rename_index:
+        df.rename({'__index__':'index'}, axis = 'columns', inplace = True)
+
+    return(df)
+
+
+def synthetic_plate_maps(plate_size, n_plates, n_vars, seed=0):
+    """
+    Generate plate maps with a mix of integer, float, string, and sparse
+    (partially blank) variables plus i5/i7/bc_set.
+
+    Output:
+    -------
+    plate_maps :: dict
+        {var: {plate: [val, ...]}}
+    """
+    rng = random.Random(seed)
+    plates = [f'Plate{i}' for i in range(1, n_plates + 1)]
+    gens = [
+        lambda: rng.randint(0, 1000),
+        lambda: rng.random() * 100,
+        lambda: rng.choice(['NP', 'saliva', 'water']),
+        lambda: rng.choice([None, 50.0]),
+    ]
+    plate_maps = {}
+    for v in range(n_vars):
+        gen = gens[v % len(gens)]
+        plate_maps[f'var{v}'] = {p: [gen() for _ in range(plate_size)] for p in plates}
+    plate_maps['bc_set'] = {p: ['N1_S2_RPP30'] * plate_size for p in plates}
+    plate_maps['i5'] = {p: [''.join(rng.choice('ACGT') for _ in range(10)) for _ in range(plate_size)] for p in plates}
+    plate_maps['i7'] = {p: [''.join(rng.choice('ACGT') for _ in range(10)) for _ in range(plate_size)] for p in plates}
+    return plate_maps
+
+
+def best_of(f, repeats):
+    "Best wall time of `repeats` calls to f (and its last result)"
+    best = float('inf')
+    for _ in range(repeats):
+        start = time.perf_counter()
+        res = f()
+        best = min(best, time.perf_counter() - start)
+    return best, res
+
+
+#===============================================================================
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Benchmark plate_maps_to_df against the old melt/concat implementation')
+    parser.add_argument('--sizes',
+                        type=int,
+                        nargs='+',
+                        default=[96, 384, 1536],
+                        help='plate sizes to test')
+    parser.add_argument('--plates',
+                        type=int,
+                        nargs='+',
+                        default=[4, 40],
+                        help='numbers of plates to test')
+    parser.add_argument('--vars',
+                        dest='n_vars',
+                        type=int,
+                        default=20,
+                        help='number of plate map variables (besides i5/i7/bc_set)')
+    parser.add_argument('-r',
+                        '--repeats',
+                        type=int,
+                        default=3,
+                        help='take the best of this many runs')
+    args = parser.parse_args()
+
+    print('plate_size\tn_plates\tn_wells\tmelt_s\tcolumnar_s\tspeedup\tplate_map_set_s')
+    for size in args.sizes:
+        for n_plates in args.plates:
+            plate_maps = synthetic_plate_maps(size, n_plates, args.n_vars)
+            old_t, old_df = best_of(lambda: melt_plate_maps_to_df(plate_maps), args.repeats)
+            new_t, new_df = best_of(lambda: pm.plate_maps_to_df(plate_maps), args.repeats)
+            pd.testing.assert_frame_equal(old_df, new_df)
+            # to_df alone, as when the set comes straight from read_plate_map_set
+            plate_map_set = pm.PlateMapSet.from_plate_maps(plate_maps)
+            set_t, set_df = best_of(plate_map_set.to_df, args.repeats)
+            pd.testing.assert_frame_equal(old_df, set_df)
+            print(f'{size}\t{n_plates}\t{size * n_plates}\t{old_t:.3f}\t{new_t:.3f}\t{old_t / new_t:.1f}x\t{set_t:.3f}')
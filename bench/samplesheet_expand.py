@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+"""
+samplesheet_expand.py - benchmark platemap2samp.expand_samplesheet and
+collapse_samplesheet against the old melt/merge expansion and a group by over
+every column (what collapseSampleSheet.R does) on synthetic sample sheets
+
+Usage: python bench/samplesheet_expand.py [--wells 384 15360] [--suffixes 2 4]
+"""
+
+import sys
+import random
+import argparse
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'src'))
+import platemap2samp as p2s
+from plate_maps_to_df import best_of
+
+#===============================================================================
+
+def melt_expand_samplesheet(df, idx_suff):
+    "The original melt/merge implementation, kept for reference"
+    i5_cols = [f'i5_{x}' for x in idx_suff]
+    i7_cols = [f'i7_{x}' for x in idx_suff]
+
+    i5_expanded_df = df.melt(id_vars = ['Sample_ID', 'Plate_ID', 'Sample_Well'], value_vars = i5_cols, value_name = 'i5', var_name = '__idx_id__')
+    i5_expanded_df['__idx_id__'] = [x.split('_')[1] for x in i5_expanded_df['__idx_id__']]
+
+    i7_expanded_df = df.melt(id_vars = ['Sample_ID', 'Plate_ID', 'Sample_Well'], value_vars = i7_cols, value_name = 'i7', var_name = '__idx_id__')
+    i7_expanded_df['__idx_id__'] = [x.split('_')[1] for x in i7_expanded_df['__idx_id__']]
+
+    i5_i7_expanded_df = pd.merge(i5_expanded_df, i7_expanded_df)
+    i5_i7_expanded_df = i5_i7_expanded_df[~i5_i7_expanded_df.duplicated(['Plate_ID', 'Sample_Well', 'i5', 'i7'])]
+
+    df_exp = df.drop(i5_cols + i7_cols, axis = 'columns').merge(i5_i7_expanded_df)
+
+    df_exp['Sample_ID'] = df_exp['Sample_ID'] + '-' + df_exp['__idx_id__']
+    df_exp.drop('__idx_id__', axis = 'columns', inplace = True)
+
+    return df_exp
+
+
+def groupby_collapse_samplesheet(df, index_cols = ['index', 'index2']):
+    "collapseSampleSheet.R's group_by_at(vars(-index, -index2)) in pandas"
+    df = df.assign(Sample_ID = df['Plate_ID'] + '-' + df['Sample_Well'])
+    key_cols = [x for x in df.columns if x not in index_cols]
+    df = df.assign(**{x: df[x].astype(object).where(df[x].notna(), 'NA').astype(str) for x in index_cols})
+    return (df.groupby(key_cols, sort = True, dropna = False)[index_cols]
+              .agg('-'.join)
+              .reset_index())
+
+
+def synthetic_samplesheet(n_wells, n_suffixes, seed=0):
+    """
+    One row per well (as plate_maps_to_df makes) with i5_<suffix>/i7_<suffix>
+    columns. A third of the wells reuse their first pair for every suffix.
+
+    Output:
+    -------
+    (df, idx_suff) :: tuple
+    """
+    rng = random.Random(seed)
+    plates = [f'Plate{i // 384 + 1}' for i in range(n_wells)]
+    wells = [f'{"ABCDEFGHIJKLMNOP"[(i % 384) // 24]}{(i % 24) + 1:02}' for i in range(n_wells)]
+    idx_suff = [chr(ord('a') + i) for i in range(n_suffixes)]
+    df = pd.DataFrame({
+        'Plate_ID': plates,
+        'RNA_copies': [rng.choice([0, 100, 1000]) for _ in range(n_wells)],
+        'lysate': [rng.choice(['NP', 'saliva']) for _ in range(n_wells)],
+        'bc_set': 'N1_S2_RPP30',
+        'Sample_Well': wells,
+    })
+    rand_idx = lambda: ''.join(rng.choice('ACGT') for _ in range(10))
+    for s in idx_suff:
+        df[f'i5_{s}'] = [rand_idx() for _ in range(n_wells)]
+        df[f'i7_{s}'] = [rand_idx() for _ in range(n_wells)]
+    single = np.arange(n_wells) % 3 == 0
+    for s in idx_suff[1:]:
+        df.loc[single, f'i5_{s}'] = df.loc[single, f'i5_{idx_suff[0]}']
+        df.loc[single, f'i7_{s}'] = df.loc[single, f'i7_{idx_suff[0]}']
+    df['Sample_ID'] = df.Plate_ID + '-' + df.Sample_Well
+    return df, idx_suff
+
+
+#===============================================================================
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Benchmark expanding/collapsing multi-index sample sheets')
+    parser.add_argument('--wells',
+                        type=int,
+                        nargs='+',
+                        default=[384, 15360],
+                        help='numbers of wells to test')
+    parser.add_argument('--suffixes',
+                        type=int,
+                        nargs='+',
+                        default=[2, 4],
+                        help='numbers of i5/i7 pairs per well to test')
+    parser.add_argument('-r',
+                        '--repeats',
+                        type=int,
+                        default=3,
+                        help='take the best of this many runs')
+    args = parser.parse_args()
+
+    print('direction\tn_wells\tn_suffixes\tn_rows\told_s\tnew_s\tspeedup')
+    for n_wells in args.wells:
+        for n_suffixes in args.suffixes:
+            df, idx_suff = synthetic_samplesheet(n_wells, n_suffixes)
+
+            old_t, old_df = best_of(lambda: melt_expand_samplesheet(df, idx_suff), args.repeats)
+            new_t, new_df = best_of(lambda: p2s.expand_samplesheet(df, idx_suff), args.repeats)
+            pd.testing.assert_frame_equal(old_df, new_df)
+            print(f'expand\t{n_wells}\t{n_suffixes}\t{len(new_df)}\t{old_t:.3f}\t{new_t:.3f}\t{old_t / new_t:.1f}x')
+
+            # as written to the SampleSheet
+            sheet = new_df.assign(index = new_df.i7, index2 = new_df.i5).drop(['i5', 'i7'], axis = 'columns')
+            old_t, old_df = best_of(lambda: groupby_collapse_samplesheet(sheet), args.repeats)
+            new_t, new_df = best_of(lambda: p2s.collapse_samplesheet(sheet), args.repeats)
+            pd.testing.assert_frame_equal(old_df, new_df)
+            print(f'collapse\t{n_wells}\t{n_suffixes}\t{len(new_df)}\t{old_t:.3f}\t{new_t:.3f}\t{old_t / new_t:.1f}x')
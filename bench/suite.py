@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+"""
+suite.py - time the plate map -> sample sheet -> count path on synthetic data
+and record the results as JSON
+
+Stages (each at several scales, best of --repeats):
+
+    read_plate_maps      parse a synthetic workbook (no cache)
+    plate_maps_to_df     plate map dict -> one row per well
+    expand_samplesheet   one row per well -> one row per i5/i7 pair
+    tidy_star            tidy-star.py's tidy_text on starcode cluster lines
+    count_barcodes       count_bcs.count_barcodes on a gzipped fastq
+
+Results go to bench/results/<timestamp>-<commit>.json (--out to change) with
+the commit, library versions, and machine, so two runs can be compared with
+--compare old.json.
+
+Usage: python bench/suite.py [--quick] [--compare bench/results/<old>.json]
+"""
+
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import tempfile
+import subprocess
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'src'))
+import plate_maps as pm
+import platemap2samp as p2s
+import count_bcs as cb
+import run_pipeline as rp
+import synthetic as syn
+from plate_maps_to_df import best_of
+
+RESULTS_DIR = Path(__file__).resolve().parent / 'results'
+
+# (plate size, plates, i5/i7 pairs per well)
+WORKBOOKS = [(6, 1, 0), (96, 4, 0), (384, 4, 2), (384, 16, 4), (1536, 4, 2)]
+CLUSTERS = [10 ** 4, 10 ** 5]
+READS = [10 ** 5, 10 ** 6]
+ERROR_RATE = 0.01
+
+QUICK_WORKBOOKS = [(6, 1, 0), (96, 2, 2)]
+QUICK_CLUSTERS = [10 ** 3]
+QUICK_READS = [10 ** 4]
+
+#===============================================================================
+
+def environment():
+    "What produced the numbers (to tell versions and machines apart)"
+    root = Path(__file__).resolve().parent.parent
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=root, stdout=subprocess.PIPE,
+                                stderr=subprocess.DEVNULL, universal_newlines=True, check=True).stdout.strip()
+        dirty = bool(subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=root, stdout=subprocess.PIPE,
+                                    stderr=subprocess.DEVNULL, universal_newlines=True, check=True).stdout.strip())
+    except (OSError, subprocess.CalledProcessError):
+        commit, dirty = None, None
+    return {
+        'commit': commit,
+        'dirty': dirty,
+        'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'pandas': pd.__version__,
+        'machine': platform.machine(),
+        'processor': platform.processor(),
+        'cpus': os.cpu_count(),
+    }
+
+
+def bench_plate_maps(tmp, workbooks, repeats):
+    "Yield results for read_plate_maps, plate_maps_to_df, and expand_samplesheet"
+    for plate_size, n_plates, n_suffixes in workbooks:
+        fname = Path(tmp) / f'plate-map-{plate_size}x{n_plates}x{n_suffixes}.xlsx'
+        syn.synthetic_workbook(fname, plate_size, n_plates, n_suffixes)
+        params = {'plate_size': plate_size, 'n_plates': n_plates, 'n_suffixes': n_suffixes}
+
+        t, plate_maps = best_of(lambda: pm.read_plate_maps(fname), repeats)
+        yield 'read_plate_maps', params, t, {'n_wells': plate_size * n_plates}
+
+        t, df = best_of(lambda: pm.plate_maps_to_df(plate_maps), repeats)
+        yield 'plate_maps_to_df', params, t, {'n_rows': len(df)}
+
+        if n_suffixes:
+            _, idx_suff = p2s.check_i5_i7_vars(plate_maps)
+            df['Sample_ID'] = df.Plate_ID + '-' + df.Sample_Well
+            t, exp = best_of(lambda: p2s.expand_samplesheet(df, idx_suff), repeats)
+            yield 'expand_samplesheet', params, t, {'n_rows': len(exp)}
+
+
+def bench_tidy_star(clusters, repeats):
+    "Yield results for tidy-star.py's text tidier"
+    tidy_star = rp.load_tidy_star()
+    for n_clusters in clusters:
+        lines = syn.starcode_lines(n_clusters)
+        t, out = best_of(lambda: tidy_star.tidy_text(lines, 'Plate1-A01'), repeats)
+        yield 'tidy_star', {'n_clusters': n_clusters}, t, {'n_rows': out.count('\n')}
+
+
+def bench_count(tmp, reads, error_rate, repeats):
+    "Yield results for counting barcodes in a gzipped fastq"
+    seqs, probs = syn.barcode_mix()
+    for n_reads in reads:
+        fname = Path(tmp) / f'reads-{n_reads}.fastq.gz'
+        syn.synthetic_fastq(fname, n_reads, seqs, probs, error_rate)
+        params = {'n_reads': n_reads, 'error_rate': error_rate}
+        t, counts = best_of(lambda: cb.count_barcodes([str(fname)], len(seqs[0])), repeats)
+        yield 'count_barcodes', params, t, {'n_barcodes': len(counts), 'reads_per_s': round(n_reads / t)}
+
+
+def compare(results, old_file):
+    "Print the ratio of every stage/params seconds to an older run's"
+    with open(old_file) as fh:
+        old = json.load(fh)
+    key = lambda x: (x['stage'], json.dumps(x['params'], sort_keys=True))
+    old_t = {key(x): x['seconds'] for x in old['results']}
+    print(f'\nvs {old_file} ({old["env"].get("commit")}): new/old seconds (> 1 is slower)')
+    for res in results:
+        if key(res) in old_t:
+            print(f'{res["stage"]}\t{json.dumps(res["params"], sort_keys=True)}\t{res["seconds"] / old_t[key(res)]:.2f}')
+
+
+#===============================================================================
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Time the plate map -> sample sheet -> count path on synthetic data and save JSON')
+    parser.add_argument('-r',
+                        '--repeats',
+                        type=int,
+                        default=3,
+                        help='take the best of this many runs')
+    parser.add_argument('--quick',
+                        action='store_true',
+                        help='only the smallest scales (a smoke test)')
+    parser.add_argument('--error-rate',
+                        dest='error_rate',
+                        type=float,
+                        default=ERROR_RATE,
+                        help='per-base error rate of the synthetic reads')
+    parser.add_argument('-o',
+                        '--out',
+                        type=str,
+                        help='results file (default = bench/results/<timestamp>-<commit>.json)')
+    parser.add_argument('--compare',
+                        type=str,
+                        help='earlier results file to compare against')
+    args = parser.parse_args()
+
+    workbooks, clusters, reads = (QUICK_WORKBOOKS, QUICK_CLUSTERS, QUICK_READS) if args.quick else (WORKBOOKS, CLUSTERS, READS)
+    env = environment()
+    results = []
+    print('stage\tparams\tseconds\tinfo')
+    with tempfile.TemporaryDirectory(prefix='swabseq-bench-') as tmp:
+        stages = [bench_plate_maps(tmp, workbooks, args.repeats),
+                  bench_tidy_star(clusters, args.repeats),
+                  bench_count(tmp, reads, args.error_rate, args.repeats)]
+        for stage in stages:
+            for name, params, seconds, info in stage:
+                results.append({'stage': name, 'params': params, 'seconds': round(seconds, 6), **info})
+                print(f'{name}\t{json.dumps(params, sort_keys=True)}\t{seconds:.4f}\t{json.dumps(info, sort_keys=True)}')
+
+    out = args.out or str(RESULTS_DIR / f'{time.strftime("%Y%m%d-%H%M%S")}-{env["commit"] or "nogit"}.json')
+    Path(out).parent.mkdir(parents=True, exist_ok=True)
+    with open(out, 'w') as fh:
+        json.dump({'env': env, 'repeats': args.repeats, 'quick': args.quick, 'results': results}, fh, indent=2)
+    print(f'Results written to {out}', file=sys.stderr)
+
+    if args.compare:
+        compare(results, args.compare)
@@ -0,0 +1,233 @@
+#!/usr/bin/env python3
+"""
+synthetic.py - synthetic inputs for the benchmarks
+
+    synthetic_workbook  plate map workbooks (6 to 1536 well plates, ranged
+                        "PlateX-Y" tabs, a _constants tab, and plain or
+                        multi-suffix i5_*/i7_* index tabs)
+    synthetic_fastq     gzipped fastqs of barcodes drawn from the barcode map
+                        with a given mix and substitution/N error rate
+    starcode_lines      starcode --print-clusters output for tidy-star.py
+
+Usage: python bench/synthetic.py workbook out.xlsx [--size 384] [--plates 4] [--suffixes 2]
+       python bench/synthetic.py fastq out.fastq.gz [--reads 100000] [--error-rate 0.01]
+"""
+
+import sys
+import gzip
+import argparse
+from pathlib import Path
+
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'src'))
+import plate_maps as pm
+import correct_bcs as cc
+
+BC_MAP = Path(__file__).resolve().parent.parent / 'data' / 'barcode-map.csv'
+
+BASES = np.frombuffer(b'ACGT', dtype=np.uint8)
+
+# reads per gzip member (bcl2fastq writes many small members)
+MEMBER_READS = 1 << 14
+
+#===============================================================================
+
+def random_indices(rng, n, length=10):
+    "n random (not necessarily unique) DNA indices"
+    return [x.tobytes().decode() for x in BASES[rng.integers(0, 4, size=(n, length))]]
+
+
+def grid_rows(plate_label, plate_size, values):
+    "One plate of a tab: a header row (label, 1, 2, ...) and a row per plate row"
+    ncol = pm.ncol_pl(plate_size)
+    rows = [[plate_label] + list(range(1, ncol + 1))]
+    for i, letter in enumerate(pm.row_letters(plate_size)):
+        rows.append([letter] + list(values[i * ncol:(i + 1) * ncol]))
+    return rows
+
+
+def synthetic_workbook(fname, plate_size=384, n_plates=4, n_suffixes=0, seed=0):
+    """
+    Write a plate map workbook platemap2samp.py accepts.
+
+    Per-well condition tabs cover every plate with a single ranged spec
+    ("Plate1-<n>") and the index tabs have one grid per plate. n_suffixes = 0
+    writes plain i5/i7 tabs, otherwise i5_a/i7_a, i5_b/i7_b, ...
+
+    Input:
+    ------
+    fname :: str
+        *.xlsx to write
+    plate_size :: int
+        6, 12, 24, 48, 96, 384, or 1536
+    n_plates :: int
+    n_suffixes :: int
+        i5/i7 pairs per well
+    """
+    from openpyxl import Workbook
+
+    rng = np.random.default_rng(seed)
+    plates = [f'Plate{i + 1}' for i in range(n_plates)]
+    ranged = 'Plate1' if n_plates == 1 else f'Plate1-{n_plates}'
+
+    wb = Workbook(write_only=True)
+    tabs = {
+        'RNA_copies': [ranged, rng.choice([0, 10, 100, 1000, 10000], size=plate_size).tolist()],
+        'lysate': [ranged, rng.choice(['NP', 'saliva', 'water'], size=plate_size).tolist()],
+        'RNA_origin': [ranged, ['ATCC_Virus'] * plate_size],
+    }
+    for name, (label, values) in tabs.items():
+        ws = wb.create_sheet(name)
+        for row in grid_rows(label, plate_size, values):
+            ws.append(row)
+
+    suffixes = [None] if n_suffixes == 0 else [chr(ord('a') + i) for i in range(n_suffixes)]
+    for prefix in ['i5', 'i7']:
+        for suffix in suffixes:
+            ws = wb.create_sheet(prefix if suffix is None else f'{prefix}_{suffix}')
+            for j, plate in enumerate(plates):
+                if j:
+                    ws.append([])
+                for row in grid_rows(plate, plate_size, random_indices(rng, plate_size)):
+                    ws.append(row)
+
+    ws = wb.create_sheet('_constants')
+    ws.append(['Plate', 'bc_set', 'PCR_cycles', 'RT_temp'])
+    for plate in plates:
+        ws.append([plate, 'N1_S2_RPP30', 40, int(rng.choice([55, 64]))])
+    wb.save(fname)
+
+
+def barcode_mix(bc_set='N1_S2_RPP30', weights=None, bc_map=BC_MAP):
+    """
+    Barcodes of a bc_set and the fraction of reads each should get.
+
+    Input:
+    ------
+    weights :: list
+        relative abundance of each barcode (default = uniform)
+
+    Output:
+    -------
+    (seqs, probs) :: tuple
+    """
+    seqs = cc.read_bc_map(bc_map)[bc_set]
+    weights = np.ones(len(seqs)) if weights is None else np.asarray(weights, dtype=float)
+    if len(weights) != len(seqs):
+        raise ValueError(f'{bc_set} has {len(seqs)} barcodes but {len(weights)} weights were given')
+    return seqs, weights / weights.sum()
+
+
+def synthetic_reads(n_reads, seqs, probs, error_rate=0.01, read_len=36, seed=0):
+    """
+    Read sequences made of a barcode (drawn with probs) plus random bases,
+    with substitutions at error_rate and N's at error_rate / 10 per base.
+
+    Output:
+    -------
+    reads :: np.array (uint8)
+        n_reads x read_len ascii
+    """
+    rng = np.random.default_rng(seed)
+    bc_len = len(seqs[0])
+    codes = rng.integers(0, 4, size=(n_reads, max(read_len, bc_len)), dtype=np.uint8)
+    bcs = np.frombuffer(''.join(seqs).encode(), dtype=np.uint8).reshape(len(seqs), bc_len)
+    which = rng.choice(len(seqs), size=n_reads, p=probs)
+    reads = BASES[codes]
+    reads[:, :bc_len] = bcs[which]
+
+    sub = rng.random(reads.shape) < error_rate
+    shift = rng.integers(1, 4, size=int(sub.sum()), dtype=np.uint8)
+    lookup = np.zeros(256, dtype=np.uint8)
+    lookup[BASES] = np.arange(4, dtype=np.uint8)
+    reads[sub] = BASES[(lookup[reads[sub]] + shift) % 4]
+    reads[rng.random(reads.shape) < error_rate / 10] = ord('N')
+    return reads
+
+
+def synthetic_fastq(fname, n_reads, seqs, probs, error_rate=0.01, read_len=36, seed=0):
+    "Write synthetic_reads as a multi-member gzipped fastq"
+    reads = synthetic_reads(n_reads, seqs, probs, error_rate, read_len, seed)
+    qual = 'F' * reads.shape[1]
+    with open(fname, 'wb') as fh:
+        for start in range(0, n_reads, MEMBER_READS):
+            block = reads[start:start + MEMBER_READS]
+            text = ''.join(f'@r{start + i}\n{seq}\n+\n{qual}\n' for i, seq in enumerate(block.view(f'S{block.shape[1]}').ravel().astype(str)))
+            fh.write(gzip.compress(text.encode(), compresslevel=1))
+
+
+def starcode_lines(n_clusters, members=5, bc_len=26, seed=0):
+    """
+    starcode --print-clusters style lines (centroid, count, members).
+
+    Output:
+    -------
+    lines :: list
+        "centroid\\tcount\\tbc1,bc2,...\\n"
+    """
+    rng = np.random.default_rng(seed)
+    n_members = rng.integers(1, 2 * members, size=n_clusters)
+    bcs = random_indices(rng, int(n_members.sum()), bc_len)
+    counts = rng.integers(1, 10000, size=n_clusters)
+    lines = []
+    pos = 0
+    for n, count in zip(n_members.tolist(), counts.tolist()):
+        group = bcs[pos:pos + n]
+        pos += n
+        lines.append(f'{group[0]}\t{count}\t{",".join(group)}\n')
+    return lines
+
+
+#===============================================================================
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Write a synthetic plate map workbook or fastq')
+    parser.add_argument('kind',
+                        choices=['workbook', 'fastq'],
+                        help='what to write')
+    parser.add_argument('out',
+                        type=str,
+                        help='output path')
+    parser.add_argument('--size',
+                        type=int,
+                        default=384,
+                        help='wells per plate (workbook)')
+    parser.add_argument('--plates',
+                        type=int,
+                        default=4,
+                        help='number of plates (workbook)')
+    parser.add_argument('--suffixes',
+                        type=int,
+                        default=0,
+                        help='i5/i7 pairs per well, 0 for plain i5/i7 tabs (workbook)')
+    parser.add_argument('--reads',
+                        type=int,
+                        default=100000,
+                        help='number of reads (fastq)')
+    parser.add_argument('--error-rate',
+                        dest='error_rate',
+                        type=float,
+                        default=0.01,
+                        help='per-base substitution rate (fastq)')
+    parser.add_argument('--bc-set',
+                        dest='bc_set',
+                        type=str,
+                        default='N1_S2_RPP30',
+                        help='bc_set to draw barcodes from (fastq)')
+    parser.add_argument('--weights',
+                        type=float,
+                        nargs='+',
+                        help='relative abundance of each barcode in the bc_set (fastq)')
+    parser.add_argument('--seed',
+                        type=int,
+                        default=0,
+                        help='random seed')
+    args = parser.parse_args()
+
+    if args.kind == 'workbook':
+        synthetic_workbook(args.out, args.size, args.plates, args.suffixes, args.seed)
+    else:
+        seqs, probs = barcode_mix(args.bc_set, args.weights)
+        synthetic_fastq(args.out, args.reads, seqs, probs, args.error_rate, seed=args.seed)
@@ -0,0 +1,246 @@
+#!/usr/bin/env python3
+"""
+annotate.py - join a run's barcode counts to its conditions and barcode map
+
+Streams starcode.csv (or correct.csv) in blocks, looks up the target/amplicon
+of every Centroid in a {(bc_set, sequence): row} index of the barcode map,
+and attaches the conditions of every Sample_ID through row codes rather than
+copying every condition column onto every barcode row. String columns are
+written as dictionaries over the conditions/barcode map values, so the output
+stays a fraction of the size of the equivalent annotated csv.
+
+Rows are written to a Parquet dataset partitioned by run and plate:
+
+    <out_dir>/run=<run>/Plate_ID=<plate>/*.parquet
+
+Samples that are not in the conditions are dropped (as inner_join(cond) in
+the run notebooks). Centroids that are not in the sample's bc_set get a null
+target/amplicon.
+"""
+
+import sys
+import shutil
+import argparse
+from pathlib import Path
+from urllib.parse import quote
+
+import numpy as np
+import pandas as pd
+
+# bytes of csv to parse at a time
+BLOCK_SIZE = 1 << 22
+
+# rows per parquet row group
+ROW_GROUP_SIZE = 1 << 18
+
+# barcode map columns to attach to every centroid
+BC_MAP_COLS = ['target', 'amplicon']
+
+#===============================================================================
+
+def import_arrow():
+    try:
+        import pyarrow
+        import pyarrow.csv
+        import pyarrow.compute
+        import pyarrow.parquet
+    except ImportError:
+        raise RuntimeError('Annotating runs requires pyarrow (conda install -c conda-forge pyarrow)')
+    return pyarrow
+
+
+def read_conditions(fname):
+    "conditions.csv, with Sample_ID as the index"
+    cond = pd.read_csv(fname)
+    if cond['Sample_ID'].duplicated().any():
+        raise ValueError(f'Sample_IDs must be unique in {fname}')
+    return cond.set_index('Sample_ID')
+
+
+def build_bc_index(bc_map):
+    """
+    Index the barcode map by (bc_set, sequence).
+
+    Input:
+    ------
+    bc_map :: pd.DataFrame
+        barcode-map.csv (sequence,target,amplicon,bc_set)
+
+    Output:
+    -------
+    index :: dict
+        {(bc_set, sequence): row number in bc_map}
+    """
+    return {key: i for i, key in enumerate(zip(bc_map['bc_set'], bc_map['sequence']))}
+
+
+def dictionary_table(pa, df):
+    "Arrow table of df with every string column dictionary-encoded"
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    cols = [x.dictionary_encode() if pa.types.is_string(x.type) or pa.types.is_large_string(x.type) else x for x in table.columns]
+    return pa.Table.from_arrays(cols, names=table.column_names)
+
+
+class Annotator:
+    """
+    Annotate blocks of starcode rows (see the module docstring).
+
+    The conditions and barcode map are dictionary-encoded once, so joining a
+    block only gathers codes (and numeric values) with take.
+
+    Input:
+    ------
+    cond :: pd.DataFrame
+        see read_conditions
+    bc_map :: pd.DataFrame
+        barcode-map.csv
+    """
+
+    def __init__(self, cond, bc_map):
+        self.pa = import_arrow()
+        bc_map = bc_map.reset_index(drop=True)
+        self.bc_index = build_bc_index(bc_map)
+        self.bc_table = dictionary_table(self.pa, bc_map[BC_MAP_COLS])
+        self.cond_table = dictionary_table(self.pa, cond.reset_index(drop=True))
+        self.sample_codes = {x: i for i, x in enumerate(cond.index)}
+        self.sample_bc_set = cond['bc_set'].tolist()
+
+    def annotate(self, batch):
+        """
+        Input:
+        ------
+        batch :: pa.RecordBatch
+            Sample_ID,Centroid,Count,barcode rows
+
+        Output:
+        -------
+        out :: pa.Table
+        """
+        pa = self.pa
+
+        # Sample_ID -> conditions row (-1 if missing), once per unique id
+        samples = batch.column('Sample_ID').dictionary_encode()
+        sample_rows = np.array([self.sample_codes.get(x, -1) for x in samples.dictionary.to_pylist()] + [-1], dtype=np.int64)
+        cond_rows = sample_rows[samples.indices.to_numpy(zero_copy_only=False)]
+        keep = cond_rows >= 0
+        batch = batch.filter(pa.array(keep))
+        samples = samples.filter(pa.array(keep))
+        cond_rows = cond_rows[keep]
+
+        # (conditions row, Centroid) -> barcode map row (-1 if missing), once
+        # per unique pair
+        centroids = batch.column('Centroid').dictionary_encode()
+        centroid_codes = centroids.indices.to_numpy(zero_copy_only=False).astype(np.int64)
+        n_centroids = len(centroids.dictionary)
+        pairs, pair_codes = np.unique(cond_rows * n_centroids + centroid_codes, return_inverse=True)
+        seqs = centroids.dictionary.to_pylist()
+        pair_rows = np.array([self.bc_index.get((self.sample_bc_set[x // n_centroids], seqs[x % n_centroids]), -1)
+                              for x in pairs.tolist()] + [-1], dtype=np.int64)
+        bc_rows = pair_rows[pair_codes.ravel()] if len(pairs) else np.zeros(0, dtype=np.int64)
+
+        cond = self.cond_table.take(pa.array(cond_rows))
+        bc = self.bc_table.take(pa.array(bc_rows, mask=bc_rows < 0))
+        cols = {
+            'Sample_ID': samples,
+            'Centroid': centroids,
+            'Count': batch.column('Count'),
+            'barcode': batch.column('barcode').dictionary_encode(),
+            **{x: bc.column(x).combine_chunks() for x in bc.column_names},
+            **{x: cond.column(x).combine_chunks() for x in cond.column_names},
+        }
+        return pa.Table.from_pydict(cols)
+
+
+def read_counts(fname, block_size=BLOCK_SIZE):
+    "Stream Sample_ID,Centroid,Count,barcode record batches out of a csv"
+    pa = import_arrow()
+    types = {'Sample_ID': pa.string(), 'Centroid': pa.string(), 'Count': pa.int64(), 'barcode': pa.string()}
+    reader = pa.csv.open_csv(fname,
+                             read_options=pa.csv.ReadOptions(block_size=block_size),
+                             convert_options=pa.csv.ConvertOptions(column_types=types, include_columns=list(types),
+                                                                   strings_can_be_null=False))
+    for batch in reader:
+        yield batch
+
+
+def annotate_run(counts_file, cond_file, bc_map_file, run, out_dir, block_size=BLOCK_SIZE):
+    """
+    Annotate a run's counts and write them to out_dir/run=<run>/Plate_ID=*/
+
+    Output:
+    -------
+    (n_in, n_out) :: tuple
+        rows read and rows written
+    """
+    pa = import_arrow()
+    annotator = Annotator(read_conditions(cond_file), pd.read_csv(bc_map_file))
+
+    # write the run to a scratch directory and swap it in at the end, so a
+    # failed run never leaves partial (or stale) plates behind
+    run_dir = Path(out_dir) / f'run={quote(run, safe="")}'
+    tmp_dir = run_dir.with_name(f'.{run_dir.name}.tmp')
+    if tmp_dir.exists():
+        shutil.rmtree(tmp_dir)
+
+    n = {'in': 0, 'out': 0}
+    writers = {}
+    try:
+        for batch in read_counts(counts_file, block_size):
+            table = annotator.annotate(batch)
+            n['in'] += batch.num_rows
+            n['out'] += table.num_rows
+            plates = table.column('Plate_ID')
+            table = table.drop_columns(['Plate_ID'])
+            for plate in pa.compute.unique(plates).to_pylist():
+                if plate not in writers:
+                    plate_dir = tmp_dir / f'Plate_ID={quote(str(plate), safe="")}'
+                    plate_dir.mkdir(parents=True)
+                    writers[plate] = pa.parquet.ParquetWriter(plate_dir / 'part-0.parquet', table.schema)
+                writers[plate].write_table(table.filter(pa.compute.equal(plates, plate)), row_group_size=ROW_GROUP_SIZE)
+    finally:
+        for writer in writers.values():
+            writer.close()
+
+    if run_dir.exists():
+        shutil.rmtree(run_dir)
+    if writers:
+        tmp_dir.rename(run_dir)
+    return n['in'], n['out']
+
+
+#===============================================================================
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Join a run\'s counts to its conditions and barcode map, and write partitioned parquet')
+    parser.add_argument('counts',
+                        type=str,
+                        help='starcode.csv / correct.csv (Sample_ID,Centroid,Count,barcode)')
+    parser.add_argument('conditions',
+                        type=str,
+                        help='the run\'s conditions.csv')
+    parser.add_argument('bc_map',
+                        type=str,
+                        help='barcode map (e.g. data/barcode-map.csv)')
+    parser.add_argument('-r',
+                        '--run',
+                        dest='run',
+                        type=str,
+                        help='run id (default = name of the folder holding the counts)')
+    parser.add_argument('-o',
+                        '--out-dir',
+                        dest='out_dir',
+                        type=str,
+                        default='pipeline/annotated',
+                        help='root of the partitioned dataset (default = pipeline/annotated)')
+    parser.add_argument('-b',
+                        '--block-size',
+                        dest='block_size',
+                        type=int,
+                        default=BLOCK_SIZE,
+                        help='bytes of csv to parse at a time')
+    args = parser.parse_args()
+
+    run = args.run or Path(args.counts).resolve().parent.name
+    n_in, n_out = annotate_run(args.counts, args.conditions, args.bc_map, run, args.out_dir, args.block_size)
+    print(f'{run}: annotated {n_out} of {n_in} rows ({n_in - n_out} from samples not in the conditions)', file=sys.stderr)
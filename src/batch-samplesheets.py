@@ -0,0 +1,224 @@
+#!/usr/bin/env python3
+"""
+batch-samplesheets.py - generate SampleSheets for many plate maps without prompting
+
+Runs platemap2samp.py over a list (or glob) of workbooks in parallel worker
+processes. The header fields that platemap2samp.py prompts for are taken from
+flags or a config file instead, e.g.
+
+    [header]
+    name = Nate
+    experiment = swabseq
+    date = 20200403
+    instrument = NextSeq
+    cycles = 26
+
+Each SampleSheet.csv is written next to its workbook. A workbook that fails is
+reported (with how long each one took) without stopping the rest of the batch.
+"""
+
+import os
+import sys
+import glob
+import time
+import argparse
+import configparser
+from pathlib import Path
+from datetime import date
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import plate_maps as pm
+import platemap2samp as p2s
+
+HEADER_FIELDS = ['name', 'experiment', 'date', 'instrument', 'cycles']
+
+#===============================================================================
+
+def read_config(fname):
+    """
+    Pull the header fields out of the [header] section of an ini file.
+
+    Output:
+    -------
+    fields :: dict
+        {field: value} for any of HEADER_FIELDS that are set
+    """
+    config = configparser.ConfigParser()
+    if not config.read(fname):
+        raise FileNotFoundError(f'Could not read config file {fname}')
+    if 'header' not in config:
+        raise ValueError(f'{fname} has no [header] section')
+    unknown = set(config['header']) - set(HEADER_FIELDS)
+    if unknown:
+        raise ValueError(f'Unknown header field(s) in {fname}: {", ".join(sorted(unknown))}. Options: {", ".join(HEADER_FIELDS)}')
+    return dict(config['header'])
+
+
+def expand_workbooks(patterns):
+    "Expand globs (and plain paths) into a sorted list of unique workbooks"
+    res = []
+    for pattern in patterns:
+        hits = glob.glob(pattern, recursive=True)
+        res.extend(hits if hits else [pattern])
+    return sorted(set(res))
+
+
+def out_path(sheet):
+    "SampleSheet.csv next to the workbook"
+    return Path(sheet).parent / 'SampleSheet.csv'
+
+
+def run_workbook(sheet, header, rc, cache_dir, mismatches):
+    """
+    Write the SampleSheet of a single workbook.
+
+    Output:
+    -------
+    (ok, n_rows or error message, seconds) :: tuple
+    """
+    start = time.perf_counter()
+    out_file = out_path(sheet)
+    tmp_file = out_file.with_name(f'.{out_file.name}.{os.getpid()}.tmp')
+    try:
+        out_df = p2s.plate_maps_to_samplesheet(sheet, cache_dir = cache_dir, mismatches = mismatches)
+
+        # write then rename so a failure never leaves half a SampleSheet behind
+        with open(tmp_file, 'w') as fh:
+            p2s.write_samplesheet(out_df, header, rc, fh)
+        os.replace(tmp_file, out_file)
+        res = (True, len(out_df))
+    except Exception as e:
+        res = (False, f'{type(e).__name__}: {e}')
+    finally:
+        if tmp_file.exists():
+            tmp_file.unlink()
+    return res + (time.perf_counter() - start,)
+
+
+def run_batch(sheets, header, rc, cache_dir=None, workers=None, mismatches=0):
+    """
+    Write every workbook's SampleSheet on a process pool.
+
+    Input:
+    ------
+    sheets :: list
+        paths to plate map workbooks
+    header, rc :: str, bool
+        see platemap2samp.make_header
+    cache_dir :: str
+        see plate_maps.read_plate_map_set
+    workers :: int
+        number of worker processes (default = number of cpus)
+    mismatches :: int
+        see platemap2samp.plate_maps_to_samplesheet
+
+    Output:
+    -------
+    results :: dict
+        {sheet: (ok, n_rows or error message, seconds)}
+    """
+    results = {}
+
+    # workbooks that share a folder would overwrite each other's SampleSheet
+    by_out = {}
+    for sheet in sheets:
+        by_out.setdefault(out_path(sheet), []).append(sheet)
+    todo = []
+    for out_file, group in by_out.items():
+        if len(group) > 1:
+            for sheet in group:
+                results[sheet] = (False, f'{out_file} would be written by several workbooks: {", ".join(group)}', 0.0)
+        else:
+            todo.extend(group)
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(run_workbook, sheet, header, rc, cache_dir, mismatches): sheet for sheet in todo}
+        for future in as_completed(futures):
+            sheet = futures[future]
+            try:
+                results[sheet] = future.result()
+            except Exception as e:
+                # the worker itself died
+                results[sheet] = (False, f'{type(e).__name__}: {e}', 0.0)
+            ok, res, seconds = results[sheet]
+            print(f'{"ok" if ok else "FAILED"}\t{seconds:.2f}s\t{sheet}\t{res}', file=sys.stderr)
+
+    return results
+
+
+#===============================================================================
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Write a SampleSheet.csv next to each plate map workbook without prompting for the header')
+    parser.add_argument('sheets',
+                        type=str,
+                        nargs='+',
+                        help='plate map *.xlsx files or globs (e.g. "data/plate-maps/*/*.xlsx")')
+    parser.add_argument('-c',
+                        '--config',
+                        dest='config',
+                        type=str,
+                        help='ini file with a [header] section of name, experiment, date, instrument, cycles')
+    parser.add_argument('--name',
+                        type=str,
+                        help='investigator name')
+    parser.add_argument('--experiment',
+                        type=str,
+                        help='experiment name')
+    parser.add_argument('--date',
+                        type=str,
+                        help='run date (default = today, YYYYMMDD)')
+    parser.add_argument('--instrument',
+                        type=str,
+                        help=f'one of {", ".join(p2s.INSTRUMENTS)} (decides whether i5 is reverse complemented)')
+    parser.add_argument('--cycles',
+                        type=str,
+                        help='cycles, separated by "," for paired end e.g. 151,151')
+    parser.add_argument('-j',
+                        '--jobs',
+                        dest='jobs',
+                        type=int,
+                        help='number of worker processes (default = number of cpus)')
+    parser.add_argument('--cache-dir',
+                        dest='cache_dir',
+                        type=str,
+                        default=pm.DEFAULT_CACHE_DIR,
+                        help=f'where to cache parsed plate maps (default = {pm.DEFAULT_CACHE_DIR})')
+    parser.add_argument('--no-cache',
+                        dest='no_cache',
+                        action='store_true',
+                        help='always reparse the workbooks')
+    parser.add_argument('-m',
+                        '--mismatches',
+                        dest='mismatches',
+                        type=int,
+                        default=0,
+                        help=f'also reject i5/i7 pairs that would collide when demultiplexing with this many index mismatches (default = 0, only reject exact duplicates; demux.py allows {p2s.ic.demux.MISMATCHES})')
+    args = parser.parse_args()
+
+    # flags take precedence over the config file
+    fields = read_config(args.config) if args.config else {}
+    for field in HEADER_FIELDS:
+        if getattr(args, field) is not None:
+            fields[field] = getattr(args, field)
+    fields.setdefault('date', date.today().strftime('%Y%m%d'))
+    missing = [x for x in HEADER_FIELDS if x not in fields]
+    if missing:
+        parser.error(f'Missing header field(s): {", ".join(missing)} (use flags or --config)')
+
+    try:
+        header, rc = p2s.make_header(fields['name'], fields['experiment'], fields['date'], fields['instrument'], fields['cycles'])
+    except ValueError as e:
+        parser.error(str(e))
+
+    sheets = expand_workbooks(args.sheets)
+    if not sheets:
+        parser.error('No workbooks found')
+
+    results = run_batch(sheets, header, rc, None if args.no_cache else args.cache_dir, args.jobs, args.mismatches)
+
+    n_failed = sum(not ok for ok, _, _ in results.values())
+    print(f'{len(results) - n_failed} of {len(results)} SampleSheets written', file=sys.stderr)
+    if n_failed:
+        sys.exit(1)
@@ -0,0 +1,243 @@
+#!/usr/bin/env python3
+"""
+classify.py - call every well of a run from its count matrix in one pass
+
+Reads a run's count store (see count_matrix.py), sums its barcode columns
+into one column per amplicon of the barcode map (RPP30, S2, S2_spike, N1,
+N1_spike, ...) with a single matrix product, and makes every well's call
+with array operations:
+
+    viral amplicons  the amplicons X of the well's bc_set that have an
+                     X_spike (only nCoV_amplicon, if the conditions have it)
+    <X>_ratio        (X + 1) / (X_spike + 1)
+    viral_reads      sum of X + X_spike over the viral amplicons
+    RPP30_detected   RPP30 >= --min-rpp30
+
+    call             failed        viral_reads < --min-reads
+                     positive      any <X>_ratio > --ratio
+                     negative      RPP30 detected
+                     inconclusive  otherwise
+
+Output is one row per well (Sample_ID, Plate_ID, Sample_Well, bc_set, a
+count column per amplicon, the ratios, viral_reads, RPP30_detected, call),
+in the store's row order.
+"""
+
+import os
+import sys
+import csv
+import argparse
+from collections import Counter
+from pathlib import Path
+
+import numpy as np
+
+import count_matrix as cm
+
+# a well needs this many virus + spike reads to be called at all
+MIN_READS = 2000
+# virus / spike ratio above which a well is positive
+RATIO = 0.003
+# RPP30 reads for a negative to count as a good sample
+MIN_RPP30 = 10
+
+HOUSEKEEPING = 'RPP30'
+SPIKE_SUFFIX = '_spike'
+
+CALLS = np.array(['inconclusive', 'negative', 'positive', 'failed'], dtype=object)
+
+#===============================================================================
+
+def read_bc_amplicons(fname):
+    "{bc_set: set of amplicons} of a barcode map"
+    bc_amplicons = {}
+    with open(fname, newline='') as fh:
+        for row in csv.DictReader(fh):
+            bc_amplicons.setdefault(row['bc_set'], set()).add(row['amplicon'])
+    return bc_amplicons
+
+
+def amplicon_counts(m):
+    """
+    Sum a count store's barcode columns per amplicon.
+
+    Input:
+    ------
+    m :: count_matrix.CountMatrix
+
+    Output:
+    -------
+    (amplicons, counts) :: tuple
+        amplicon names (the store's column order, without 'other') and a
+        wells x amplicons int64 matrix
+    """
+    amplicons = list(dict.fromkeys(x for x in m.amplicons if x != cm.OTHER))
+    col_of = {x: i for i, x in enumerate(amplicons)}
+    onehot = np.zeros((len(m.amplicons), len(amplicons)), dtype=np.int64)
+    for i, amp in enumerate(m.amplicons):
+        if amp in col_of:
+            onehot[i, col_of[amp]] = 1
+    return amplicons, np.asarray(m.counts, dtype=np.int64) @ onehot
+
+
+def viral_mask(amplicons, bc_sets, bc_amplicons, expected=None):
+    """
+    Which viral amplicons count towards each well's call.
+
+    Input:
+    ------
+    amplicons :: list
+        see amplicon_counts
+    bc_sets :: list
+        bc_set of every well
+    bc_amplicons :: dict
+        see read_bc_amplicons
+    expected :: list
+        nCoV_amplicon of every well, if the conditions have it
+
+    Output:
+    -------
+    (viral, mask) :: tuple
+        amplicons X with an X_spike in the map, and a wells x len(viral) bool
+        matrix of the ones each well is called on
+    """
+    viral = [x for x in amplicons if x + SPIKE_SUFFIX in amplicons]
+    mask = np.zeros((len(bc_sets), len(viral)), dtype=bool)
+    for j, amp in enumerate(viral):
+        has = {x for x, amps in bc_amplicons.items() if amp in amps and amp + SPIKE_SUFFIX in amps}
+        mask[:, j] = [x in has for x in bc_sets]
+        if expected is not None:
+            mask[:, j] &= np.array([x in ('', amp) for x in expected], dtype=bool)
+    return viral, mask
+
+
+def classify(amplicons, counts, mask, min_reads=MIN_READS, ratio=RATIO, min_rpp30=MIN_RPP30):
+    """
+    Call every well.
+
+    Input:
+    ------
+    amplicons, counts :: list, np.array
+        see amplicon_counts
+    mask :: np.array
+        see viral_mask (its columns are the viral amplicons in amplicons order)
+
+    Output:
+    -------
+    res :: dict
+        {'<X>_ratio': float array, ..., 'viral_reads', 'RPP30_detected',
+         'call'} with one entry per well
+    """
+    col = {x: i for i, x in enumerate(amplicons)}
+    viral = [x for x in amplicons if x + SPIKE_SUFFIX in col]
+    virus = counts[:, [col[x] for x in viral]]
+    spike = counts[:, [col[x + SPIKE_SUFFIX] for x in viral]]
+
+    ratios = (virus + 1) / (spike + 1)
+    viral_reads = np.where(mask, virus + spike, 0).sum(axis=1)
+    detected = (np.where(mask, ratios, 0) > ratio).any(axis=1)
+    rpp30 = counts[:, col[HOUSEKEEPING]] >= min_rpp30 if HOUSEKEEPING in col else np.zeros(len(counts), dtype=bool)
+
+    # later conditions win: inconclusive < negative < positive < failed
+    call = np.zeros(len(counts), dtype=np.intp)
+    call[rpp30] = 1
+    call[detected] = 2
+    call[viral_reads < min_reads] = 3
+
+    res = {f'{x}_ratio': np.where(mask[:, j], ratios[:, j], np.nan) for j, x in enumerate(viral)}
+    res['viral_reads'] = viral_reads
+    res['RPP30_detected'] = rpp30
+    res['call'] = CALLS[call]
+    return res
+
+
+def classify_run(store, conds_file, bc_map_file, out_file, **thresholds):
+    """
+    Call every well of a count store and write the per-well table.
+
+    Input:
+    ------
+    store :: str
+        count store folder (see count_matrix.build)
+    conds_file :: str
+        conditions.csv (Sample_ID, bc_set, optionally nCoV_amplicon)
+    bc_map_file :: str
+        bc-map.csv
+    out_file :: str
+        csv to write
+    thresholds :: dict
+        min_reads, ratio, min_rpp30 (see classify)
+
+    Output:
+    -------
+    calls :: collections.Counter
+        wells per call
+    """
+    m = cm.CountMatrix(store)
+    with open(conds_file, newline='') as fh:
+        conds = {row['Sample_ID']: row for row in csv.DictReader(fh)}
+    missing = [x for x in m.sample_ids if x not in conds]
+    if missing:
+        raise ValueError(f'{len(missing)} wells of {store} are not in {conds_file} (e.g. {missing[0]})')
+    rows = [conds[x] for x in m.sample_ids]
+    bc_sets = [row['bc_set'] for row in rows]
+    expected = [row['nCoV_amplicon'] for row in rows] if rows and 'nCoV_amplicon' in rows[0] else None
+
+    amplicons, counts = amplicon_counts(m)
+    _, mask = viral_mask(amplicons, bc_sets, read_bc_amplicons(bc_map_file), expected)
+    res = classify(amplicons, counts, mask, **thresholds)
+
+    ratio_cols = [x for x in res if x.endswith('_ratio')]
+    tmp = f'{out_file}.tmp'
+    with open(tmp, 'w', newline='') as fh:
+        writer = csv.writer(fh, lineterminator='\n')
+        writer.writerow(['Sample_ID', 'Plate_ID', 'Sample_Well', 'bc_set'] + amplicons + ratio_cols + ['viral_reads', 'RPP30_detected', 'call'])
+        # wells not called on an amplicon get a blank ratio
+        ratio_text = [np.where(np.isnan(res[x]), '', np.char.mod('%.6g', res[x])).tolist() for x in ratio_cols]
+        columns = [m.sample_ids, m.plate_ids, m.wells, bc_sets, *counts.T.tolist(), *ratio_text,
+                   res['viral_reads'].tolist(), res['RPP30_detected'].tolist(), res['call'].tolist()]
+        writer.writerows(zip(*columns))
+    os.replace(tmp, out_file)
+    return Counter(res['call'].tolist())
+
+
+#===============================================================================
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Call every well of a run (positive/negative/inconclusive/failed) from its count matrix')
+    parser.add_argument('store',
+                        type=str,
+                        help='count store folder (see count_matrix.py)')
+    parser.add_argument('conditions',
+                        type=str,
+                        help='the run\'s conditions.csv')
+    parser.add_argument('bc_map',
+                        type=str,
+                        help='path to bc-map.csv')
+    parser.add_argument('-o',
+                        '--out-file',
+                        dest='out_file',
+                        type=str,
+                        help='calls csv (default = calls.csv next to the store)')
+    parser.add_argument('--min-reads',
+                        dest='min_reads',
+                        type=int,
+                        default=MIN_READS,
+                        help='virus + spike reads a well needs to be called')
+    parser.add_argument('--ratio',
+                        type=float,
+                        default=RATIO,
+                        help='virus / spike ratio above which a well is positive')
+    parser.add_argument('--min-rpp30',
+                        dest='min_rpp30',
+                        type=int,
+                        default=MIN_RPP30,
+                        help='RPP30 reads for a well to be negative rather than inconclusive')
+    args = parser.parse_args()
+
+    out_file = args.out_file or str(Path(args.store).resolve().parent / 'calls.csv')
+    calls = classify_run(args.store, args.conditions, args.bc_map, out_file,
+                         min_reads=args.min_reads, ratio=args.ratio, min_rpp30=args.min_rpp30)
+    summary = ', '.join(f'{calls[x]} {x}' for x in CALLS if calls[x])
+    print(f'{sum(calls.values())} wells ({summary}) written to {out_file}', file=sys.stderr)
@@ -0,0 +1,299 @@
+#!/usr/bin/env python3
+"""
+conditions.py - SampleSheet.csv -> conditions.csv in one process
+
+Replaces the conditions.csv recipe's
+
+    strip-windows.py | awk '/Sample_ID/{seen=1} seen{print}'
+        | Rscript collapseSampleSheet.R | Rscript bc-lengths.R
+
+and writes the same bytes, without starting R (and tidyverse) twice:
+
+    * lines before the first one with "Sample_ID" are skipped (line endings
+      and a BOM are normalized as strip-windows.py does)
+    * columns are typed as readr's read_csv guesses them from every row
+      (blank/NA -> NA, then logical, double, else character) and written
+      back as write_csv does (TRUE/FALSE, NA, shortest doubles in fixed
+      notation - readr before 1.2 wrote 20000 as 2e4)
+    * Sample_ID becomes Plate_ID-Sample_Well and rows that agree on every
+      column but index/index2 are collapsed, joining their indices with "-".
+      Rows come out sorted by those columns, left to right (numbers by value,
+      text by code point, NA last), with index and index2 moved to the end
+    * bc_len (the barcode length of the row's bc_set in the barcode map) is
+      added last - every barcode of a bc_set must have the same length
+
+Only the standard library (and metrics.py) is imported, so it starts in a
+fraction of a second.
+"""
+
+import io
+import os
+import re
+import sys
+import csv
+import math
+import argparse
+from decimal import Decimal
+from itertools import groupby
+from signal import signal, SIGPIPE, SIG_DFL
+
+import metrics
+
+# catch broken pipe errors to allow ex) python pyParse.py foo bar | head
+# see: https://stackoverflow.com/a/30091579
+signal(SIGPIPE, SIG_DFL)
+
+INDEX_COLS = ['index', 'index2']
+
+NA_STRINGS = {'', 'NA'}
+LOGICALS = {'T': True, 'TRUE': True, 'True': True, 'true': True,
+            'F': False, 'FALSE': False, 'False': False, 'false': False}
+DOUBLE_RE = re.compile(r'[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?')
+NEEDS_QUOTE = re.compile(r'[,"\r\n]')
+
+#===============================================================================
+
+def read_data_section(handle):
+    """
+    Rows of a SampleSheet from the first line containing "Sample_ID" on.
+
+    Input:
+    ------
+    handle :: file-like
+        text opened with newline=None (any line ending) and utf-8-sig (BOM)
+
+    Output:
+    -------
+    (header, rows) :: tuple
+        column names and lists of strings (blank lines skipped, short rows
+        padded with '')
+    """
+    lines = iter(handle)
+    for line in lines:
+        if 'Sample_ID' in line:
+            break
+    else:
+        raise ValueError('No line with "Sample_ID" (the [Data] header) in the sample sheet')
+    header, *rows = csv.reader(io.StringIO(line + ''.join(lines)))
+    header = [x.strip() for x in header]
+    width = len(header)
+    return header, [row if len(row) == width else (row + [''] * width)[:width] for row in rows if row]
+
+
+def guess_column(vals):
+    """
+    Parse a column the way readr's read_csv would guess it.
+
+    Input:
+    ------
+    vals :: iterable
+        the column's strings (surrounding whitespace is dropped)
+
+    Output:
+    -------
+    (kind, parsed) :: tuple
+        'logical', 'double', or 'character', and {string: value} for every
+        distinct string (None for NA) - readr guesses whole numbers as doubles
+        too
+    """
+    trimmed = {x: x.strip() for x in set(vals)}
+    present = set(trimmed.values()) - NA_STRINGS
+    if all(x in LOGICALS for x in present):
+        kind, parse = 'logical', LOGICALS.get
+    elif all(DOUBLE_RE.fullmatch(x) for x in present):
+        kind, parse = 'double', float
+    else:
+        kind, parse = 'character', str
+    return kind, {x: None if y in NA_STRINGS else parse(y) for x, y in trimmed.items()}
+
+
+def format_double(x):
+    """
+    Write a double as readr's write_csv does: the shortest digits that read
+    back as the same number, in fixed notation (20000, 0.0711273687954072)
+    """
+    if math.isnan(x):
+        return 'NA'
+    if math.isinf(x):
+        return 'Inf' if x > 0 else '-Inf'
+    if x == 0:
+        return '0'
+    if not 1e-15 < abs(x) < 1e15:
+        return repr(x)
+    text = format(Decimal(repr(x)), 'f')
+    return text[:-2] if text.endswith('.0') else text
+
+
+def format_value(x, kind):
+    "Write a parsed value as write_csv does"
+    if x is None:
+        return 'NA'
+    if kind == 'logical':
+        return 'TRUE' if x else 'FALSE'
+    if kind == 'double':
+        return format_double(x)
+    return str(x)
+
+
+def format_row(row):
+    "A csv line, quoting only the fields that need it"
+    if NEEDS_QUOTE.search(''.join(row)) is None:
+        return ','.join(row)
+    return ','.join('"' + x.replace('"', '""') + '"' if NEEDS_QUOTE.search(x) else x for x in row)
+
+
+def sort_key(x):
+    "Order values as dplyr's group_by does: by value, NA last"
+    return (1, 0) if x is None else (0, x)
+
+
+def encode_column(vals):
+    """
+    Format and rank a column once per distinct string.
+
+    Output:
+    -------
+    (text, ranks) :: tuple
+        the write_csv text and the sort rank (equal values share one) of every
+        row
+    """
+    kind, parsed = guess_column(vals)
+    keys = {x: sort_key(v) for x, v in parsed.items()}
+    rank_of = {k: i for i, k in enumerate(sorted(set(keys.values())))}
+    text_of = {x: format_value(v, kind) for x, v in parsed.items()}
+    return [text_of[x] for x in vals], [rank_of[keys[x]] for x in vals]
+
+
+def collapse(header, rows):
+    """
+    Collapse the rows of each well (see collapseSampleSheet.R).
+
+    Input:
+    ------
+    header, rows :: list
+        see read_data_section
+
+    Output:
+    -------
+    (header, rows) :: tuple
+        output columns and rows of formatted strings
+    """
+    missing = [x for x in ['Plate_ID', 'Sample_Well'] + INDEX_COLS if x not in header]
+    if missing:
+        raise ValueError(f'The sample sheet has no {", ".join(missing)} column(s)')
+    columns = [list(col) for col in zip(*rows)] if rows else [[] for _ in header]
+    text, ranks = map(list, zip(*map(encode_column, columns)))
+
+    # Sample_ID is reset to Plate_ID-Sample_Well (NA pastes as "NA")
+    plate, well = header.index('Plate_ID'), header.index('Sample_Well')
+    sample_ids = [f'{p}-{w}' for p, w in zip(text[plate], text[well])]
+    if 'Sample_ID' not in header:
+        header = header + ['Sample_ID']
+        text.append(None)
+        ranks.append(None)
+    i = header.index('Sample_ID')
+    text[i], ranks[i] = encode_column(sample_ids)
+
+    key_cols = [i for i, x in enumerate(header) if x not in INDEX_COLS]
+    index_cols = [header.index(x) for x in INDEX_COLS]
+    # rows of a well end up next to each other, then each run of identical
+    # ranks is a group
+    ranks = list(zip(*[ranks[i] for i in key_cols])) or [()] * len(rows)
+    order = sorted(range(len(rows)), key=ranks.__getitem__)
+
+    out = []
+    for _, group in groupby(order, key=ranks.__getitem__):
+        group = list(group)
+        out.append([text[i][group[0]] for i in key_cols] + ['-'.join(text[i][r] for r in group) for i in index_cols])
+    return [header[i] for i in key_cols] + INDEX_COLS, out
+
+
+def read_bc_lengths(fname):
+    """
+    Barcode length of every bc_set in a barcode map (see bc-lengths.R).
+
+    Output:
+    -------
+    bc_lens :: dict
+        {bc_set: length}
+    """
+    lengths = {}
+    with open(fname, newline='', encoding='utf-8-sig') as fh:
+        for row in csv.DictReader(fh):
+            lengths.setdefault(row['bc_set'], []).append(len(row['sequence'].strip()))
+    bad = [x for x, lens in lengths.items() if len(set(lens)) > 1]
+    if bad:
+        raise ValueError(f'All barcodes in the same "bc_set" in {fname} must have the same length. These bc_sets are in violation: {", ".join(bad)}')
+    return {x: lens[0] for x, lens in lengths.items()}
+
+
+def build_conditions(sample_sheet, bc_map):
+    """
+    Build conditions.csv (see the module docstring).
+
+    Input:
+    ------
+    sample_sheet :: file-like
+        SampleSheet.csv text (see read_data_section)
+    bc_map :: str
+        path to bc-map.csv
+
+    Output:
+    -------
+    text :: str
+        conditions.csv
+    """
+    bc_lens = read_bc_lengths(bc_map)
+    header, rows = collapse(*read_data_section(sample_sheet))
+    bc_set = header.index('bc_set') if 'bc_set' in header else None
+    lines = [format_row(header + ['bc_len'])]
+    for row in rows:
+        bc_len = bc_lens.get(row[bc_set]) if bc_set is not None else None
+        lines.append(format_row(row + ['NA' if bc_len is None else str(bc_len)]))
+    return '\n'.join(lines) + '\n'
+
+
+#===============================================================================
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Collapse a SampleSheet to one row per well and add each bc_set\'s barcode length')
+    parser.add_argument('sample_sheet',
+                        type=str,
+                        help='SampleSheet.csv (or - for stdin)')
+    parser.add_argument('bc_map',
+                        type=str,
+                        help='path to bc-map.csv')
+    parser.add_argument('-o',
+                        '--out-file',
+                        dest='out_file',
+                        type=str,
+                        help='conditions.csv to write (default = stdout)')
+    parser.add_argument('--metrics',
+                        type=str,
+                        help=f'append the stage\'s timings to this *.jsonl (default = ${metrics.METRICS_ENV} if set)')
+    args = parser.parse_args()
+
+    if args.metrics:
+        metrics.enable(args.metrics)
+
+    if args.sample_sheet == '-':
+        infile = io.TextIOWrapper(sys.stdin.buffer, encoding='utf-8-sig', newline=None)
+    else:
+        infile = open(args.sample_sheet, encoding='utf-8-sig', newline=None)
+    with metrics.stage('conditions', unit='wells') as m:
+        try:
+            with infile:
+                text = build_conditions(infile, args.bc_map)
+        except ValueError as err:
+            print(f'Error: {err}', file=sys.stderr)
+            sys.exit(1)
+
+        if args.out_file:
+            tmp = f'{args.out_file}.tmp'
+            with open(tmp, 'w', newline='') as fh:
+                fh.write(text)
+            os.replace(tmp, args.out_file)
+        else:
+            sys.stdout.write(text)
+        m.items = text.count('\n') - 1
@@ -0,0 +1,264 @@
+#!/usr/bin/env python3
+"""
+correct_bcs.py - error correct barcode counts against the known amplicons
+
+A fast alternative to `starcode -d2 --sphere --print-clusters | tidy-star.py`.
+Every bc_set in the barcode map only holds a handful of expected sequences, so
+rather than clustering each sample from scratch we enumerate every sequence
+within edit distance max_dist of each expected sequence once, store them in a
+dict, and correct each observed barcode with a single lookup.
+
+Output matches the tidied starcode table (Sample_ID,Centroid,Count,barcode),
+where Count is the total count of the cluster. Barcodes that don't land near
+any expected sequence are passed through as their own single member cluster.
+"""
+
+import sys
+import csv
+import argparse
+from collections import defaultdict
+from signal import signal, SIGPIPE, SIG_DFL
+
+# catch broken pipe errors to allow ex) python pyParse.py foo bar | head
+# see: https://stackoverflow.com/a/30091579
+signal(SIGPIPE, SIG_DFL)
+
+# same as starcode -d2
+MAX_DIST = 2
+BASES = 'ACGTN'
+
+#===============================================================================
+
+def read_bc_map(fname):
+    """
+    Parse the barcode map into the expected sequences of each bc_set.
+
+    Input:
+    ------
+    fname :: str
+        path to bc-map.csv (sequence,target,amplicon,bc_set)
+
+    Output:
+    -------
+    bc_sets :: dict
+        {bc_set: [sequence, ...]}
+    """
+    bc_sets = defaultdict(list)
+    with open(fname, newline='') as fh:
+        for row in csv.DictReader(fh):
+            if row['sequence'] not in bc_sets[row['bc_set']]:
+                bc_sets[row['bc_set']].append(row['sequence'])
+    return dict(bc_sets)
+
+
+def edit_neighbors(seq, alphabet=BASES):
+    """
+    Every sequence one substitution, insertion, or deletion away from seq.
+
+    Input:
+    ------
+    seq :: str
+    alphabet :: str
+        bases to substitute/insert
+
+    Output:
+    -------
+    neighbors :: set
+        does not include seq itself
+    """
+    res = set()
+    for i in range(len(seq) + 1):
+        pre, suf = seq[:i], seq[i:]
+        for b in alphabet:
+            res.add(pre + b + suf)
+        if suf:
+            res.add(pre + suf[1:])
+            for b in alphabet:
+                if b != suf[0]:
+                    res.add(pre + b + suf[1:])
+    res.discard(seq)
+    return res
+
+
+def neighborhood(seq, max_dist=MAX_DIST):
+    """
+    Every sequence within Levenshtein distance max_dist of seq.
+
+    Input:
+    ------
+    seq :: str
+    max_dist :: int
+
+    Output:
+    -------
+    dists :: dict
+        {sequence: distance to seq}
+    """
+    dists = {seq: 0}
+    frontier = {seq}
+    # breadth first, so the first time we see a sequence is its true distance
+    for d in range(1, max_dist + 1):
+        new = set()
+        for x in frontier:
+            new.update(edit_neighbors(x))
+        new.difference_update(dists)
+        dists.update(dict.fromkeys(new, d))
+        frontier = new
+    return dists
+
+
+def build_index(targets, max_dist=MAX_DIST):
+    """
+    Build the lookup table from observed barcode to expected sequence.
+
+    Input:
+    ------
+    targets :: list
+        expected sequences of a single bc_set
+    max_dist :: int
+        maximum edit distance to correct
+
+    Output:
+    -------
+    index :: dict
+        {barcode: target}. Barcodes with a tie for the closest target map to
+        None and are left uncorrected.
+    ambiguous :: dict
+        {barcode: {target: distance, ...}} for every barcode within max_dist
+        of more than one target
+    """
+    hits = defaultdict(dict)
+    for target in targets:
+        for bc, d in neighborhood(target, max_dist).items():
+            hits[bc][target] = d
+
+    index = {}
+    ambiguous = {}
+    for bc, cands in hits.items():
+        if len(cands) == 1:
+            index[bc] = next(iter(cands))
+            continue
+        ambiguous[bc] = cands
+        best = min(cands.values())
+        closest = [t for t, d in cands.items() if d == best]
+        index[bc] = closest[0] if len(closest) == 1 else None
+
+    return index, ambiguous
+
+
+def correct_counts(counts, index):
+    """
+    Group observed barcodes into clusters around their expected sequence.
+
+    Input:
+    ------
+    counts :: dict
+        {barcode: count}
+    index :: dict
+        see build_index
+
+    Output:
+    -------
+    clusters :: dict
+        {centroid: {barcode: count}}
+    """
+    clusters = defaultdict(dict)
+    for bc, n in counts.items():
+        centroid = index.get(bc)
+        if centroid is None:
+            centroid = bc
+        clusters[centroid][bc] = clusters[centroid].get(bc, 0) + n
+    return dict(clusters)
+
+
+def tidy_clusters(sample_id, clusters):
+    """
+    Flatten clusters into (Sample_ID, Centroid, Count, barcode) rows.
+
+    Clusters are ordered by total count (largest first) as starcode does.
+    """
+    totals = {c: sum(members.values()) for c, members in clusters.items()}
+    for centroid in sorted(totals, key=lambda c: (-totals[c], c)):
+        members = clusters[centroid]
+        for bc in sorted(members, key=lambda b: (-members[b], b)):
+            yield (sample_id, centroid, totals[centroid], bc)
+
+
+def read_counts(handle):
+    """
+    Parse "barcode count" lines (see count_bcs.py) into a dict.
+    """
+    counts = {}
+    for line in handle:
+        split = line.split()
+        if len(split) == 1:
+            # empty barcode
+            split = ['', split[0]]
+        if split:
+            counts[split[0]] = counts.get(split[0], 0) + int(split[1])
+    return counts
+
+
+#===============================================================================
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Error correct barcode counts against the expected sequences in a barcode map')
+    parser.add_argument('bc_map',
+                        type=str,
+                        help='path to bc-map.csv')
+    parser.add_argument('bc_set',
+                        type=str,
+                        help='bc_set to correct against')
+    parser.add_argument('infile',
+                        type=argparse.FileType('r'),
+                        default=sys.stdin,
+                        nargs='?',
+                        help='"barcode count" table from count_bcs.py (or stdin if none)')
+    parser.add_argument('-s',
+                        '--sample-id',
+                        dest='sample_id',
+                        type=str,
+                        required=True,
+                        help='Sample_ID to prepend to every row')
+    parser.add_argument('-d',
+                        '--dist',
+                        dest='dist',
+                        type=int,
+                        default=MAX_DIST,
+                        help='maximum edit distance to correct (default = 2)')
+    parser.add_argument('-a',
+                        '--ambiguous',
+                        dest='ambiguous',
+                        type=argparse.FileType('w'),
+                        help='write observed barcodes within --dist of several expected sequences here')
+    parser.add_argument('--header',
+                        action='store_true',
+                        help='print the "Sample_ID,Centroid,Count,barcode" header')
+    parser.add_argument('--drop-unmatched',
+                        dest='drop_unmatched',
+                        action='store_true',
+                        help='only report barcodes that correct to an expected sequence')
+    args = parser.parse_args()
+
+    bc_sets = read_bc_map(args.bc_map)
+    if args.bc_set not in bc_sets:
+        raise ValueError(f'bc_set "{args.bc_set}" is not in {args.bc_map}. Options: {", ".join(bc_sets)}')
+    index, ambiguous = build_index(bc_sets[args.bc_set], args.dist)
+
+    counts = read_counts(args.infile)
+    if args.drop_unmatched:
+        counts = {bc: n for bc, n in counts.items() if index.get(bc) is not None}
+    clusters = correct_counts(counts, index)
+
+    writer = csv.writer(sys.stdout, lineterminator='\n')
+    if args.header:
+        writer.writerow(['Sample_ID', 'Centroid', 'Count', 'barcode'])
+    writer.writerows(tidy_clusters(args.sample_id, clusters))
+
+    if args.ambiguous:
+        amb_writer = csv.writer(args.ambiguous, lineterminator='\n')
+        for bc in sorted(set(counts) & ambiguous.keys()):
+            cands = ambiguous[bc]
+            amb_writer.writerow([args.sample_id, bc, counts[bc], index[bc] or '',
+                                 ';'.join(f'{t}:{d}' for t, d in sorted(cands.items(), key=lambda x: x[1]))])
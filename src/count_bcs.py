@@ -0,0 +1,315 @@
+#!/usr/bin/env python3
+"""
+count_bcs.py - count barcode prefixes in (gzipped) fastqs
+
+Drop-in replacement for `zcat *.fastq.gz | awk -f count-bcs.awk`. Rather than
+handing every read to awk, the decompressed stream is read in large blocks,
+the sequence line of each record is located with numpy, and the first bc_len
+bases are 2-bit packed into a single integer so the counting step is a
+vectorized np.unique. Output is the same "barcode count" table starcode eats.
+"""
+
+import os
+import sys
+import gzip
+import time
+import argparse
+from collections import Counter
+from signal import signal, SIGPIPE, SIG_DFL
+
+import numpy as np
+
+import metrics
+
+# catch broken pipe errors to allow ex) python pyParse.py foo bar | head
+# see: https://stackoverflow.com/a/30091579
+signal(SIGPIPE, SIG_DFL)
+
+# 16 MiB of decompressed fastq per block
+BLOCK_SIZE = 1 << 24
+
+# 2-bit encoding of each base - anything else (N, lowercase, etc) is flagged
+# with 4 and sent down the slow path so the output matches awk exactly
+BASES = b'ACGT'
+ENCODE = np.full(256, 4, dtype=np.uint8)
+for i, b in enumerate(BASES):
+    ENCODE[b] = i
+DECODE = np.frombuffer(BASES, dtype=np.uint8)
+
+# packed barcodes live in a uint64
+MAX_BC_LEN = 32
+
+NEWLINE = ord('\n')
+
+#===============================================================================
+
+def open_fastq(fname):
+    """
+    Open a fastq for binary reading, transparently handling gzip and stdin.
+
+    Input:
+    ------
+    fname :: str
+        path to a fastq(.gz), or '-' for stdin
+
+    Output:
+    -------
+    handle :: file-like
+        binary file handle
+    """
+    if fname == '-':
+        return sys.stdin.buffer
+    with open(fname, 'rb') as fh:
+        magic = fh.read(2)
+    if magic == b'\x1f\x8b':
+        return gzip.open(fname, 'rb')
+    return open(fname, 'rb')
+
+
+def read_blocks(handle, block_size=BLOCK_SIZE):
+    """
+    Yield blocks of whole fastq records from a binary file handle.
+
+    Input:
+    ------
+    handle :: file-like
+        binary file handle
+    block_size :: int
+        number of bytes to read at a time
+
+    Output:
+    -------
+    blocks :: generator
+        (block, nl) tuples. Each block is a bytes object that starts at a
+        record boundary and ends on the newline of a record's fourth line, and
+        nl holds the offsets of every newline in it. Any trailing partial
+        record is yielded last, newline terminated.
+    """
+    carry = b''
+    while True:
+        chunk = handle.read(block_size)
+        if not chunk:
+            break
+        buf = carry + chunk
+        # find the end of the last complete record in this buffer
+        nl = np.flatnonzero(np.frombuffer(buf, dtype=np.uint8) == NEWLINE)
+        n_full = len(nl) // 4
+        if n_full == 0:
+            carry = buf
+            continue
+        cut = nl[4 * n_full - 1] + 1
+        carry = buf[cut:]
+        yield buf[:cut], nl[:4 * n_full]
+    if carry:
+        if not carry.endswith(b'\n'):
+            carry += b'\n'
+        yield carry, np.flatnonzero(np.frombuffer(carry, dtype=np.uint8) == NEWLINE)
+
+
+def pack_reads(block, nl, bc_len):
+    """
+    2-bit pack the barcode prefix of every record in a block.
+
+    Input:
+    ------
+    block :: bytes
+        whole fastq records (see read_blocks)
+    nl :: np.array
+        offsets of every newline in block
+    bc_len :: int
+        number of bases to keep from the start of each read
+
+    Output:
+    -------
+    packed :: np.array (uint64)
+        packed barcode of every record (0 where ok is False)
+    ok :: np.array (bool)
+        records that are at least bc_len long and only contain A, C, G, or T
+    odd :: list
+        barcodes (bytes) of the records that are not ok, in record order
+    """
+    buf = np.frombuffer(block, dtype=np.uint8)
+
+    # sequence lines are the second line of every record
+    starts = nl[0::4] + 1
+    ends = nl[1::4]
+    starts = starts[:len(ends)]
+    lens = ends - starts
+
+    packed = np.zeros(len(starts), dtype=np.uint64)
+    ok = lens >= bc_len
+    if bc_len > 0 and ok.any():
+        # grab the prefix of every read as an (n_reads, bc_len) matrix - a row
+        # gather on a sliding window view copies each prefix in one go
+        prefixes = np.lib.stride_tricks.sliding_window_view(buf, bc_len)[starts[ok]]
+        codes = ENCODE[prefixes]
+        good = (codes < 4).all(axis=1)
+        ok[ok] = good
+        codes = codes[good]
+
+        # left pad with A's to 32 bases (doesn't change the value), squeeze
+        # four bases into each byte and read every row back as one big-endian
+        # uint64
+        codes = np.pad(codes, ((0, 0), (MAX_BC_LEN - bc_len, 0)))
+        packed_bytes = (codes[:, 0::4] << 6) | (codes[:, 1::4] << 4) | (codes[:, 2::4] << 2) | codes[:, 3::4]
+        packed[ok] = np.ascontiguousarray(packed_bytes).view('>u8').ravel()
+
+    odd = [block[s:s + min(l, bc_len)] for s, l in zip(starts[~ok], lens[~ok])]
+
+    return packed, ok, odd
+
+
+def pack_block(block, nl, bc_len):
+    """
+    Pull out the barcode prefix of every record in a block.
+
+    Input:
+    ------
+    see pack_reads
+
+    Output:
+    -------
+    packed :: np.array (uint64)
+        2-bit packed barcodes for every read that is at least bc_len long and
+        only contains A, C, G, or T
+    odd :: list
+        barcodes (bytes) of the reads that did not fit the fast path
+    """
+    packed, ok, odd = pack_reads(block, nl, bc_len)
+    return packed[ok], odd
+
+
+def unpack(packed, bc_len):
+    """
+    Convert 2-bit packed barcodes back to strings.
+
+    Input:
+    ------
+    packed :: np.array (uint64)
+        packed barcodes
+    bc_len :: int
+        number of bases in each barcode
+
+    Output:
+    -------
+    bcs :: list
+        barcode strings in the same order as packed
+    """
+    if bc_len == 0:
+        return [''] * len(packed)
+    shifts = np.arange(2 * (bc_len - 1), -1, -2, dtype=np.uint64)
+    codes = (packed[:, None] >> shifts) & np.uint64(3)
+    letters = DECODE[codes.astype(np.intp)]
+    raw = letters.tobytes().decode('ascii')
+    return [raw[i:i + bc_len] for i in range(0, len(raw), bc_len)]
+
+
+def merge_counts(keys, counts):
+    """
+    Sum counts over duplicated keys.
+
+    Input:
+    ------
+    keys :: np.array (uint64)
+    counts :: np.array (int64)
+
+    Output:
+    -------
+    (keys, counts) :: tuple of np.array
+        unique keys and their summed counts
+    """
+    uniq, inv = np.unique(keys, return_inverse=True)
+    return uniq, np.bincount(inv.ravel(), weights=counts, minlength=len(uniq)).astype(np.int64)
+
+
+def count_barcodes(fnames, bc_len, block_size=BLOCK_SIZE):
+    """
+    Count the barcode prefix of every read across one or more fastqs.
+
+    Input:
+    ------
+    fnames :: list
+        fastq(.gz) paths ('-' for stdin)
+    bc_len :: int
+        number of bases to keep from the start of each read
+    block_size :: int
+        number of decompressed bytes to process at a time
+
+    Output:
+    -------
+    counts :: dict
+        {barcode: count}
+    """
+    if bc_len > MAX_BC_LEN:
+        raise ValueError(f'Barcodes longer than {MAX_BC_LEN} can not be packed (got {bc_len})')
+
+    keys = []
+    counts = []
+    odd = Counter()
+    for fname in fnames:
+        handle = open_fastq(fname)
+        # with metrics on, time decompression apart from counting
+        reader = metrics.TimedReader(handle) if metrics.enabled() else handle
+        wall, cpu = time.perf_counter(), time.process_time()
+        n_reads = 0
+        try:
+            for block, nl in read_blocks(reader, block_size):
+                packed, block_odd = pack_block(block, nl, bc_len)
+                uniq, n = np.unique(packed, return_counts=True)
+                keys.append(uniq)
+                counts.append(n.astype(np.int64))
+                odd.update(block_odd)
+                n_reads += len(packed) + len(block_odd)
+        finally:
+            if handle is not sys.stdin.buffer:
+                handle.close()
+        if metrics.enabled():
+            wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+            name = os.path.basename(fname)
+            metrics.record('decompress', reader.wall, reader.cpu, reader.bytes, 'bytes', name)
+            metrics.record('count', wall - reader.wall, cpu - reader.cpu, n_reads, 'reads', name)
+
+    res = {}
+    if keys:
+        uniq, n = merge_counts(np.concatenate(keys), np.concatenate(counts))
+        res = dict(zip(unpack(uniq, bc_len), n.tolist()))
+    for bc, n in odd.items():
+        bc = bc.decode('ascii', errors='replace')
+        res[bc] = res.get(bc, 0) + n
+    return res
+
+
+def write_counts(counts, out):
+    """
+    Write a {barcode: count} dict as space separated "barcode count" lines.
+    """
+    out.write(''.join(f'{bc} {n}\n' for bc, n in counts.items()))
+
+
+#===============================================================================
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Count the first bc_len bases of every read in one or more fastqs')
+    parser.add_argument('fastqs',
+                        type=str,
+                        nargs='*',
+                        default=['-'],
+                        help='path to (gzipped) fastqs (or stdin if none)')
+    parser.add_argument('-l',
+                        '--bc-len',
+                        dest='bc_len',
+                        type=int,
+                        required=True,
+                        help='number of bases to count from the start of each read')
+    parser.add_argument('-b',
+                        '--block-size',
+                        dest='block_size',
+                        type=int,
+                        default=BLOCK_SIZE,
+                        help='bytes of decompressed fastq to process at a time')
+    args = parser.parse_args()
+
+    print('Barcode length:', args.bc_len, file=sys.stderr)
+    counts = count_barcodes(args.fastqs, args.bc_len, args.block_size)
+    write_counts(counts, sys.stdout)
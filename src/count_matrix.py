@@ -0,0 +1,308 @@
+#!/usr/bin/env python3
+"""
+count_matrix.py - compact, memory-mapped samples x barcodes count store per run
+
+starcode.csv (and correct.csv) repeat the Sample_ID and Centroid of a cluster
+on every member line, so answering "S2 counts for Plate3" means parsing the
+whole file. This packs a run into a folder:
+
+    counts.npy     samples x barcodes uint32 matrix of cluster counts
+    samples.csv    row,Sample_ID,Plate_ID,Sample_Well
+    targets.csv    col,sequence,target,amplicon
+
+Columns are the distinct sequences of the barcode map plus a last 'other'
+column holding every cluster whose centroid is not in the map. Rows are the
+wells of the conditions, sorted by plate (in conditions order) and then well,
+so a plate is a contiguous block of rows. The Sample_ID of every row is
+Plate_ID-Sample_Well, as platemap2samp.py makes it.
+
+CountMatrix opens the store without pandas (only building a store imports
+it) and memory maps counts.npy, so plate and target slices are views into the
+file rather than copies.
+"""
+
+import os
+import re
+import csv
+import sys
+import shutil
+import argparse
+from pathlib import Path
+
+import numpy as np
+
+COUNTS = 'counts.npy'
+SAMPLES = 'samples.csv'
+TARGETS = 'targets.csv'
+
+# column for clusters that aren't in the barcode map
+OTHER = 'other'
+
+# rows of counts csv to parse at a time
+CHUNK_SIZE = 1 << 20
+
+#===============================================================================
+
+def well_key(well):
+    "Sort key of a well name (A01 < A02 < ... < B01, also for A1 or AA01)"
+    match = re.fullmatch(r'([A-Za-z]+)0*(\d+)', str(well))
+    if match is None:
+        return (1, str(well), 0)
+    letters, col = match.groups()
+    return (0, len(letters), letters.upper(), int(col))
+
+
+def sample_table(conds):
+    """
+    One row per well of the conditions, sorted by plate then well.
+
+    Input:
+    ------
+    conds :: pd.DataFrame
+        conditions.csv (needs Plate_ID and Sample_Well)
+
+    Output:
+    -------
+    samples :: pd.DataFrame
+        Sample_ID, Plate_ID, Sample_Well
+    """
+    import pandas as pd
+    df = conds[['Plate_ID', 'Sample_Well']].astype(str).drop_duplicates()
+    plate_order = {x: i for i, x in enumerate(pd.unique(df['Plate_ID']))}
+    order = sorted(range(len(df)), key=lambda i: (plate_order[df['Plate_ID'].iat[i]], well_key(df['Sample_Well'].iat[i])))
+    df = df.iloc[order].reset_index(drop=True)
+    df.insert(0, 'Sample_ID', df['Plate_ID'] + '-' + df['Sample_Well'])
+    return df
+
+
+def target_table(bc_map):
+    """
+    One column per distinct barcode map sequence (first target/amplicon
+    wins), plus the 'other' column.
+
+    Output:
+    -------
+    targets :: pd.DataFrame
+        sequence, target, amplicon
+    """
+    import pandas as pd
+    df = bc_map[['sequence', 'target', 'amplicon']].drop_duplicates('sequence').reset_index(drop=True)
+    return pd.concat([df, pd.DataFrame({'sequence': [OTHER], 'target': [OTHER], 'amplicon': [OTHER]})], ignore_index=True)
+
+
+def read_clusters(fname, chunk_size=CHUNK_SIZE):
+    """
+    Stream the (Sample_ID, Centroid, Count) of every cluster in a tidy
+    starcode/correct csv, once per cluster rather than once per member.
+
+    Output:
+    -------
+    chunks :: generator
+        pd.DataFrame chunks
+    """
+    import pandas as pd
+    last = (None, None)
+    for chunk in pd.read_csv(fname, usecols=['Sample_ID', 'Centroid', 'Count'], dtype={'Sample_ID': str, 'Centroid': str}, chunksize=chunk_size):
+        # a cluster's members are consecutive lines, so keep the first line of
+        # every run of (Sample_ID, Centroid), including across chunks
+        sample = chunk['Sample_ID'].to_numpy()
+        centroid = chunk['Centroid'].to_numpy()
+        prev_sample = np.concatenate([[last[0]], sample[:-1]])
+        prev_centroid = np.concatenate([[last[1]], centroid[:-1]])
+        first = (sample != prev_sample) | (centroid != prev_centroid)
+        if len(chunk):
+            last = (sample[-1], centroid[-1])
+        if first.any():
+            yield chunk[first]
+
+
+def build(counts_file, conds_file, bc_map_file, out_dir, chunk_size=CHUNK_SIZE):
+    """
+    Write a run's count store (see the module docstring).
+
+    Input:
+    ------
+    counts_file :: str
+        starcode.csv / correct.csv (Sample_ID,Centroid,Count,barcode)
+    conds_file :: str
+        conditions.csv
+    bc_map_file :: str
+        bc-map.csv
+    out_dir :: str
+        store folder (replaced if it exists)
+
+    Output:
+    -------
+    n_dropped :: int
+        clusters of samples that are not in the conditions
+    """
+    import pandas as pd
+    samples = sample_table(pd.read_csv(conds_file))
+    targets = target_table(pd.read_csv(bc_map_file))
+    row_of = pd.Series(np.arange(len(samples)), index=samples['Sample_ID'])
+    col_of = pd.Series(np.arange(len(targets) - 1), index=targets['sequence'].iloc[:-1])
+
+    counts = np.zeros((len(samples), len(targets)), dtype=np.uint64)
+    n_dropped = 0
+    for chunk in read_clusters(counts_file, chunk_size):
+        rows = row_of.reindex(chunk['Sample_ID']).to_numpy()
+        cols = col_of.reindex(chunk['Centroid']).fillna(len(targets) - 1).to_numpy()
+        keep = ~np.isnan(rows)
+        n_dropped += int((~keep).sum())
+        np.add.at(counts, (rows[keep].astype(np.intp), cols[keep].astype(np.intp)), chunk['Count'].to_numpy()[keep].astype(np.uint64))
+    if counts.max(initial=0) > np.iinfo(np.uint32).max:
+        raise ValueError(f'Counts in {counts_file} overflow uint32')
+
+    # write next to the store and swap it in, so readers never see half a store
+    out_dir = Path(out_dir)
+    tmp_dir = out_dir.with_name(out_dir.name + '.tmp')
+    if tmp_dir.exists():
+        shutil.rmtree(tmp_dir)
+    tmp_dir.mkdir(parents=True)
+    out = np.lib.format.open_memmap(tmp_dir / COUNTS, mode='w+', dtype=np.uint32, shape=counts.shape)
+    out[:] = counts
+    out.flush()
+    del out
+    samples.to_csv(tmp_dir / SAMPLES, index_label='row')
+    targets.to_csv(tmp_dir / TARGETS, index_label='col')
+    if out_dir.exists():
+        shutil.rmtree(out_dir)
+    os.replace(tmp_dir, out_dir)
+    return n_dropped
+
+
+class CountMatrix:
+    """
+    Read-only view of a count store.
+
+    Input:
+    ------
+    path :: str
+        store folder (see build)
+
+    Attributes:
+    -----------
+    counts :: np.memmap
+        samples x barcodes uint32
+    sample_ids, plate_ids, wells :: list
+        labels of every row
+    sequences, targets, amplicons :: list
+        labels of every column
+    """
+
+    def __init__(self, path):
+        path = Path(path)
+        self.counts = np.load(path / COUNTS, mmap_mode='r')
+        with open(path / SAMPLES, newline='') as fh:
+            rows = list(csv.DictReader(fh))
+        self.sample_ids = [x['Sample_ID'] for x in rows]
+        self.plate_ids = [x['Plate_ID'] for x in rows]
+        self.wells = [x['Sample_Well'] for x in rows]
+        with open(path / TARGETS, newline='') as fh:
+            cols = list(csv.DictReader(fh))
+        self.sequences = [x['sequence'] for x in cols]
+        self.targets = [x['target'] for x in cols]
+        self.amplicons = [x['amplicon'] for x in cols]
+
+        self._sample_rows = {x: i for i, x in enumerate(self.sample_ids)}
+        self._wells = np.array(self.wells, dtype=object)
+        # plates are contiguous blocks of rows
+        self._plates = {}
+        for i, plate in enumerate(self.plate_ids):
+            start, _ = self._plates.get(plate, (i, i))
+            self._plates[plate] = (start, i + 1)
+
+    @property
+    def plates(self):
+        return list(self._plates)
+
+    def rows(self, plate=None, well=None, sample_id=None):
+        """
+        Rows of a plate (a slice), a well (on every plate, or one plate),
+        or a Sample_ID. Everything if nothing is given.
+        """
+        if sample_id is not None:
+            if sample_id not in self._sample_rows:
+                raise KeyError(f'Sample_ID {sample_id} is not in the store')
+            return self._sample_rows[sample_id]
+        if plate is None:
+            rows = slice(None)
+        elif plate in self._plates:
+            rows = slice(*self._plates[plate])
+        else:
+            raise KeyError(f'Plate {plate} is not in the store. Options: {", ".join(self._plates)}')
+        if well is not None:
+            idx = np.arange(len(self.sample_ids))[rows]
+            hits = idx[self._wells[rows] == well]
+            if len(hits) == 0:
+                raise KeyError(f'Well {well} is not in the store')
+            rows = int(hits[0]) if plate is not None else hits
+        return rows
+
+    def cols(self, target=None):
+        """
+        Column(s) of a barcode sequence, amplicon, or target (in that order
+        of precedence). An int where the name is a single column, else a list.
+        Everything if nothing is given.
+        """
+        if target is None:
+            return slice(None)
+        for labels in [self.sequences, self.amplicons, self.targets]:
+            hits = [i for i, x in enumerate(labels) if x == target]
+            if len(hits) == 1:
+                return hits[0]
+            if hits:
+                return hits
+        raise KeyError(f'{target} is not a sequence, amplicon, or target in the store')
+
+    def get(self, plate=None, well=None, target=None, sample_id=None):
+        """
+        Counts of the matching rows and columns - a view of the memory
+        mapped file for plates/Sample_IDs and single columns (a target with
+        several barcodes is summed over them).
+
+        Examples:
+        ---------
+        m.get(plate='Plate3', target='S2')  # S2 count of every Plate3 well
+        m.get(well='A01')                   # every barcode of A01 on every plate
+        """
+        rows = self.rows(plate, well, sample_id)
+        cols = self.cols(target)
+        if isinstance(cols, list):
+            return self.counts[rows][..., cols].sum(axis=-1)
+        return self.counts[rows, cols]
+
+    def labels(self, plate=None, well=None, sample_id=None):
+        "Sample_IDs of the rows returned by get"
+        rows = self.rows(plate, well, sample_id)
+        ids = np.array(self.sample_ids, dtype=object)[rows]
+        return ids.tolist() if isinstance(ids, np.ndarray) else ids
+
+
+#===============================================================================
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Pack a run\'s counts into a memory-mapped samples x barcodes matrix')
+    parser.add_argument('counts',
+                        type=str,
+                        help='starcode.csv / correct.csv (Sample_ID,Centroid,Count,barcode)')
+    parser.add_argument('conditions',
+                        type=str,
+                        help='the run\'s conditions.csv')
+    parser.add_argument('bc_map',
+                        type=str,
+                        help='path to bc-map.csv')
+    parser.add_argument('-o',
+                        '--out-dir',
+                        dest='out_dir',
+                        type=str,
+                        help='store folder (default = <counts>.matrix/ next to the counts)')
+    args = parser.parse_args()
+
+    out_dir = args.out_dir or str(Path(args.counts).with_suffix('.matrix'))
+    n_dropped = build(args.counts, args.conditions, args.bc_map, out_dir)
+    m = CountMatrix(out_dir)
+    print(f'{len(m.sample_ids)} samples x {len(m.sequences)} barcodes written to {out_dir}', file=sys.stderr)
+    if n_dropped:
+        print(f'Dropped {n_dropped} clusters of samples not in {args.conditions}', file=sys.stderr)
@@ -0,0 +1,470 @@
+#!/usr/bin/env python3
+"""
+demux.py - demultiplex and count barcodes straight from Undetermined fastqs
+
+Rather than letting bcl2fastq write one fastq per Sample_ID (and then
+decompressing each of them separately), read the R1/I1/I2 fastqs of an
+Undetermined run once. Every index read is looked up in a precomputed
+mismatch-tolerant table of the SampleSheet's index/index2 sequences, and the
+barcode of every read is counted against its sample in the same pass. Reads
+whose index/index2 combination is not in the SampleSheet are tallied as well,
+which measures index hopping at no extra I/O cost.
+
+Run bcl2fastq with --create-fastq-for-index-reads and an empty SampleSheet (or
+none at all) so every read ends up in Undetermined_S0_*.
+"""
+
+import re
+import sys
+import csv
+import argparse
+import itertools
+from pathlib import Path
+from collections import Counter, defaultdict
+from signal import signal, SIGPIPE, SIG_DFL
+
+import numpy as np
+import pandas as pd
+
+import count_bcs as cb
+
+# catch broken pipe errors to allow ex) python pyParse.py foo bar | head
+# see: https://stackoverflow.com/a/30091579
+signal(SIGPIPE, SIG_DFL)
+
+# same default as bcl2fastq --barcode-mismatches
+MISMATCHES = 1
+
+# index reads are packed 3 bits per base so N's survive (as a mismatch)
+INDEX_BASES = b'ACGTN'
+INDEX_ENCODE = np.full(256, 4, dtype=np.uint64)
+for i, b in enumerate(INDEX_BASES):
+    INDEX_ENCODE[b] = i
+MAX_INDEX_LEN = 21
+
+#===============================================================================
+
+def read_samplesheet(fname):
+    """
+    Pull the [Data] section out of an Illumina SampleSheet.
+
+    Input:
+    ------
+    fname :: str
+        path to SampleSheet.csv (see platemap2samp.py)
+
+    Output:
+    -------
+    df :: pd.DataFrame
+        one row per index/index2 pair
+    """
+    with open(fname, newline='', encoding='utf-8-sig') as fh:
+        lines = fh.read().splitlines()
+    try:
+        start = next(i for i, x in enumerate(lines) if x.startswith('[Data]')) + 1
+    except StopIteration:
+        raise ValueError(f'No [Data] section in {fname}')
+    rows = list(csv.reader(x for x in lines[start:] if x.strip(',')))
+    df = pd.DataFrame(rows[1:], columns=rows[0])
+    for col in ['Sample_ID', 'index', 'index2']:
+        if col not in df:
+            raise ValueError(f'A column named "{col}" must be present in the [Data] section of {fname}')
+    return df
+
+
+def well_ids(df):
+    """
+    Name every SampleSheet row after its well (Plate_ID-Sample_Well) as
+    collapseSampleSheet.R does, falling back to the Sample_ID.
+    """
+    if 'Plate_ID' in df and 'Sample_Well' in df:
+        return (df['Plate_ID'] + '-' + df['Sample_Well']).tolist()
+    return df['Sample_ID'].tolist()
+
+
+def pack_index(seq):
+    "3-bit pack a single index sequence"
+    res = 0
+    for b in seq.encode('ascii'):
+        res = (res << 3) | int(INDEX_ENCODE[b])
+    return res
+
+
+def mismatch_neighbors(seq, mismatches):
+    """
+    Every sequence within `mismatches` substitutions (including N's) of seq.
+
+    Input:
+    ------
+    seq :: str
+    mismatches :: int
+
+    Output:
+    -------
+    dists :: dict
+        {sequence: number of mismatches}
+    """
+    dists = {seq: 0}
+    for d in range(1, mismatches + 1):
+        for pos in itertools.combinations(range(len(seq)), d):
+            for subs in itertools.product(INDEX_BASES.decode(), repeat=d):
+                if any(seq[p] == b for p, b in zip(pos, subs)):
+                    continue
+                x = list(seq)
+                for p, b in zip(pos, subs):
+                    x[p] = b
+                dists.setdefault(''.join(x), d)
+    return dists
+
+
+def build_index_table(indices, mismatches=MISMATCHES):
+    """
+    Build a lookup table from any observed index read to an expected index.
+
+    Input:
+    ------
+    indices :: list
+        unique expected index sequences (all the same length)
+    mismatches :: int
+        number of tolerated mismatches
+
+    Output:
+    -------
+    keys :: np.array (uint64)
+        sorted, 3-bit packed observed sequences
+    ids :: np.array (int64)
+        position in `indices` of the expected index for each key
+    collisions :: dict
+        {observed: [expected, ...]} for observed sequences that sit within
+        `mismatches` of more than one index and can't be assigned
+    """
+    lens = set(len(x) for x in indices)
+    if len(lens) > 1:
+        raise ValueError(f'Indices must all be the same length. Observed lengths: {lens}')
+    if lens and lens.pop() > MAX_INDEX_LEN:
+        raise ValueError(f'Indices longer than {MAX_INDEX_LEN} are not supported')
+
+    hits = defaultdict(dict)
+    for i, idx in enumerate(indices):
+        for seq, d in mismatch_neighbors(idx, mismatches).items():
+            hits[seq][i] = d
+
+    table = {}
+    collisions = {}
+    for seq, cands in hits.items():
+        best = min(cands.values())
+        closest = [i for i, d in cands.items() if d == best]
+        if len(closest) == 1:
+            table[pack_index(seq)] = closest[0]
+        else:
+            collisions[seq] = [indices[i] for i in closest]
+
+    keys = np.fromiter(table.keys(), dtype=np.uint64, count=len(table))
+    ids = np.fromiter(table.values(), dtype=np.int64, count=len(table))
+    order = np.argsort(keys)
+    return keys[order], ids[order], collisions
+
+
+def lookup(packed, keys, ids):
+    """
+    Vectorized dictionary lookup of packed sequences (-1 when missing).
+    """
+    if len(keys) == 0:
+        return np.full(len(packed), -1, dtype=np.int64)
+    pos = np.searchsorted(keys, packed)
+    pos[pos == len(keys)] = 0
+    return np.where(keys[pos] == packed, ids[pos], -1)
+
+
+def pack_index_reads(block, nl, length):
+    """
+    3-bit pack the first `length` bases of every index read in a block.
+
+    Reads shorter than `length` are padded with N's.
+    """
+    buf = np.frombuffer(block, dtype=np.uint8)
+    starts = nl[0::4] + 1
+    ends = nl[1::4]
+    starts = starts[:len(ends)]
+    lens = ends - starts
+    packed = np.zeros(len(starts), dtype=np.uint64)
+    for j in range(length):
+        col = np.where(lens > j, INDEX_ENCODE[buf[np.minimum(starts + j, len(buf) - 1)]], np.uint64(4))
+        packed = (packed << np.uint64(3)) | col.astype(np.uint64)
+    return packed
+
+
+def pack_barcode_reads(block, nl, bc_len):
+    """
+    Like count_bcs.pack_reads, but keep the raw barcode of every read that
+    misses the fast path in a per-read object array so the output can be
+    re-chunked alongside the index reads.
+    """
+    packed, ok, odd = cb.pack_reads(block, nl, bc_len)
+    raw = np.empty(len(packed), dtype=object)
+    raw[~ok] = odd
+    return packed, ok, raw
+
+
+def unpack_index(packed, length):
+    "Convert 3-bit packed index reads back to strings"
+    res = []
+    for x in packed.tolist():
+        res.append(''.join(INDEX_BASES.decode()[(x >> (3 * (length - j - 1))) & 7] for j in range(length)))
+    return res
+
+
+def stream(fname, parse, block_size):
+    "Yield parse(block, nl) for every block of records in fname"
+    handle = cb.open_fastq(fname)
+    try:
+        for block, nl in cb.read_blocks(handle, block_size):
+            yield parse(block, nl)
+    finally:
+        handle.close()
+
+
+def take(item, n):
+    "Split a tuple of parallel arrays/lists at n"
+    return tuple(x[:n] for x in item), tuple(x[n:] for x in item)
+
+
+def zip_records(*streams):
+    """
+    Re-chunk several record streams so each yielded chunk covers the same
+    reads in every stream (fastq blocks rarely hold the same number of reads).
+
+    Every stream item must be a tuple of arrays/lists with one entry per read.
+    """
+    iters = [iter(x) for x in streams]
+    pending = [None] * len(iters)
+    while True:
+        for i, it in enumerate(iters):
+            while pending[i] is None or len(pending[i][0]) == 0:
+                pending[i] = next(it, None)
+                if pending[i] is None:
+                    break
+        done = [x is None for x in pending]
+        if all(done):
+            return
+        if any(done):
+            raise ValueError('Read and index fastqs have a different number of records!')
+        n = min(len(x[0]) for x in pending)
+        chunk = []
+        for i, x in enumerate(pending):
+            head, pending[i] = take(x, n)
+            chunk.append(head)
+        yield chunk
+
+
+def demux(r1s, i1s, i2s, samples, bc_len, mismatches=MISMATCHES, block_size=cb.BLOCK_SIZE):
+    """
+    Count barcodes per sample and tally unexpected index pairs in one pass.
+
+    Input:
+    ------
+    r1s, i1s, i2s :: list
+        matched lists of read 1, index 1 (i7), and index 2 (i5) fastqs
+    samples :: pd.DataFrame
+        SampleSheet [Data] section (see read_samplesheet)
+    bc_len :: int
+        number of read 1 bases to count
+    mismatches :: int
+        mismatches tolerated in each index read
+    block_size :: int
+        number of decompressed bytes to process at a time
+
+    Output:
+    -------
+    counts :: pd.DataFrame
+        Sample_ID, barcode, Count
+    undetermined :: pd.DataFrame
+        index, index2, Count, index_match, index2_match, category for every
+        index/index2 pair that did not match a sample. category is "hop" when
+        both indices match the SampleSheet but the pair does not.
+    collisions :: dict
+        index reads that could not be assigned (see build_index_table)
+    """
+    names = well_ids(samples)
+    sample_names = list(dict.fromkeys(names))
+    i7s = list(dict.fromkeys(samples['index']))
+    i5s = list(dict.fromkeys(samples['index2']))
+    i7_len = len(i7s[0])
+    i5_len = len(i5s[0])
+
+    i7_keys, i7_ids, i7_coll = build_index_table(i7s, mismatches)
+    i5_keys, i5_ids, i5_coll = build_index_table(i5s, mismatches)
+    collisions = {**i7_coll, **i5_coll}
+
+    # (i7, i5) -> sample, with an extra row/column for reads that match nothing
+    pairs = np.full((len(i7s) + 1, len(i5s) + 1), -1, dtype=np.int64)
+    name_ids = {x: i for i, x in enumerate(sample_names)}
+    for i7, i5, name in zip(samples['index'], samples['index2'], names):
+        if pairs[i7s.index(i7), i5s.index(i5)] not in (-1, name_ids[name]):
+            raise ValueError(f'index/index2 pair {i7}/{i5} is assigned to more than one well')
+        pairs[i7s.index(i7), i5s.index(i5)] = name_ids[name]
+
+    count_parts = []
+    odd = Counter()
+    undet_parts = []
+
+    for r1_files in zip(r1s, i1s, i2s):
+        r1, i1, i2 = r1_files
+        chunks = zip_records(
+            stream(r1, lambda b, nl: pack_barcode_reads(b, nl, bc_len), block_size),
+            stream(i1, lambda b, nl: (pack_index_reads(b, nl, i7_len),), block_size),
+            stream(i2, lambda b, nl: (pack_index_reads(b, nl, i5_len),), block_size))
+        for (bcs, ok, raw), (i7_packed,), (i5_packed,) in chunks:
+            i7_id = lookup(i7_packed, i7_keys, i7_ids)
+            i5_id = lookup(i5_packed, i5_keys, i5_ids)
+            sample = pairs[i7_id, i5_id]
+            hit = sample >= 0
+
+            # barcodes of the assigned reads
+            good = hit & ok
+            if good.any():
+                ubc, inv = np.unique(bcs[good], return_inverse=True)
+                key = sample[good] * len(ubc) + inv.ravel()
+                ukey, n = np.unique(key, return_counts=True)
+                count_parts.append((ukey // len(ubc), ubc[ukey % len(ubc)], n))
+            bad = hit[~ok]
+            if bad.any():
+                odd.update(zip(sample[~ok][bad].tolist(), raw[~ok][bad]))
+
+            # tally everything that didn't land in a well, keyed on the
+            # (i7, i5) pair - both packed indices together can need more
+            # than 64 bits
+            if (~hit).any():
+                pair = np.stack([i7_packed[~hit], i5_packed[~hit]], axis=1)
+                upair, idx, n = np.unique(pair, axis=0, return_index=True, return_counts=True)
+                undet_parts.append((upair, i7_id[~hit][idx], i5_id[~hit][idx], n))
+
+    # merge the per chunk counts
+    if count_parts:
+        s, b, n = (np.concatenate(x) for x in zip(*count_parts))
+        ubc, inv = np.unique(b, return_inverse=True)
+        key = s * len(ubc) + inv.ravel()
+        ukey, kinv = np.unique(key, return_inverse=True)
+        n = np.bincount(kinv.ravel(), weights=n).astype(np.int64)
+        counts = pd.DataFrame({
+            'Sample_ID': np.array(sample_names, dtype=object)[ukey // len(ubc)],
+            'barcode': cb.unpack(ubc[ukey % len(ubc)], bc_len),
+            'Count': n})
+    else:
+        counts = pd.DataFrame({'Sample_ID': [], 'barcode': [], 'Count': []})
+    if odd:
+        counts = pd.concat([counts, pd.DataFrame(
+            [(sample_names[s], bc.decode('ascii', errors='replace'), n) for (s, bc), n in odd.items()],
+            columns=['Sample_ID', 'barcode', 'Count'])])
+        counts = counts.groupby(['Sample_ID', 'barcode'], sort=False, as_index=False)['Count'].sum()
+    counts = counts.sort_values(['Sample_ID', 'Count'], ascending=[True, False]).reset_index(drop=True)
+
+    if undet_parts:
+        p, i7_id, i5_id, n = (np.concatenate(x) for x in zip(*undet_parts))
+        upair, idx, kinv = np.unique(p, axis=0, return_index=True, return_inverse=True)
+        n = np.bincount(kinv.ravel(), weights=n).astype(np.int64)
+        i7_id, i5_id = i7_id[idx], i5_id[idx]
+        i7_arr = np.array(i7s + [''], dtype=object)
+        i5_arr = np.array(i5s + [''], dtype=object)
+        category = np.select(
+            [(i7_id >= 0) & (i5_id >= 0), i7_id >= 0, i5_id >= 0],
+            ['hop', 'index_only', 'index2_only'], 'none')
+        undetermined = pd.DataFrame({
+            'index': unpack_index(upair[:, 0], i7_len),
+            'index2': unpack_index(upair[:, 1], i5_len),
+            'Count': n,
+            'index_match': i7_arr[i7_id],
+            'index2_match': i5_arr[i5_id],
+            'category': category})
+        undetermined = undetermined.sort_values('Count', ascending=False).reset_index(drop=True)
+    else:
+        undetermined = pd.DataFrame(columns=['index', 'index2', 'Count', 'index_match', 'index2_match', 'category'])
+
+    return counts, undetermined, collisions
+
+
+def find_undetermined(fq_dir):
+    """
+    Find matched R1/I1/I2 Undetermined fastqs (one set per lane) in a folder.
+    """
+    r1s = sorted(Path(fq_dir).glob('Undetermined_S0_*R1_001.fastq*'))
+    i1s = [x.with_name(re.sub(r'_R1_001', '_I1_001', x.name)) for x in r1s]
+    i2s = [x.with_name(re.sub(r'_R1_001', '_I2_001', x.name)) for x in r1s]
+    missing = [str(x) for x in i1s + i2s if not x.exists()]
+    if len(r1s) == 0:
+        raise ValueError(f'No Undetermined_S0_*R1_001.fastq* files in {fq_dir}')
+    if missing:
+        raise ValueError('Missing index fastqs (run bcl2fastq with --create-fastq-for-index-reads):\n{}'.format('\n'.join(missing)))
+    return [str(x) for x in r1s], [str(x) for x in i1s], [str(x) for x in i2s]
+
+
+#===============================================================================
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Demultiplex Undetermined fastqs and count barcodes per sample in a single pass')
+    parser.add_argument('samplesheet',
+                        type=str,
+                        help='path to SampleSheet.csv')
+    parser.add_argument('fq_dir',
+                        type=str,
+                        nargs='?',
+                        help='folder of Undetermined_S0_*_{R1,I1,I2}_001.fastq.gz files')
+    parser.add_argument('--r1',
+                        nargs='+',
+                        default=[],
+                        help='read 1 fastqs (instead of fq_dir)')
+    parser.add_argument('--i1',
+                        nargs='+',
+                        default=[],
+                        help='index 1 (i7) fastqs, matched to --r1')
+    parser.add_argument('--i2',
+                        nargs='+',
+                        default=[],
+                        help='index 2 (i5) fastqs, matched to --r1')
+    parser.add_argument('-l',
+                        '--bc-len',
+                        dest='bc_len',
+                        type=int,
+                        required=True,
+                        help='number of bases to count from the start of each read')
+    parser.add_argument('-m',
+                        '--mismatches',
+                        dest='mismatches',
+                        type=int,
+                        default=MISMATCHES,
+                        help='mismatches allowed in each index read (default = 1)')
+    parser.add_argument('-o',
+                        '--out-dir',
+                        dest='out_dir',
+                        type=str,
+                        default='.',
+                        help='where to write counts.csv and undetermined.csv (default = current directory)')
+    args = parser.parse_args()
+
+    if args.fq_dir:
+        r1s, i1s, i2s = find_undetermined(args.fq_dir)
+    else:
+        r1s, i1s, i2s = args.r1, args.i1, args.i2
+    if not r1s or not len(r1s) == len(i1s) == len(i2s):
+        raise ValueError('Need a fastq folder or matched --r1/--i1/--i2 fastqs')
+
+    samples = read_samplesheet(args.samplesheet)
+    counts, undetermined, collisions = demux(r1s, i1s, i2s, samples, args.bc_len, args.mismatches)
+
+    for seq, idx in collisions.items():
+        print(f'Index read {seq} is within {args.mismatches} mismatch(es) of {", ".join(idx)} and will not be assigned', file=sys.stderr)
+
+    out_dir = Path(args.out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    counts.to_csv(out_dir / 'counts.csv', index=False)
+    undetermined.to_csv(out_dir / 'undetermined.csv', index=False)
+
+    # quick summary
+    n_hit = counts['Count'].sum()
+    n_undet = undetermined['Count'].sum()
+    n_hop = undetermined.loc[undetermined['category'] == 'hop', 'Count'].sum()
+    total = max(n_hit + n_undet, 1)
+    print(f'Reads: {n_hit + n_undet}\tAssigned: {n_hit} ({n_hit / total:.2%})\t' +
+          f'Undetermined: {n_undet} ({n_undet / total:.2%})\tIndex hopping: {n_hop} ({n_hop / total:.2%})',
+          file=sys.stderr)
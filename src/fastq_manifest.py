@@ -0,0 +1,212 @@
+#!/usr/bin/env python3
+"""
+fastq_manifest.py - one-pass inventory of a run's fastqs
+
+bcl2fastq names every fastq <Sample>_S<n>_L<lane>_<read>_<chunk>.fastq.gz (no
+_L<lane> with --no-lane-splitting). Globbing "<Sample_ID>*_S*_R1_001.fastq.gz"
+once per sample lists the folder once per sample - minutes for 10k samples on
+network storage - and the prefix glob also picks up Plate1-A10 for Plate1-A1.
+A manifest lists the folder once, parses every name, and keeps each file's
+size, so finding a sample's fastqs is a dict lookup:
+
+    {"version": 1, "folder": <abs path when written>,
+     "files": [{"file", "sample", "S", "lane", "read", "chunk", "size",
+                "mtime_ns"}, ...]}
+
+A sample's fastqs are the ones named after its Sample_ID, or after its
+Sample_ID plus a "-<suffix>" (the rows platemap2samp.py expands a well with
+several i5/i7 pairs into). link-data.py writes a manifest into the folder of
+links it makes, and load() reuses it as long as the folder still holds the
+same fastqs.
+"""
+
+import os
+import re
+import sys
+import json
+import argparse
+from collections import defaultdict
+from pathlib import Path
+
+MANIFEST = 'fastq-manifest.json'
+
+# bump whenever the manifest layout changes
+MANIFEST_VERSION = 1
+
+FASTQ_RE = re.compile(r'(?P<sample>.+)_S(?P<S>\d+)(?:_L(?P<lane>\d+))?_(?P<read>[RI]\d)_(?P<chunk>\d+)\.fastq(?:\.gz)?')
+
+#===============================================================================
+
+def parse_name(name):
+    """
+    Split a bcl2fastq fastq name into its parts.
+
+    Input:
+    ------
+    name :: str
+        e.g. Plate1-A01_S1_L001_R1_001.fastq.gz
+
+    Output:
+    -------
+    parts :: dict
+        {'file', 'sample', 'S', 'lane', 'read', 'chunk'} (lane is None without
+        lane splitting), or None if name isn't a bcl2fastq fastq
+    """
+    match = FASTQ_RE.fullmatch(name)
+    if match is None:
+        return None
+    lane = match['lane']
+    return {
+        'file': name,
+        'sample': match['sample'],
+        'S': int(match['S']),
+        'lane': None if lane is None else int(lane),
+        'read': match['read'],
+        'chunk': int(match['chunk']),
+    }
+
+
+def scan_folder(folder):
+    """
+    List the bcl2fastq fastqs of a folder (one directory listing, one stat
+    per fastq).
+
+    Output:
+    -------
+    files :: list
+        parse_name of every fastq plus its 'size' and 'mtime_ns', sorted by
+        name
+    """
+    files = []
+    with os.scandir(folder) as it:
+        for entry in it:
+            rec = parse_name(entry.name)
+            if rec is None:
+                continue
+            st = entry.stat()
+            rec['size'] = st.st_size
+            rec['mtime_ns'] = st.st_mtime_ns
+            files.append(rec)
+    files.sort(key=lambda x: x['file'])
+    return files
+
+
+class Manifest:
+    """
+    The fastqs of a folder, indexed by sample.
+
+    Input:
+    ------
+    folder :: str
+        folder the fastqs are in
+    files :: list
+        see scan_folder
+    """
+
+    def __init__(self, folder, files):
+        self.folder = Path(folder)
+        self.files = files
+        self._by_sample = defaultdict(list)
+        for rec in files:
+            self._by_sample[rec['sample']].append(rec)
+        # Plate1-A01-a, Plate1-A01-b, ... are the i5/i7 pairs of Plate1-A01
+        self._by_base = defaultdict(list)
+        for rec in files:
+            base, sep, _ = rec['sample'].rpartition('-')
+            if sep:
+                self._by_base[base].append(rec)
+
+    @classmethod
+    def scan(cls, folder):
+        return cls(folder, scan_folder(folder))
+
+    @property
+    def samples(self):
+        return list(self._by_sample)
+
+    def records(self, sample_id, read='R1'):
+        "Manifest entries of a sample's fastqs of one read (None for every read)"
+        recs = self._by_sample.get(sample_id, []) + self._by_base.get(sample_id, [])
+        return sorted((x for x in recs if read is None or x['read'] == read), key=lambda x: x['file'])
+
+    def fastqs(self, sample_id, read='R1'):
+        "Paths of a sample's fastqs"
+        return [str(self.folder / x['file']) for x in self.records(sample_id, read)]
+
+    def size(self, sample_id, read='R1'):
+        "Bytes of a sample's fastqs"
+        return sum(x['size'] for x in self.records(sample_id, read))
+
+    def save(self, fname=None):
+        "Write the manifest (default = <folder>/fastq-manifest.json)"
+        fname = Path(fname) if fname else self.folder / MANIFEST
+        tmp = fname.with_name(fname.name + '.tmp')
+        with open(tmp, 'w') as fh:
+            json.dump({'version': MANIFEST_VERSION, 'folder': str(self.folder.resolve()), 'files': self.files}, fh, indent=1)
+        os.replace(tmp, fname)
+        return fname
+
+
+def read_manifest(fname, folder=None):
+    """
+    Read a saved manifest.
+
+    Input:
+    ------
+    fname :: str
+        manifest json
+    folder :: str
+        folder the fastqs are in (default = the manifest's folder)
+    """
+    with open(fname) as fh:
+        data = json.load(fh)
+    if data.get('version') != MANIFEST_VERSION:
+        raise ValueError(f'{fname} is a version {data.get("version")} manifest, expected {MANIFEST_VERSION}')
+    return Manifest(folder or Path(fname).parent, data['files'])
+
+
+def load(folder, fname=None):
+    """
+    The manifest of a folder: the saved one if it lists exactly the fastqs in
+    the folder now, else a fresh scan.
+
+    Input:
+    ------
+    folder :: str
+        folder of fastqs
+    fname :: str
+        saved manifest (default = <folder>/fastq-manifest.json)
+    """
+    fname = Path(fname) if fname else Path(folder) / MANIFEST
+    if fname.exists():
+        try:
+            saved = read_manifest(fname, folder)
+        except (ValueError, KeyError, json.JSONDecodeError) as err:
+            print(f'Ignoring {fname}: {err}', file=sys.stderr)
+        else:
+            names = sorted(x for x in os.listdir(folder) if FASTQ_RE.fullmatch(x))
+            if names == [x['file'] for x in saved.files]:
+                return saved
+            print(f'{fname} is out of date, rescanning {folder}', file=sys.stderr)
+    return Manifest.scan(folder)
+
+
+#===============================================================================
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Write a manifest of the fastqs in a folder (Sample_ID, S number, lane, read, size)')
+    parser.add_argument('folder',
+                        type=str,
+                        help='folder of fastqs (e.g. data/seq-runs/<run>)')
+    parser.add_argument('-o',
+                        '--out-file',
+                        dest='out_file',
+                        type=str,
+                        help='manifest to write (default = <folder>/fastq-manifest.json)')
+    args = parser.parse_args()
+
+    manifest = Manifest.scan(args.folder)
+    out = manifest.save(args.out_file)
+    size = sum(x['size'] for x in manifest.files)
+    print(f'{len(manifest.files)} fastqs of {len(manifest.samples)} samples ({size / 1e9:.2f} GB) written to {out}', file=sys.stderr)
@@ -0,0 +1,210 @@
+#!/usr/bin/env python3
+"""
+index_collisions.py - find i5/i7 pairs that a mismatch tolerant demultiplexer
+can't tell apart
+
+bcl2fastq (and demux.py) assign a read to a sample if its i7 and i5 reads are
+each within `mismatches` substitutions of the sample's indices. Two samples
+are therefore ambiguous whenever both their i7's and their i5's are within
+2 * mismatches of each other, even if the pairs are not exact duplicates.
+
+Every index is 2-bit packed into a uint64, so the Hamming distance between
+two indices is a XOR, a fold of each base's two bits into one, and a popcount.
+All pairs are compared a block of rows at a time, which keeps memory bounded
+and checks tens of thousands of wells in seconds.
+"""
+
+import sys
+import argparse
+
+import numpy as np
+import pandas as pd
+
+import demux
+
+# 2-bit encoding - anything else can't be packed
+BASES = b'ACGT'
+ENCODE = np.full(256, 255, dtype=np.uint8)
+for i, b in enumerate(BASES):
+    ENCODE[b] = i
+MAX_INDEX_LEN = 32
+
+# low bit of every 2-bit base
+LOW_BITS = np.uint64(0x5555555555555555)
+
+# rows of the pairwise matrix to compare at a time
+BLOCK_SIZE = 512
+
+#===============================================================================
+
+def pack_indices(seqs):
+    """
+    2-bit pack index sequences.
+
+    Input:
+    ------
+    seqs :: list
+        index sequences (all the same length, only A, C, G, or T)
+
+    Output:
+    -------
+    packed :: np.array (uint64)
+    """
+    seqs = [x.upper() for x in seqs]
+    lens = set(len(x) for x in seqs)
+    if len(lens) > 1:
+        raise ValueError(f'Indices must all be the same length. Observed lengths: {lens}')
+    length = lens.pop() if lens else 0
+    if length > MAX_INDEX_LEN:
+        raise ValueError(f'Indices longer than {MAX_INDEX_LEN} are not supported')
+
+    raw = np.frombuffer(''.join(seqs).encode('ascii'), dtype=np.uint8).reshape(len(seqs), length)
+    codes = ENCODE[raw]
+    bad = (codes == 255).any(axis=1)
+    if bad.any():
+        raise ValueError(f'Indices can only contain A, C, G, or T: {", ".join(np.array(seqs)[bad][:5])}')
+
+    packed = np.zeros(len(seqs), dtype=np.uint64)
+    for j in range(length):
+        packed = (packed << np.uint64(2)) | codes[:, j].astype(np.uint64)
+    return packed
+
+
+if hasattr(np, 'bitwise_count'):
+    def popcount(x):
+        "Number of set bits in every element of a uint64 array"
+        return np.bitwise_count(x)
+else:
+    POPCOUNT_8 = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+    def popcount(x):
+        "Number of set bits in every element of a uint64 array"
+        x = np.ascontiguousarray(x)
+        return POPCOUNT_8[x.view(np.uint8)].reshape(x.shape + (8,)).sum(axis=-1, dtype=np.uint8)
+
+
+def hamming(a, b):
+    """
+    Pairwise number of mismatched bases between packed indices.
+
+    Input:
+    ------
+    a, b :: np.array (uint64)
+        broadcastable arrays of packed indices
+
+    Output:
+    -------
+    dist :: np.array (uint8)
+    """
+    x = a ^ b
+    # a base mismatches if either of its two bits differs
+    return popcount((x | (x >> np.uint64(1))) & LOW_BITS)
+
+
+def find_collisions(i7, i5, mismatches=demux.MISMATCHES, block_size=BLOCK_SIZE):
+    """
+    Find every pair of rows whose i7's and i5's are both within
+    2 * mismatches of each other.
+
+    Input:
+    ------
+    i7, i5 :: list
+        index sequences of every row
+    mismatches :: int
+        mismatches the demultiplexer tolerates in each index read
+    block_size :: int
+        rows to compare at a time
+
+    Output:
+    -------
+    pairs :: np.array (int64)
+        (n, 2) row numbers, first < second
+    d7, d5 :: np.array (uint8)
+        i7 and i5 mismatches of each pair
+    """
+    p7 = pack_indices(i7)
+    p5 = pack_indices(i5)
+    max_dist = 2 * mismatches
+
+    rows, cols, d7s, d5s = [], [], [], []
+    n = len(p7)
+    for start in range(0, n, block_size):
+        end = min(start + block_size, n)
+        # only compare each row to the rows after it
+        d7 = hamming(p7[start:end, None], p7[None, start:])
+        hit = d7 <= max_dist
+        r, c = np.nonzero(hit)
+        d5 = hamming(p5[start + r], p5[start + c])
+        keep = (d5 <= max_dist) & (r < c)
+        rows.append(start + r[keep])
+        cols.append(start + c[keep])
+        d7s.append(d7[r[keep], c[keep]])
+        d5s.append(d5[keep])
+
+    if not rows:
+        return np.zeros((0, 2), dtype=np.int64), np.zeros(0, dtype=np.uint8), np.zeros(0, dtype=np.uint8)
+    pairs = np.column_stack([np.concatenate(rows), np.concatenate(cols)]).astype(np.int64)
+    return pairs, np.concatenate(d7s), np.concatenate(d5s)
+
+
+def collision_report(df, mismatches=demux.MISMATCHES, i7_col='i7', i5_col='i5'):
+    """
+    Table of every ambiguous pair of SampleSheet rows (see find_collisions).
+
+    Input:
+    ------
+    df :: pd.DataFrame
+        SampleSheet rows with i7/i5 columns (and Plate_ID/Sample_Well if
+        available)
+    mismatches :: int
+    i7_col, i5_col :: str
+        columns holding the indices
+
+    Output:
+    -------
+    report :: pd.DataFrame
+        one row per colliding pair with the Sample_ID, Plate_ID, Sample_Well,
+        and indices of both rows plus their i7/i5 mismatches
+    """
+    pairs, d7, d5 = find_collisions(df[i7_col].tolist(), df[i5_col].tolist(), mismatches)
+    cols = [x for x in ['Sample_ID', 'Plate_ID', 'Sample_Well', i7_col, i5_col] if x in df]
+    a = df[cols].iloc[pairs[:, 0]].reset_index(drop=True).add_suffix('_1')
+    b = df[cols].iloc[pairs[:, 1]].reset_index(drop=True).add_suffix('_2')
+    return pd.concat([a, b], axis=1).assign(**{f'{i7_col}_mismatches': d7, f'{i5_col}_mismatches': d5})
+
+
+def check_collisions(df, mismatches=demux.MISMATCHES, i7_col='i7', i5_col='i5', max_report=20):
+    "Raise a ValueError listing the colliding rows, if there are any (see collision_report)"
+    report = collision_report(df, mismatches, i7_col, i5_col)
+    if len(report) == 0:
+        return
+    # Sample_ID is Plate_ID-Sample_Well(-suffix) for platemap2samp.py sheets
+    id_col = 'Sample_ID' if 'Sample_ID' in df else 'Plate_ID'
+    wells = [[row[f'{id_col}_1'], row[f'{id_col}_2']] for _, row in report.head(max_report).iterrows()]
+    lines = [f'{x[0]} / {x[1]} ({i7_col}: {d7} mismatches, {i5_col}: {d5} mismatches)'
+             for x, d7, d5 in zip(wells, report[f'{i7_col}_mismatches'], report[f'{i5_col}_mismatches'])]
+    more = f'\n... and {len(report) - max_report} more' if len(report) > max_report else ''
+    raise ValueError(f'{len(report)} pair(s) of wells can not be told apart with {mismatches} mismatch(es) per index:\n' + '\n'.join(lines) + more)
+
+
+#===============================================================================
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='List SampleSheet rows whose index/index2 pairs collide within the allowed mismatches')
+    parser.add_argument('samplesheet',
+                        type=str,
+                        help='path to SampleSheet.csv')
+    parser.add_argument('-m',
+                        '--mismatches',
+                        dest='mismatches',
+                        type=int,
+                        default=demux.MISMATCHES,
+                        help='mismatches allowed in each index read (default = 1, as bcl2fastq and demux.py)')
+    args = parser.parse_args()
+
+    samples = demux.read_samplesheet(args.samplesheet)
+    report = collision_report(samples, args.mismatches, i7_col='index', i5_col='index2')
+    report.to_csv(sys.stdout, index=False)
+    print(f'{len(report)} colliding pair(s) of {len(samples)} rows', file=sys.stderr)
+    if len(report) > 0:
+        sys.exit(1)
@@ -0,0 +1,233 @@
+#!/usr/bin/env python3
+"""
+lexicode.py - greedy (Conway) lexicodes of DNA indices under edit distance
+
+Same result as conways_lexicode in analyses/primer-design-3/index-design-3.ipynb
+(e.g. ten-mer_d3.txt is lexicode(10, 3)): walk through every index in order
+and keep it if it is at least d edits away from every index kept so far.
+
+Instead of comparing each candidate against the whole growing pool, every
+index is 2-bit packed into an integer and a bitmap over all 4^length
+candidates records which ones are already within d - 1 edits of a kept index.
+Keeping an index marks its (vectorized) edit ball, and testing a candidate is
+a single lookup, so the cost scales with the size of the code rather than
+candidates x code.
+"""
+
+import sys
+import argparse
+
+import numpy as np
+
+BASES = 'ACGT'
+ENCODE = np.full(256, 255, dtype=np.uint8)
+for i, b in enumerate(BASES.encode()):
+    ENCODE[b] = i
+DECODE = np.frombuffer(BASES.encode(), dtype=np.uint8)
+
+# the bitmap holds 4^length entries
+MAX_LEN = 14
+
+# candidates to scan at a time when looking for the next index to keep
+SCAN_SIZE = 1 << 12
+
+#===============================================================================
+
+def pack(seqs):
+    """
+    2-bit pack equal length sequences (first base in the highest bits, so
+    packed order is lexicographic order).
+
+    Output:
+    -------
+    packed :: np.array (int64)
+    """
+    length = len(seqs[0]) if len(seqs) else 0
+    raw = np.frombuffer(''.join(seqs).encode('ascii'), dtype=np.uint8).reshape(len(seqs), length)
+    codes = ENCODE[raw]
+    if (codes == 255).any():
+        raise ValueError('Sequences can only contain A, C, G, or T')
+    packed = np.zeros(len(seqs), dtype=np.int64)
+    for j in range(length):
+        packed = (packed << 2) | codes[:, j]
+    return packed
+
+
+def unpack(packed, length):
+    "Convert packed sequences back to strings"
+    packed = np.asarray(packed, dtype=np.int64)
+    shifts = np.arange(2 * (length - 1), -1, -2, dtype=np.int64)
+    letters = DECODE[(packed[:, None] >> shifts) & 3]
+    raw = letters.tobytes().decode('ascii')
+    return [raw[i:i + length] for i in range(0, len(raw), length)]
+
+
+class EditBall:
+    """
+    Vectorized enumeration of every same length sequence within r edits of a
+    packed sequence.
+
+    An alignment between two sequences of the same length has as many
+    insertions as deletions, so the ball is every combination of k
+    substitutions and m deletion + insertion pairs with k + 2m <= r. Up to k
+    substitutions is a fixed set of XOR masks, and a deletion + insertion is
+    a handful of shifts over precomputed positions and bases.
+    """
+
+    def __init__(self, length, radius):
+        self.length = length
+        self.radius = radius
+        L = length
+
+        # substituting the base at position p (0 = first) flips bits 2(L-1-p)
+        pos = np.repeat(np.arange(L), 3)
+        delta = np.tile(np.arange(1, 4), L)
+        sub_masks = (delta << (2 * (L - 1 - pos))).astype(np.int64)
+
+        # sub_balls[k] = XOR masks of every combination of <= k substitutions
+        self.sub_balls = [np.zeros(1, dtype=np.int64)]
+        for k in range(1, radius + 1):
+            prev = self.sub_balls[-1]
+            self.sub_balls.append(np.unique(np.concatenate([prev, (prev[:, None] ^ sub_masks[None, :]).ravel()])))
+
+        # delete position i, then insert base b at position j of the shorter
+        # sequence
+        i, j, b = [x.ravel() for x in np.meshgrid(np.arange(L), np.arange(L), np.arange(4), indexing='ij')]
+        self.del_hi = 2 * (L - i)
+        self.del_lo = (1 << (2 * (L - 1 - i))) - 1
+        self.del_shift = 2 * (L - 1 - i)
+        self.ins_hi = 2 * (L - 1 - j)
+        self.ins_lo = (1 << (2 * (L - 1 - j))) - 1
+        self.ins_shift = 2 * (L - j)
+        self.ins_base = b << (2 * (L - 1 - j))
+
+    def delete_insert(self, x):
+        "Every deletion followed by an insertion of every sequence in x"
+        x = x[:, None]
+        y = ((x >> self.del_hi) << self.del_shift) | (x & self.del_lo)
+        return (((y >> self.ins_hi) << self.ins_shift) | self.ins_base | (y & self.ins_lo)).ravel()
+
+    def __call__(self, x):
+        """
+        Input:
+        ------
+        x :: int
+            packed sequence
+
+        Output:
+        -------
+        ball :: np.array (int64)
+            packed sequences within radius edits of x (with repeats)
+        """
+        res = [x ^ self.sub_balls[self.radius]]
+        # m deletion + insertion pairs, then whatever substitutions are left
+        shifted = np.array([x], dtype=np.int64)
+        for m in range(1, self.radius // 2 + 1):
+            shifted = self.delete_insert(shifted)
+            if m > 1:
+                shifted = np.unique(shifted)
+            res.append((shifted[:, None] ^ self.sub_balls[self.radius - 2 * m][None, :]).ravel())
+        return np.concatenate(res) if len(res) > 1 else res[0]
+
+
+def check_length(length):
+    if not 0 < length <= MAX_LEN:
+        raise ValueError(f'Index length must be between 1 and {MAX_LEN} (got {length})')
+
+
+def lexicode(length, d=3, scan_size=SCAN_SIZE):
+    """
+    Conway's lexicode over every index of a given length, in lexicographic
+    (itertools.product('ACGT', repeat=length)) order.
+
+    Input:
+    ------
+    length :: int
+        index length
+    d :: int
+        minimum edit distance between any two indices
+    scan_size :: int
+        candidates to look through at a time for the next one to keep
+
+    Output:
+    -------
+    pool :: list
+        the indices, in the order they were kept
+    """
+    check_length(length)
+    n = 4 ** length
+    if d <= 1:
+        return unpack(np.arange(n), length)
+
+    ball = EditBall(length, d - 1)
+    blocked = np.zeros(n, dtype=bool)
+    kept = []
+    pos = 0
+    while pos < n:
+        # the next candidate that isn't within d - 1 of anything kept
+        window = blocked[pos:pos + scan_size]
+        free = np.flatnonzero(~window)
+        if len(free) == 0:
+            pos += len(window)
+            continue
+        x = pos + int(free[0])
+        kept.append(x)
+        blocked[ball(x)] = True
+        pos = x + 1
+
+    return unpack(np.array(kept, dtype=np.int64), length)
+
+
+def lexicode_from(candidates, d=3):
+    """
+    Conway's lexicode over candidates in an arbitrary order (the notebook's
+    conways_lexicode with the same ordered iterator).
+
+    Input:
+    ------
+    candidates :: iterable
+        equal length indices (only A, C, G, or T)
+    d :: int
+        minimum edit distance between any two indices
+
+    Output:
+    -------
+    pool :: list
+    """
+    candidates = list(candidates)
+    if not candidates:
+        return []
+    length = len(candidates[0])
+    check_length(length)
+    packed = pack(candidates)
+
+    ball = EditBall(length, d - 1)
+    blocked = np.zeros(4 ** length, dtype=bool)
+    pool = []
+    for seq, x in zip(candidates, packed.tolist()):
+        if not blocked[x]:
+            pool.append(seq)
+            if d > 1:
+                blocked[ball(x)] = True
+    return pool
+
+
+#===============================================================================
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Print the greedy lexicode of every index of a given length (one per line)')
+    parser.add_argument('length',
+                        type=int,
+                        help='index length')
+    parser.add_argument('-d',
+                        '--dist',
+                        dest='dist',
+                        type=int,
+                        default=3,
+                        help='minimum edit distance between indices (default = 3)')
+    args = parser.parse_args()
+
+    pool = lexicode(args.length, args.dist)
+    sys.stdout.write(''.join(x + '\n' for x in pool))
+    print(f'{len(pool)} indices of length {args.length} at edit distance >= {args.dist}', file=sys.stderr)
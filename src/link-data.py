@@ -1,9 +1,11 @@
 #!/usr/bin/env python
 
-import re
+import os
 import argparse
 from pathlib import Path
 
+import fastq_manifest as fm
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(
         description='Create a folder with symlinks to all fastq\'s and a SampleSheet.csv in a sequencing directory. Note the name of the new folder will be the same as the input.')
@@ -16,6 +18,10 @@ if __name__ == '__main__':
                         help='where to drop the folder of symlinks (default = current directory)',
                         default=''
                         )
+    parser.add_argument('-u', '--undetermined',
+                        action='store_true',
+                        help='also link the Undetermined fastqs (for demux.py)'
+                        )
     args = parser.parse_args()
 
     # dump links in to a folder with the run id
@@ -27,10 +33,18 @@ if __name__ == '__main__':
     path_to_samplesheet = in_dir.joinpath('SampleSheet.csv').resolve()
     out_dir.joinpath('SampleSheet.csv').symlink_to(path_to_samplesheet)
 
-    # grab the fastqs
-    fastqs = in_dir.glob('Data/Intensities/BaseCalls/*.fastq*')
-    for fq in fastqs:
-        out_name = Path(fq).name
-        if 'Undetermined' not in out_name:
-            out_dir.joinpath(out_name).symlink_to(fq.resolve())
+    # grab the fastqs - one listing of the folder, and only resolve the
+    # folder rather than every file (unless the file is itself a link)
+    base_calls = in_dir.joinpath('Data', 'Intensities', 'BaseCalls')
+    real_base_calls = base_calls.resolve()
+    with os.scandir(base_calls) as it:
+        for entry in it:
+            if '.fastq' not in entry.name:
+                continue
+            if args.undetermined or 'Undetermined' not in entry.name:
+                target = Path(entry.path).resolve() if entry.is_symlink() else real_base_calls / entry.name
+                out_dir.joinpath(entry.name).symlink_to(target)
+
+    # index the links so the pipeline doesn't have to glob for every sample
+    fm.Manifest.scan(out_dir).save()
 
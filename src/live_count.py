@@ -0,0 +1,335 @@
+#!/usr/bin/env python3
+"""
+live_count.py - count a run's barcodes while the fastqs are still being written
+
+Polls a run's Data/Intensities/BaseCalls/ folder (the one link-data.py links
+from) for new or growing fastqs, and every poll only reads the bytes that have
+arrived since the last one. Each file keeps its byte offset, a streaming gzip
+decompressor, and any partial record at the end, so records are counted
+exactly once as they complete. Per-sample counts are kept as packed barcode
+arrays (see count_bcs.py) and, every --interval seconds, corrected against
+each sample's bc_set and republished as a preliminary correct.csv
+(Sample_ID,Centroid,Count,barcode).
+
+Once --until exists (e.g. the run folder's CopyComplete.txt, or a file the
+conversion step touches when it is done), the fastqs are read to the end one
+last time and the final table is written. Ctrl-C also publishes what has been
+counted so far before exiting.
+
+Counts only live in memory, so restarting starts the run over.
+"""
+
+import os
+import sys
+import time
+import zlib
+import argparse
+from collections import Counter
+from pathlib import Path
+
+import numpy as np
+
+import count_bcs as cb
+import correct_bcs as cc
+import run_pipeline as rp
+import fastq_manifest as fm
+
+# compressed bytes to read from a file at a time
+READ_SIZE = 1 << 22
+
+# seconds between polls and between publishing counts
+POLL_INTERVAL = 5
+PUBLISH_INTERVAL = 60
+
+#===============================================================================
+
+def find_basecalls(run_dir):
+    "Data/Intensities/BaseCalls/ of a run folder, or the folder itself"
+    base_calls = Path(run_dir) / 'Data' / 'Intensities' / 'BaseCalls'
+    return base_calls if base_calls.is_dir() else Path(run_dir)
+
+
+class FastqTail:
+    """
+    Incremental barcode counts of a single (possibly growing) fastq.
+
+    Input:
+    ------
+    path :: str
+        fastq or fastq.gz
+    bc_len :: int
+        number of bases to count from the start of each read
+    """
+
+    def __init__(self, path, bc_len):
+        self.path = str(path)
+        self.bc_len = bc_len
+        self.gzip = self.path.endswith('.gz')
+        self.reset()
+
+    def reset(self):
+        self.offset = 0
+        self.inode = None
+        self.decomp = zlib.decompressobj(wbits=31) if self.gzip else None
+        self.carry = b''
+        self.n_reads = 0
+        self.keys = np.zeros(0, dtype=np.uint64)
+        self.counts = np.zeros(0, dtype=np.int64)
+        self.odd = Counter()
+
+    def decompress(self, data):
+        "Decompressed bytes of data, moving on to the next gzip member as needed"
+        if not self.gzip:
+            return data
+        out = [self.decomp.decompress(data)]
+        # bcl2fastq (and bgzip) write many concatenated gzip members
+        while self.decomp.eof and self.decomp.unused_data:
+            rest = self.decomp.unused_data
+            self.decomp = zlib.decompressobj(wbits=31)
+            out.append(self.decomp.decompress(rest))
+        return b''.join(out)
+
+    def add_records(self, final=False):
+        "Count the complete records in carry (and the partial one if final)"
+        buf = self.carry
+        if final and buf and not buf.endswith(b'\n'):
+            buf += b'\n'
+        nl = np.flatnonzero(np.frombuffer(buf, dtype=np.uint8) == cb.NEWLINE)
+        if final:
+            # a truncated last record is handled the same way count_bcs does
+            cut = len(buf)
+        elif len(nl) >= 4:
+            nl = nl[:len(nl) // 4 * 4]
+            cut = nl[-1] + 1
+        else:
+            return 0
+        packed, odd = cb.pack_block(buf[:cut], nl, self.bc_len)
+        self.carry = buf[cut:]
+        if len(packed):
+            uniq, n = np.unique(packed, return_counts=True)
+            self.keys, self.counts = cb.merge_counts(np.concatenate([self.keys, uniq]),
+                                                     np.concatenate([self.counts, n.astype(np.int64)]))
+        self.odd.update(odd)
+        # records with a sequence line
+        n_reads = len(nl[1::4])
+        self.n_reads += n_reads
+        return n_reads
+
+    def poll(self, final=False):
+        """
+        Count whatever has been appended since the last poll.
+
+        Input:
+        ------
+        final :: bool
+            the file is complete, so also count a trailing partial record
+
+        Output:
+        -------
+        n_reads :: int
+            new reads counted (-1 if the file was replaced and recounted)
+        """
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return 0
+        restarted = False
+        if (self.inode is not None and stat.st_ino != self.inode) or stat.st_size < self.offset:
+            self.reset()
+            restarted = True
+        self.inode = stat.st_ino
+
+        n = 0
+        if stat.st_size > self.offset:
+            with open(self.path, 'rb') as fh:
+                fh.seek(self.offset)
+                while self.offset < stat.st_size:
+                    data = fh.read(min(READ_SIZE, stat.st_size - self.offset))
+                    if not data:
+                        break
+                    self.offset += len(data)
+                    self.carry += self.decompress(data)
+                    n += self.add_records()
+        if final:
+            n += self.add_records(final=True)
+        return -1 if restarted else n
+
+    def barcode_counts(self):
+        "{barcode: count} so far (as count_bcs.count_barcodes)"
+        res = dict(zip(cb.unpack(self.keys, self.bc_len), self.counts.tolist()))
+        for bc, n in self.odd.items():
+            bc = bc.decode('ascii', errors='replace')
+            res[bc] = res.get(bc, 0) + n
+        return res
+
+
+class LiveRun:
+    """
+    Live barcode counts of every sample in a run.
+
+    Input:
+    ------
+    run_dir :: str
+        sequencing run folder (or a folder of fastqs)
+    conds :: list
+        see run_pipeline.read_conditions
+    bc_sets :: dict
+        see correct_bcs.read_bc_map
+    dist :: int
+        maximum edit distance to correct
+    """
+
+    def __init__(self, run_dir, conds, bc_sets, dist=cc.MAX_DIST):
+        self.base_calls = find_basecalls(run_dir)
+        self.conds = conds
+        missing = sorted({row['bc_set'] for row in conds} - bc_sets.keys())
+        if missing:
+            raise ValueError(f'bc_sets {", ".join(missing)} are not in the barcode map. Options: {", ".join(bc_sets)}')
+        self.indices = {x: cc.build_index(bc_sets[x], dist)[0] for x in {row['bc_set'] for row in conds}}
+        self.bc_lens = {row['Sample_ID']: int(row['bc_len']) for row in conds}
+        self.tails = {row['Sample_ID']: {} for row in conds}
+        self.seen = set()
+        self.dirty = set()
+        self.rows = {}
+
+    def discover(self):
+        "Start tailing any new fastqs in the folder"
+        with os.scandir(self.base_calls) as it:
+            names = sorted(x.name for x in it if x.name not in self.seen)
+        for name in names:
+            self.seen.add(name)
+            # same samples as fastq_manifest.Manifest.records: the Sample_ID or
+            # Sample_ID-<suffix>
+            rec = fm.parse_name(name)
+            if rec is None or rec['read'] != 'R1':
+                continue
+            sample_id = rec['sample']
+            if sample_id not in self.tails:
+                sample_id = sample_id.rpartition('-')[0]
+            if sample_id in self.tails:
+                self.tails[sample_id][name] = FastqTail(self.base_calls / name, self.bc_lens[sample_id])
+
+    def poll(self, final=False):
+        """
+        Pick up new files and count the new records of every file.
+
+        Output:
+        -------
+        n_reads :: int
+            reads counted in this poll
+        """
+        self.discover()
+        total = 0
+        for sample_id, tails in self.tails.items():
+            for tail in tails.values():
+                n = tail.poll(final)
+                if n:
+                    self.dirty.add(sample_id)
+                    total += tail.n_reads if n < 0 else n
+        return total
+
+    @property
+    def n_reads(self):
+        return sum(tail.n_reads for tails in self.tails.values() for tail in tails.values())
+
+    def sample_rows(self, row):
+        "A sample's corrected rows (see run_pipeline.correct_rows)"
+        counts = Counter()
+        for tail in self.tails[row['Sample_ID']].values():
+            counts.update(tail.barcode_counts())
+        clusters = cc.correct_counts(counts, self.indices[row['bc_set']])
+        return ''.join(f'{s},{c},{n},{bc}\n' for s, c, n, bc in cc.tidy_clusters(row['Sample_ID'], clusters))
+
+    def publish(self, out_file):
+        "Write every sample's counts so far (only re-correcting samples that changed)"
+        for row in self.conds:
+            if row['Sample_ID'] in self.dirty or row['Sample_ID'] not in self.rows:
+                self.rows[row['Sample_ID']] = self.sample_rows(row)
+        self.dirty.clear()
+        tmp_file = f'{out_file}.tmp'
+        with open(tmp_file, 'w') as out:
+            out.write(rp.HEADER)
+            for row in self.conds:
+                out.write(self.rows[row['Sample_ID']])
+        os.replace(tmp_file, out_file)
+
+
+def watch(live, out_file, until=None, poll_interval=POLL_INTERVAL, publish_interval=PUBLISH_INTERVAL):
+    """
+    Poll and publish until the until file exists (or Ctrl-C).
+
+    Input:
+    ------
+    live :: LiveRun
+    out_file :: str
+        where to (re)write the counts
+    until :: str
+        path that signals the fastqs are complete
+    """
+    last_publish = time.monotonic()
+    try:
+        while True:
+            done = until is not None and os.path.exists(until)
+            n = live.poll(final=done)
+            if done:
+                break
+            if time.monotonic() - last_publish >= publish_interval:
+                live.publish(out_file)
+                last_publish = time.monotonic()
+                files = sum(len(x) for x in live.tails.values())
+                print(f'{time.strftime("%H:%M:%S")} published {live.n_reads} reads from {files} fastqs', file=sys.stderr)
+            if not n:
+                time.sleep(poll_interval)
+    except KeyboardInterrupt:
+        print('Interrupted, publishing partial counts', file=sys.stderr)
+    live.publish(out_file)
+    print(f'Final: {live.n_reads} reads written to {out_file}', file=sys.stderr)
+
+
+#===============================================================================
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Count and correct a run\'s barcodes while its fastqs are being written, republishing the counts as they grow')
+    parser.add_argument('run_dir',
+                        type=str,
+                        help='sequencing run folder (fastqs are read from Data/Intensities/BaseCalls/ if it exists)')
+    parser.add_argument('conditions',
+                        type=str,
+                        help='path to the run\'s conditions.csv')
+    parser.add_argument('bc_map',
+                        type=str,
+                        help='path to bc-map.csv')
+    parser.add_argument('-o',
+                        '--out-file',
+                        dest='out_file',
+                        type=str,
+                        help='preliminary counts (default = live.csv next to the conditions)')
+    parser.add_argument('-u',
+                        '--until',
+                        dest='until',
+                        type=str,
+                        help='stop (after a final read) once this file exists')
+    parser.add_argument('-i',
+                        '--interval',
+                        dest='interval',
+                        type=float,
+                        default=PUBLISH_INTERVAL,
+                        help=f'seconds between publishing counts (default = {PUBLISH_INTERVAL})')
+    parser.add_argument('-p',
+                        '--poll',
+                        dest='poll',
+                        type=float,
+                        default=POLL_INTERVAL,
+                        help=f'seconds between checking for new reads (default = {POLL_INTERVAL})')
+    parser.add_argument('-d',
+                        '--dist',
+                        dest='dist',
+                        type=int,
+                        default=cc.MAX_DIST,
+                        help='maximum edit distance to correct (default = 2)')
+    args = parser.parse_args()
+
+    out_file = args.out_file or str(Path(args.conditions).parent / 'live.csv')
+    live = LiveRun(args.run_dir, rp.read_conditions(args.conditions), cc.read_bc_map(args.bc_map), args.dist)
+    watch(live, out_file, args.until, args.poll, args.interval)
@@ -0,0 +1,261 @@
+#!/usr/bin/env python3
+"""
+metrics.py - per-stage wall time, CPU time, memory, and throughput
+
+Stages are timed with a context manager:
+
+    with metrics.stage('count', sample=sample_id, unit='reads') as m:
+        ...
+        m.items = n_reads
+
+Metrics are off unless SWABSEQ_METRICS names a file (or enable() is called,
+which sets it for child processes too). When off, stage() hands back a shared
+object whose enter/exit do nothing. When on, every stage appends one JSON
+line to the file (single small O_APPEND writes, so pool workers can share it):
+
+    {"stage", "sample", "wall_s", "cpu_s", "rss_delta_mb",
+     "worker_peak_rss_mb", "items", "unit", "items_per_s", "pid", "start"}
+
+rss_delta_mb is how much the process's resident memory grew (or shrank) over
+the stage. worker_peak_rss_mb is the process's high-water mark so far - a pool
+worker reports the peak of every sample it has run, not just this one.
+
+`python src/metrics.py <file>.jsonl` summarizes a file per stage (or per
+stage and sample with --by-sample) as csv.
+"""
+
+import os
+import sys
+import csv
+import json
+import time
+import argparse
+from collections import defaultdict
+
+try:
+    import resource
+except ImportError:
+    # not on windows
+    resource = None
+
+METRICS_ENV = 'SWABSEQ_METRICS'
+
+_path = os.environ.get(METRICS_ENV) or None
+
+#===============================================================================
+
+def enable(path):
+    "Record metrics to path (here and in any child processes started later)"
+    global _path
+    _path = str(path) if path else None
+    if _path:
+        os.environ[METRICS_ENV] = _path
+    else:
+        os.environ.pop(METRICS_ENV, None)
+
+
+def enabled():
+    return _path is not None
+
+
+def rss_mb():
+    "Current resident memory of this process (None where /proc isn't there)"
+    try:
+        with open('/proc/self/statm') as fh:
+            pages = int(fh.read().split()[1])
+    except (OSError, IndexError, ValueError):
+        return None
+    return pages * os.sysconf('SC_PAGE_SIZE') / (1 << 20)
+
+
+def peak_rss_mb():
+    "Peak resident memory of this process so far (over its whole life)"
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on linux, bytes on macos
+    return round(rss / (1 << 20 if sys.platform == 'darwin' else 1 << 10), 1)
+
+
+def record(stage, wall, cpu=None, items=None, unit=None, sample=None, rss_delta=None, **extra):
+    "Append one stage's metrics (a no-op when disabled)"
+    if _path is None:
+        return
+    rec = {
+        'stage': stage,
+        'sample': sample,
+        'wall_s': round(wall, 6),
+        'cpu_s': None if cpu is None else round(cpu, 6),
+        'rss_delta_mb': None if rss_delta is None else round(rss_delta, 1),
+        'worker_peak_rss_mb': peak_rss_mb(),
+        'items': items,
+        'unit': unit,
+        'items_per_s': round(items / wall, 1) if items and wall > 0 else None,
+        'pid': os.getpid(),
+        'start': round(time.time() - wall, 3),
+        **extra,
+    }
+    line = (json.dumps(rec) + '\n').encode()
+    fd = os.open(_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, line)
+    finally:
+        os.close(fd)
+
+
+class Stage:
+    "A timed stage (see stage)"
+    __slots__ = ['name', 'sample', 'unit', 'items', 'extra', '_wall', '_cpu', '_rss']
+
+    def __init__(self, name, sample=None, unit=None, **extra):
+        self.name = name
+        self.sample = sample
+        self.unit = unit
+        self.items = None
+        self.extra = extra
+
+    def __enter__(self):
+        self._wall = time.perf_counter()
+        self._cpu = time.process_time()
+        self._rss = rss_mb()
+        return self
+
+    def __exit__(self, exc_type, *args):
+        wall = time.perf_counter() - self._wall
+        cpu = time.process_time() - self._cpu
+        rss = rss_mb()
+        rss_delta = None if rss is None or self._rss is None else rss - self._rss
+        extra = self.extra if exc_type is None else {**self.extra, 'error': exc_type.__name__}
+        record(self.name, wall, cpu, self.items, self.unit, self.sample, rss_delta, **extra)
+        return False
+
+
+class NullStage:
+    "What stage returns when metrics are off - every operation is a no-op"
+    __slots__ = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+    def __setattr__(self, name, value):
+        pass
+
+
+NULL_STAGE = NullStage()
+
+
+def stage(name, sample=None, unit=None, **extra):
+    """
+    Time a block of code.
+
+    Input:
+    ------
+    name :: str
+        stage name (e.g. 'read_workbook', 'count', 'starcode')
+    sample :: str
+        Sample_ID (or file) the stage worked on, if any
+    unit :: str
+        what the stage's items are ('wells', 'reads', 'barcodes', ...) - set
+        .items on the returned object to get items_per_s
+    """
+    if _path is None:
+        return NULL_STAGE
+    return Stage(name, sample, unit, **extra)
+
+
+class TimedReader:
+    """
+    Wrap a file handle and add up the time (and bytes) spent in read() - for
+    telling decompression apart from the work done on what it returns.
+    """
+
+    def __init__(self, handle):
+        self.handle = handle
+        self.wall = 0.0
+        self.cpu = 0.0
+        self.bytes = 0
+
+    def read(self, *args):
+        wall, cpu = time.perf_counter(), time.process_time()
+        data = self.handle.read(*args)
+        self.wall += time.perf_counter() - wall
+        self.cpu += time.process_time() - cpu
+        self.bytes += len(data)
+        return data
+
+    def close(self):
+        self.handle.close()
+
+
+def read_metrics(fname):
+    "Every record of a metrics file"
+    with open(fname) as fh:
+        return [json.loads(line) for line in fh if line.strip()]
+
+
+def summarize(records, by_sample=False):
+    """
+    Add up the records of each stage (and sample).
+
+    Output:
+    -------
+    rows :: list
+        [{'stage', 'sample', 'n', 'wall_s', 'cpu_s', 'max_rss_delta_mb',
+          'max_worker_peak_rss_mb', 'items', 'unit', 'items_per_s'}, ...] in
+        order of first appearance
+    """
+    groups = defaultdict(list)
+    for rec in records:
+        groups[(rec['stage'], rec.get('sample') if by_sample else None)].append(rec)
+    rows = []
+    for (name, sample), recs in groups.items():
+        wall = sum(x['wall_s'] for x in recs)
+        items = sum(x['items'] or 0 for x in recs)
+        delta = [x['rss_delta_mb'] for x in recs if x.get('rss_delta_mb') is not None]
+        peak = [x['worker_peak_rss_mb'] for x in recs if x.get('worker_peak_rss_mb') is not None]
+        rows.append({
+            'stage': name,
+            'sample': sample,
+            'n': len(recs),
+            'wall_s': round(wall, 6),
+            'cpu_s': round(sum(x['cpu_s'] or 0 for x in recs), 6),
+            'max_rss_delta_mb': max(delta) if delta else None,
+            'max_worker_peak_rss_mb': max(peak) if peak else None,
+            'items': items or None,
+            'unit': recs[0].get('unit'),
+            'items_per_s': round(items / wall, 1) if items and wall > 0 else None,
+        })
+    return rows
+
+
+#===============================================================================
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Summarize a metrics file (see SWABSEQ_METRICS) per stage as csv')
+    parser.add_argument('metrics',
+                        type=str,
+                        help='metrics *.jsonl')
+    parser.add_argument('-s',
+                        '--by-sample',
+                        dest='by_sample',
+                        action='store_true',
+                        help='one row per stage and sample')
+    parser.add_argument('-o',
+                        '--out-file',
+                        dest='out_file',
+                        type=argparse.FileType('w'),
+                        default=sys.stdout,
+                        help='csv to write (default = stdout)')
+    args = parser.parse_args()
+
+    rows = summarize(read_metrics(args.metrics), args.by_sample)
+    fields = ['stage', 'sample', 'n', 'wall_s', 'cpu_s', 'max_rss_delta_mb', 'max_worker_peak_rss_mb', 'items', 'unit', 'items_per_s']
+    if not args.by_sample:
+        fields.remove('sample')
+    writer = csv.DictWriter(args.out_file, fieldnames=fields, extrasaction='ignore', lineterminator='\n')
+    writer.writeheader()
+    writer.writerows(rows)
@@ -0,0 +1,257 @@
+#!/usr/bin/env python3
+"""
+neighbor_qc.py - flag wells that look contaminated by a positive next door
+
+Takes the per-well calls of a run (see classify.py) and lays every plate out
+as a (plate, row, col) array - plates of the same size are stacked, so a run
+of hundreds of 1536 well plates is a handful of arrays and every step below
+is an array operation rather than a loop over wells:
+
+    signal          log10 of the well's largest virus / spike ratio (NaN for
+                    wells that weren't called on any amplicon)
+    strength        how far a positive's signal is above the positive cutoff
+                    (log10 of --ratio), 0 for everything else
+    neighbor_score  sum of the strength of the 8 surrounding wells, weighted
+                    1 for edge neighbors and --diagonal for corner neighbors
+    z               (signal - plate median) / (1.4826 * plate MAD) over the
+                    plate's negative and inconclusive wells
+    flag            negative or inconclusive, z > --z, and neighbor_score >=
+                    --min-neighbor
+
+Writes the per-well scores as csv, and optionally the per-plate heatmaps
+(signal, neighbor_score, z, flag) as an npz with "<Plate_ID>/<name>" arrays.
+"""
+
+import os
+import sys
+import argparse
+import warnings
+from pathlib import Path
+from contextlib import contextmanager
+
+import numpy as np
+import pandas as pd
+
+import plate_maps as pm
+import classify as cl
+
+# weight of a corner neighbor (edge neighbors weigh 1)
+DIAGONAL = 0.5
+# robust z-score of the well's signal that counts as unusually high
+Z = 3.0
+# neighbor_score (weighted log10 ratios above the positive cutoff) a flagged
+# well needs - 1 is one edge neighbor ten times over the cutoff
+MIN_NEIGHBOR = 1.0
+
+# calls that can be flagged (and that set a plate's baseline)
+CANDIDATES = ['negative', 'inconclusive']
+
+# MAD -> standard deviation for normal data
+MAD_SCALE = 1.4826
+
+HEATMAPS = ['signal', 'neighbor_score', 'z', 'flag']
+
+#===============================================================================
+
+def plate_arrays(plate_ids, wells):
+    """
+    Where every well goes in a stack of (plate, row, col) arrays, one stack
+    per plate size.
+
+    Input:
+    ------
+    plate_ids, wells :: list
+        Plate_ID and Sample_Well of every well
+
+    Output:
+    -------
+    layout :: dict
+        {plate size: (plates, idx, (p, r, c))} - the plates in the stack,
+        the wells (positions in the input) on those plates, and their
+        coordinates in the stack
+    """
+    plate_ids = pd.Series(plate_ids, dtype = object).astype(str)
+    rows, cols = pm.well_rows_cols(wells)
+    codes, plates = pd.factorize(plate_ids)
+    # each plate is sized to fit its wells
+    max_row = np.zeros(len(plates), dtype = np.int64)
+    max_col = np.zeros(len(plates), dtype = np.int64)
+    np.maximum.at(max_row, codes, rows)
+    np.maximum.at(max_col, codes, cols)
+    sizes = np.array([pm.fit_plate_size(r + 1, c + 1, x) for r, c, x in zip(max_row, max_col, plates)], dtype = np.int64)
+
+    layout = {}
+    for size in np.unique(sizes).tolist():
+        members = np.flatnonzero(sizes == size)
+        stack_of = np.full(len(plates), -1, dtype = np.int64)
+        stack_of[members] = np.arange(len(members))
+        idx = np.flatnonzero(stack_of[codes] >= 0)
+        layout[size] = (plates[members].tolist(), idx, (stack_of[codes[idx]], rows[idx], cols[idx]))
+    return layout
+
+
+def to_stack(values, n_plates, size, idx, coords, fill = np.nan):
+    "Scatter per-well values into a (plate, row, col) array (fill sets the dtype)"
+    arr = np.full((n_plates, pm.nrow_pl(size), pm.ncol_pl(size)), fill)
+    arr[coords] = values[idx]
+    return arr
+
+
+def neighbor_sum(arr, diagonal = DIAGONAL):
+    """
+    Weighted sum of the 8 neighbors of every well (a 3x3 convolution with a
+    zero center, wells off the plate count as 0)
+
+    Input:
+    ------
+    arr :: np.array
+        (plate, row, col)
+    """
+    padded = np.pad(arr, ((0, 0), (1, 1), (1, 1)))
+    nrow, ncol = arr.shape[1:]
+    res = np.zeros(arr.shape, dtype = np.float64)
+    for dr in (-1, 0, 1):
+        for dc in (-1, 0, 1):
+            if dr == dc == 0:
+                continue
+            weight = diagonal if dr and dc else 1.0
+            res += weight * padded[:, 1 + dr:1 + dr + nrow, 1 + dc:1 + dc + ncol]
+    return res
+
+
+@contextmanager
+def quiet_nan_warnings():
+    "All-NaN wells and plates are expected - don't warn about them"
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', category = RuntimeWarning)
+        yield
+
+
+def robust_z(signal, ref):
+    """
+    (signal - median) / (MAD_SCALE * MAD) per plate, over the wells in ref
+
+    Input:
+    ------
+    signal :: np.array
+        (plate, row, col)
+    ref :: np.array
+        bool, same shape - the wells each plate's median/MAD come from
+    """
+    vals = np.where(ref, signal, np.nan)
+    with quiet_nan_warnings():
+        med = np.nanmedian(vals, axis = (1, 2), keepdims = True)
+        mad = np.nanmedian(np.abs(vals - med), axis = (1, 2), keepdims = True) * MAD_SCALE
+        # a perfectly flat plate has no spread - fall back to the std
+        mad = np.where(mad > 0, mad, np.nanstd(vals, axis = (1, 2), keepdims = True))
+        return (signal - med) / np.where(mad > 0, mad, np.nan)
+
+
+def score_wells(calls, ratio = cl.RATIO, diagonal = DIAGONAL, z = Z, min_neighbor = MIN_NEIGHBOR):
+    """
+    Score every well of a calls table.
+
+    Input:
+    ------
+    calls :: pd.DataFrame
+        classify.py output (Plate_ID, Sample_Well, <X>_ratio, ..., call)
+
+    Output:
+    -------
+    (scores, heatmaps) :: tuple
+        per-well DataFrame (Sample_ID, Plate_ID, Sample_Well, call, signal,
+        neighbor_score, z, flag) in the input order, and
+        {Plate_ID: {name: (row, col) array}} for the names in HEATMAPS
+    """
+    ratio_cols = [x for x in calls.columns if x.endswith('_ratio')]
+    if not ratio_cols:
+        raise ValueError('The calls have no <amplicon>_ratio columns (see classify.py)')
+    with np.errstate(divide = 'ignore', invalid = 'ignore'), quiet_nan_warnings():
+        signal = np.log10(np.nanmax(calls[ratio_cols].to_numpy(dtype = np.float64), axis = 1))
+    positive = (calls['call'] == 'positive').to_numpy()
+    candidate = calls['call'].isin(CANDIDATES).to_numpy()
+    strength = np.where(positive, np.clip(np.nan_to_num(signal - np.log10(ratio)), 0, None), 0.0)
+
+    n = len(calls)
+    out = {x: np.full(n, np.nan) for x in ['neighbor_score', 'z']}
+    out['flag'] = np.zeros(n, dtype = bool)
+    heatmaps = {}
+    for size, (plates, idx, coords) in plate_arrays(calls['Plate_ID'], calls['Sample_Well']).items():
+        sig = to_stack(signal, len(plates), size, idx, coords)
+        cand = to_stack(candidate, len(plates), size, idx, coords, fill = False)
+        nbr = neighbor_sum(to_stack(strength, len(plates), size, idx, coords, fill = 0.0), diagonal)
+        zs = robust_z(sig, cand & ~np.isnan(sig))
+        with np.errstate(invalid = 'ignore'):
+            flag = cand & (zs > z) & (nbr >= min_neighbor)
+
+        out['neighbor_score'][idx] = nbr[coords]
+        out['z'][idx] = zs[coords]
+        out['flag'][idx] = flag[coords]
+        for i, plate in enumerate(plates):
+            heatmaps[plate] = dict(zip(HEATMAPS, [sig[i], nbr[i], zs[i], flag[i]]))
+
+    scores = pd.DataFrame({
+        'Sample_ID': calls['Sample_ID'].to_numpy(),
+        'Plate_ID': calls['Plate_ID'].to_numpy(),
+        'Sample_Well': calls['Sample_Well'].to_numpy(),
+        'call': calls['call'].to_numpy(),
+        'signal': signal,
+        'neighbor_score': out['neighbor_score'],
+        'z': out['z'],
+        'flag': out['flag'],
+    })
+    return scores, heatmaps
+
+
+def write_heatmaps(heatmaps, fname):
+    "Save the per-plate arrays as <Plate_ID>/<name> entries of an npz"
+    tmp = f'{fname}.tmp.npz'
+    np.savez_compressed(tmp, **{f'{plate}/{name}': arr for plate, maps in heatmaps.items() for name, arr in maps.items()})
+    os.replace(tmp, fname)
+
+
+#===============================================================================
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Flag negative wells with unusually high viral signal next to strong positives')
+    parser.add_argument('calls',
+                        type=str,
+                        help='calls.csv of a run (see classify.py)')
+    parser.add_argument('-o',
+                        '--out-file',
+                        dest='out_file',
+                        type=str,
+                        help='per-well scores csv (default = neighbor-qc.csv next to the calls)')
+    parser.add_argument('--heatmaps',
+                        type=str,
+                        help='also save the per-plate arrays to this *.npz')
+    parser.add_argument('--ratio',
+                        type=float,
+                        default=cl.RATIO,
+                        help='virus / spike ratio the calls were made with')
+    parser.add_argument('--diagonal',
+                        type=float,
+                        default=DIAGONAL,
+                        help='weight of corner neighbors (edge neighbors weigh 1)')
+    parser.add_argument('--z',
+                        type=float,
+                        default=Z,
+                        help='robust z-score of a well\'s signal that counts as high')
+    parser.add_argument('--min-neighbor',
+                        dest='min_neighbor',
+                        type=float,
+                        default=MIN_NEIGHBOR,
+                        help='weighted log10 ratio of positive neighbors over the cutoff a flagged well needs')
+    args = parser.parse_args()
+
+    calls = pd.read_csv(args.calls, dtype={'Sample_ID': str, 'Plate_ID': str, 'Sample_Well': str, 'call': str})
+    scores, heatmaps = score_wells(calls, args.ratio, args.diagonal, args.z, args.min_neighbor)
+
+    out_file = args.out_file or str(Path(args.calls).with_name('neighbor-qc.csv'))
+    tmp = f'{out_file}.tmp'
+    scores.to_csv(tmp, index=False, float_format='%.6g')
+    os.replace(tmp, out_file)
+    if args.heatmaps:
+        write_heatmaps(heatmaps, args.heatmaps)
+    print(f'{int(scores["flag"].sum())} of {len(scores)} wells flagged, written to {out_file}', file=sys.stderr)
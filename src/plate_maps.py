@@ -1,19 +1,45 @@
 #!/usr/bin/env python
 
+import os
+import pickle
+import hashlib
 import itertools
+import numpy as np
 import pandas as pd
-from copy import deepcopy
 from collections import defaultdict
+from functools import lru_cache
 from math import sqrt
+from pathlib import Path
 import string
 
-from openpyxl import load_workbook
-from xlrd import XLRDError
+import metrics
+
+# bump whenever the parsed plate map format changes to invalidate old caches
+CACHE_VERSION = 3
+DEFAULT_CACHE_DIR = os.environ.get('SWABSEQ_CACHE_DIR', str(Path.home() / '.cache' / 'swabseq' / 'plate-maps'))
+
+# valid plate sizes (see split_plate)
+PLATE_SIZES = [6, 12, 24, 48, 96, 384, 1536]
+
+# flat-file plate maps (see sheet_reader)
+GRID_SUFFIXES = {'.csv': ',', '.tsv': '\t', '.txt': '\t'}
+LONG_SUFFIXES = set(['.csv', '.tsv', '.txt', '.parquet'])
+# optional column of a long table giving each plate's size (see read_long_table)
+PLATE_SIZE_COL = 'Plate_Size'
+
+# cell text that is read as an int/float/bool, as Excel would have stored it
+INT_RE = r'[+-]?\d+'
+FLOAT_RE = r'[+-]?(?:\d+\.?\d*|\.\d+)(?:[eE][+-]?\d+)?'
+BOOLS = {'TRUE': True, 'FALSE': False}
+
+# values that infer to the same dtype whether they're split over plates or not
+SIMPLE_KINDS = set(['integer', 'floating', 'mixed-integer-float', 'string', 'boolean'])
 
 # Suite of functions for new plate maps
 def add_plate_map_constants(plate_maps, constants_df):
     
-    plate_maps_full = defaultdict(dict, deepcopy(plate_maps))
+    # the value lists are never modified, so only copy the dicts around them
+    plate_maps_full = defaultdict(dict, {var_name: dict(x) for var_name, x in plate_maps.items()})
     
     # Get plate sizes (also gets plate worksheet variable names)
     plate_sizes = get_plate_sizes(plate_maps)
@@ -47,45 +73,220 @@ def expand_plate_maps(plate_maps):
                 plate_maps_expanded[var][enum_plate] = val
     return dict(plate_maps_expanded)
 
-def get_stripped_values(sheet):
+def get_stripped_values(rows):
     # Get the values as a list of tuples
-    vals = list(sheet.values)
+    vals = [tuple(row) for row in rows]
 
     # Determine last row
     nrows = len(vals)
-    for i in range(nrows-1, 0, -1):
-        if all(x is None for x in vals[i]):
-            nrows = i
-        else:
-            break
+    while nrows > 1 and all(x is None for x in vals[nrows-1]):
+        nrows -= 1
 
     # Strip off extra rows
     vals = vals[:nrows]
 
-    # Determine last column
-    ncols = len(vals[0])
-    for i in range(ncols-1, 0, -1):
-        if all(x is None for x in [vals[j][i] for j in range(nrows)]):
-            ncols = i
-        else:
-            break
+    # Determine last column (one pass over each row rather than one pass over
+    # every row for each column)
+    ncols = 1
+    for row in vals:
+        for i in range(len(row)-1, ncols-1, -1):
+            if row[i] is not None:
+                ncols = i + 1
+                break
 
-    # Strip off extra columns
-    vals = [row[:ncols] for row in vals]
+    # Strip off extra columns (read-only sheets can have ragged rows)
+    vals = [row[:ncols] + (None,) * (ncols - len(row)) for row in vals]
 
     return vals
 
+def read_workbook(fname):
+    """
+    Read every tab of a workbook in a single read-only pass
+
+    Input:
+    ------
+    fname :: str
+        path to the plate map *.xlsx
+
+    Output:
+    -------
+    sheets :: dict
+        {sheet title: [(val, ...), ...]} with trailing empty rows/columns stripped
+    """
+    from openpyxl import load_workbook
+
+    wb = load_workbook(fname, read_only = True, data_only = True)
+    try:
+        sheets = {sheet.title: get_stripped_values(sheet.values) for sheet in wb.worksheets}
+    finally:
+        wb.close()
+    return sheets
+
+def sheet_reader(fname):
+    """
+    Pick the reader for a plate map. Every reader returns the same
+    {tab: [(val, ...), ...]} as read_workbook, so all of them go through the
+    same checks (split_plate, check_plates_x_vars, the "_constants" tab)
+
+    Input:
+    ------
+    fname :: str
+        a *.xlsx workbook, a folder of per-tab csv/tsv grids (see
+        read_grid_dir), or a long *.csv/*.tsv/*.parquet table with one row
+        per well (see read_long_table)
+
+    Output:
+    -------
+    reader :: function
+        read_workbook, read_grid_dir, or read_long_table
+    """
+    path = Path(fname)
+    if path.is_dir():
+        return read_grid_dir
+    if path.suffix.lower() in LONG_SUFFIXES:
+        return read_long_table
+    return read_workbook
+
+def parse_cells(vals):
+    """
+    Convert cell text into the values openpyxl would give for the same cells
+    (vectorized over the whole grid)
+
+    Input:
+    ------
+    vals :: np.array
+        2d array of str ('' for blank cells)
+
+    Output:
+    -------
+    cells :: np.array
+        object array of None, int, float, bool, and str
+    """
+    flat = pd.Series(vals.ravel(), dtype = object).str.strip()
+    out = flat.astype(object)
+    is_float = flat.str.fullmatch(FLOAT_RE)
+    out[is_float] = flat[is_float].astype(np.float64)
+    is_int = flat.str.fullmatch(INT_RE)
+    if is_int.any():
+        out[is_int] = [int(x) for x in flat[is_int]]
+    is_bool = flat.str.upper().isin(BOOLS.keys())
+    out[is_bool] = flat[is_bool].str.upper().map(BOOLS)
+    out[flat == ''] = None
+    return out.to_numpy(dtype = object).reshape(vals.shape)
+
+def read_grid(fname, sep = ','):
+    """
+    Read a csv/tsv laid out like a workbook tab (blank lines between plates)
+
+    Output:
+    -------
+    rows :: list
+        [(val, ...), ...] with trailing empty rows/columns stripped
+    """
+    # plates of different sizes make ragged lines - give the parser the widest
+    with open(fname, newline = '') as fh:
+        width = max((line.count(sep) + 1 for line in fh), default = 1)
+    df = pd.read_csv(fname, sep = sep, header = None, names = range(width), dtype = str,
+                     keep_default_na = False, skip_blank_lines = False)
+    return get_stripped_values(parse_cells(df.fillna('').to_numpy(dtype = object)).tolist())
+
+def read_grid_dir(folder):
+    """
+    Read a folder with one <tab>.csv or <tab>.tsv per workbook tab
+    (including _constants.csv), in file name order
+
+    Output:
+    -------
+    sheets :: dict
+        see read_workbook
+    """
+    sheets = {}
+    for path in sorted(Path(folder).iterdir()):
+        sep = GRID_SUFFIXES.get(path.suffix.lower())
+        if sep is None or path.name.startswith('.'):
+            continue
+        if path.stem in sheets:
+            raise ValueError(f'Tab "{path.stem}" is given by more than one file in {folder}')
+        sheets[path.stem] = read_grid(path, sep)
+    if not sheets:
+        raise ValueError(f'No *.csv or *.tsv plate maps in {folder}')
+    return sheets
+
+def read_long_table(fname):
+    """
+    Read a table with one row per well (Plate_ID, Sample_Well, and a column
+    per variable) and lay it out as workbook tabs: one grid per variable and
+    plate, and a "_constants" tab of just the plates. Missing wells are
+    blank.
+
+    Each plate is laid out at the size in its Plate_Size column (6, 12, ...,
+    1536), and wells outside of that plate are an error. Plates without a
+    Plate_Size (or tables without the column) fall back to the smallest
+    plate that holds their wells - a 96 well plate that only uses A01-D06
+    is then read as a 24 well plate, so give Plate_Size whenever the plate
+    size matters.
+
+    Output:
+    -------
+    sheets :: dict
+        see read_workbook
+    """
+    fname = Path(fname)
+    if fname.suffix.lower() == '.parquet':
+        df = pd.read_parquet(fname)
+        df = pd.DataFrame({x: df[x].astype(object).where(df[x].notna(), None) for x in df.columns})
+    else:
+        sep = GRID_SUFFIXES[fname.suffix.lower()]
+        df = pd.read_csv(fname, sep = sep, dtype = str, keep_default_na = False)
+        df = pd.DataFrame(parse_cells(df.to_numpy(dtype = object)), columns = df.columns)
+    missing = [x for x in ['Plate_ID', 'Sample_Well'] if x not in df.columns]
+    if missing:
+        raise ValueError(f'{fname} must have {" and ".join(missing)} column(s)')
+
+    row, col = well_rows_cols(df['Sample_Well'])
+
+    var_names = [x for x in df.columns if x not in ('Plate_ID', 'Sample_Well', PLATE_SIZE_COL)]
+    sheets = {x: [] for x in var_names}
+    plates = list(pd.unique(df['Plate_ID'].astype(str)))
+    plate_ids = df['Plate_ID'].astype(str).to_numpy()
+    given_sizes = df[PLATE_SIZE_COL].to_numpy(dtype = object) if PLATE_SIZE_COL in df.columns else None
+    for plate in plates:
+        idx = np.flatnonzero(plate_ids == plate)
+        sizes = set() if given_sizes is None else set(x for x in given_sizes[idx] if x is not None)
+        if len(sizes) > 1:
+            raise ValueError(f'{plate} has more than one {PLATE_SIZE_COL}: {", ".join(sorted(map(str, sizes)))}')
+        if sizes:
+            size = check_plate_size(sizes.pop(), plate)
+            outside = (row[idx] >= nrow_pl(size)) | (col[idx] >= ncol_pl(size))
+            if outside.any():
+                wells = df['Sample_Well'].to_numpy(dtype = object)[idx][outside]
+                raise ValueError(f'{plate} has wells outside of a {size} well plate: {", ".join(map(str, wells[:5]))}')
+        else:
+            size = fit_plate_size(row[idx].max() + 1, col[idx].max() + 1, plate)
+        pos = row[idx] * ncol_pl(size) + col[idx]
+        if len(set(pos.tolist())) != len(pos):
+            raise ValueError(f'{plate} has the same well more than once')
+        header = tuple([plate] + list(range(1, ncol_pl(size) + 1)))
+        for var_name in var_names:
+            grid = np.full(size, None, dtype = object)
+            grid[pos] = df[var_name].to_numpy(dtype = object)[idx]
+            grid = grid.reshape(nrow_pl(size), ncol_pl(size))
+            if sheets[var_name]:
+                sheets[var_name].append((None,) * len(header))
+            sheets[var_name].append(header)
+            sheets[var_name].extend((letter,) + tuple(x) for letter, x in zip(row_letters(size), grid.tolist()))
+    sheets['_constants'] = [('Plate',)] + [(x,) for x in plates]
+    return sheets
+
 def read_plate_map_sheets(sheets):
     # This needs to error out in an informative way - I had a tab named "test"
     # with nothing in the right format and the error was not intuitive.
     plate_maps = {}
     #var_names = set()
     #plate_ids = set()
-    for sheet in sheets.worksheets:
-        var_name = sheet.title
+    for var_name, strip in sheets.items():
         #var_names.add(var_name)
         if not var_name.startswith('_'):
-            strip = get_stripped_values(sheet)
             plates = [list(x[1]) for x in itertools.groupby(strip, lambda line: all(y is None for y in line)) if not x[0]]
             try:
                 plate_by_var = split_plate(plates)
@@ -95,29 +296,106 @@ def read_plate_map_sheets(sheets):
     
     return plate_maps
 
-def read_plate_maps(fname):
+def read_plate_maps(fname, cache_dir = None):
+    """
+    Parse a plate map workbook into {var: {plate: [val, ...]}}
+
+    Input:
+    ------
+    fname :: str
+        path to the plate map *.xlsx
+    cache_dir :: str
+        see read_plate_map_set
 
-    sheets = load_workbook(fname, data_only = True)
-    
-    # Read in the sheet-formatted maps and expand them
-    plate_maps = read_plate_map_sheets(sheets)
-    plate_maps = expand_plate_maps(plate_maps)
-    
-    # Ensure all observed plates exist for all variables
-    check_plates_x_vars(plate_maps)
+    Output:
+    -------
+    plate_maps :: dict
+        {var1:{plate1:[val, ...], plate2:[val, ...],} var2:{plate1:[val, ...], ...}}
+    """
+    return read_plate_map_set(fname, cache_dir).to_dict()
+
+def read_plate_map_set(fname, cache_dir = None):
+    """
+    Parse a plate map workbook into a PlateMapSet
+
+    Input:
+    ------
+    fname :: str
+        path to the plate map *.xlsx (or a folder of csv/tsv tabs, or a long
+        csv/tsv/parquet table - see sheet_reader)
+    cache_dir :: str
+        if given, reuse (or save) the parsed plate maps in this folder, keyed
+        by the sha256 of the workbook's contents
+
+    Output:
+    -------
+    plate_maps :: PlateMapSet
+    """
+    if cache_dir is not None:
+        cache_file = plate_map_cache_file(fname, cache_dir)
+        if cache_file.exists():
+            try:
+                with metrics.stage('plate_map_cache', sample = os.path.basename(fname), unit = 'wells') as m:
+                    with open(cache_file, 'rb') as fh:
+                        plate_maps = pickle.load(fh)
+                    m.items = sum(plate_maps.plate_sizes.values())
+                return plate_maps
+            except (pickle.UnpicklingError, EOFError, AttributeError, ImportError):
+                # corrupt or stale cache - just reparse
+                pass
+
+    reader = sheet_reader(fname)
+    with metrics.stage(reader.__name__, sample = os.path.basename(fname), unit = 'cells') as m:
+        sheets = reader(fname)
+        m.items = sum(len(row) for rows in sheets.values() for row in rows)
     
-    # Read in constants and add them into the full-format plate map
-    constants_df = get_constants_tab(fname)
-    plate_maps = add_plate_map_constants(plate_maps, constants_df)
+    with metrics.stage('parse_plate_maps', sample = os.path.basename(fname), unit = 'wells') as m:
+        # Read in the sheet-formatted maps - ranged plates ("Plate1-3") share a
+        # single array rather than being copied out to every plate
+        plate_maps = PlateMapSet.from_plate_maps(read_plate_map_sheets(sheets))
+        
+        # Ensure all observed plates exist for all variables
+        plate_maps.check_plates_x_vars()
+        
+        # Read in constants and add them into the plate map set
+        constants_df = get_constants_tab(sheets)
+        plate_maps.add_constants(constants_df)
+        m.items = sum(plate_maps.plate_sizes.values())
+
+    if cache_dir is not None:
+        cache_file.parent.mkdir(parents = True, exist_ok = True)
+        # write then rename so a concurrent run never sees half a file
+        tmp_file = cache_file.with_suffix(f'.{os.getpid()}.tmp')
+        with open(tmp_file, 'wb') as fh:
+            pickle.dump(plate_maps, fh, protocol = pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_file, cache_file)
     
     return plate_maps
+
+def plate_map_cache_file(fname, cache_dir):
+    "Get the cache file for a workbook (sha256 of its contents + cache version)"
+    digest = hashlib.sha256(f'v{CACHE_VERSION}'.encode())
+    # a folder of tabs is keyed by the names and contents of its files
+    paths = sorted(x for x in Path(fname).iterdir() if x.is_file()) if Path(fname).is_dir() else [Path(fname)]
+    for path in paths:
+        if len(paths) > 1 or path != Path(fname):
+            digest.update(path.name.encode() + b'\0')
+        with open(path, 'rb') as fh:
+            for chunk in iter(lambda: fh.read(1 << 20), b''):
+                digest.update(chunk)
+    return Path(cache_dir) / f'{digest.hexdigest()}.pkl'
     
-def get_constants_tab(fname):
+def get_constants_tab(sheets):
     # Get the tab
-    try:
-        constants_df = pd.read_excel(fname, sheet_name = '_constants')
-    except XLRDError as e:
+    if '_constants' not in sheets:
         raise RuntimeError('A sheet named "_constants" must be specified in the workbook.')
+    vals = sheets['_constants']
+
+    # First row is the header (as in pd.read_excel). Excel stores every number
+    # as a float, so convert whole numbers back to int as pandas would.
+    header = [f'Unnamed: {i}' if x is None else x for i, x in enumerate(vals[0])] if vals else []
+    rows = [[int(x) if isinstance(x, float) and x.is_integer() else x for x in row] for row in vals[1:]]
+    constants_df = pd.DataFrame(rows, columns = header)
     
     # Ensure it has a column named "Plate"
     if not 'Plate' in constants_df:
@@ -201,36 +479,228 @@ def get_plate_sizes(plate_maps):
     return plate_sizes
 
 def add_plate_wells(plate_maps):
-    plate_maps = deepcopy(plate_maps)
+    plate_maps = dict(plate_maps)
     
     plate_sizes = get_plate_sizes(plate_maps)
     
-    wells_dict = {plate_id:[f'{row}{col:02}' for row in row_letters(plate_size) for col in range(1, ncol_pl(plate_size) + 1)] for plate_id, plate_size in plate_sizes.items()}
+    wells_dict = {plate_id:well_names(plate_size).tolist() for plate_id, plate_size in plate_sizes.items()}
     
     plate_maps['Sample_Well'] = wells_dict
     
     return(plate_maps)
 
 def plate_maps_to_df(plate_maps):
-    check_plates_x_vars(plate_maps)
-    
-    plate_maps = add_plate_wells(plate_maps)
-
-    # Temporarily rename "index" column
-    rename_index = False
-    if 'index' in plate_maps:
-        rename_index = True
-        plate_maps['__index__'] = deepcopy(plate_maps['index'])
-        del plate_maps['index']
-    
-    df = pd.concat([pd.DataFrame(x).reset_index().melt(id_vars = 'index', var_name = "Plate_ID", value_name = var_name).set_index(['index', 'Plate_ID']) for var_name, x in plate_maps.items()], axis=1, sort=True)
-    
-    df = df.reset_index().drop('index', axis=1).assign(foo = lambda df: df['Plate_ID'].map(lambda x: int(x.replace('Plate', '')))).sort_values(['foo', 'Sample_Well']).reset_index(drop=True).drop('foo', axis = 1)
+    """
+    Convert plate maps into a long DataFrame with one row per well (see
+    PlateMapSet.to_df)
+
+    Input:
+    ------
+    plate_maps :: dict or PlateMapSet
+        {var1:{plate1:[val, ...], plate2:[val, ...],} var2:{plate1:[val, ...], ...}}
+
+    Output:
+    -------
+    df :: pd.DataFrame
+    """
+    if not isinstance(plate_maps, PlateMapSet):
+        plate_maps = PlateMapSet.from_plate_maps(plate_maps)
+    return(plate_maps.to_df())
 
-    if rename_index:
-        df.rename({'__index__':'index'}, axis = 'columns', inplace = True)
-    
-    return(df)
+
+class PlateMapSet:
+    """
+    Plate map variables stored as arrays over a (plate, well) grid
+
+    Every variable is either a tab, with one array of well values per plate,
+    or a constant, with a single value per plate that is only broadcast to
+    every well on output. Plates that come from a ranged spec like "Plate1-100"
+    all point at the same array. Well values are held as int64/float64/bool
+    arrays when a plate is homogeneous and object arrays otherwise.
+
+    Behaves like the old {var: {plate: [val, ...]}} dict for reading (keys,
+    membership, indexing), and plate sizes and the plates x variables check
+    are only computed once.
+    """
+
+    def __init__(self):
+        self._tabs = {}
+        self._constants = {}
+        self._plate_sizes = None
+        self._checked = False
+
+    @classmethod
+    def from_plate_maps(cls, plate_maps):
+        """
+        Build from {var: {plate: [val, ...]}}, where plates can also be ranges
+        (e.g. the output of read_plate_map_sheets).
+        """
+        res = cls()
+        for var_name, plate_dict in plate_maps.items():
+            res.add_tab(var_name, plate_dict)
+        return res
+
+    def add_tab(self, var_name, plate_dict):
+        "Add a variable given as {plate (or plate range): [val, ...]}"
+        arrays = {}
+        converted = {}
+        for plate, vals in plate_dict.items():
+            # convert each distinct list once and share it across plates
+            if id(vals) not in converted:
+                converted[id(vals)] = values_to_array(vals)
+            for enum_plate in enum_plates(plate):
+                arrays[enum_plate] = converted[id(vals)]
+        self._tabs[var_name] = arrays
+        self._plate_sizes = None
+        self._checked = False
+
+    def add_constants(self, constants_df):
+        """
+        Add the columns of the "_constants" tab (one row per plate) as
+        variables (see add_plate_map_constants)
+        """
+        plate_sizes = self.plate_sizes
+        plates = constants_df['Plate'].tolist()
+
+        # Check that all plates in the constants tab are in
+        # the existing plate maps, and vice versa
+        if not all(plate in plates for plate in plate_sizes.keys()):
+            raise RuntimeError('The following plates are in the individual plate maps but not in the "_constants" tab: {}'.format(list(plate_sizes.keys() - set(plates))))
+        if not all(plate in plate_sizes.keys() for plate in plates):
+            raise RuntimeError('The following plates are in the "_constants" tab but not in the individual plate maps: {}'.format(list(set(plates) - plate_sizes.keys())))
+
+        # Ensure that a variable is not specifed both as its own tab and as a column in the _constants tab
+        dup_columns = set(constants_df.columns.tolist()) & self.keys()
+        if len(dup_columns) > 0:
+            raise RuntimeError('The following variables are defined in both the individual plate maps and the "_constants" tab: {}'.format(list(dup_columns)))
+
+        constants_df = constants_df.set_index('Plate')
+        for var_name in constants_df.columns:
+            self._constants[var_name] = {plate_id: constants_df.loc[plate_id, var_name] for plate_id in plate_sizes.keys()}
+
+    @property
+    def plate_sizes(self):
+        "{plate: number of wells} (computed once, see get_plate_sizes)"
+        if self._plate_sizes is None:
+            self._plate_sizes = get_plate_sizes(self._tabs)
+        return self._plate_sizes
+
+    def check_plates_x_vars(self):
+        "Ensure plates are the same across all variables (only checked once)"
+        if not self._checked:
+            check_plates_x_vars(self._tabs)
+            self._checked = True
+
+    def keys(self):
+        return dict.fromkeys(itertools.chain(self._tabs, self._constants)).keys()
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self._tabs) + len(self._constants)
+
+    def __contains__(self, var_name):
+        return var_name in self._tabs or var_name in self._constants
+
+    def __getitem__(self, var_name):
+        "{plate: [val, ...]} for a single variable"
+        return {plate: self.plate_values(var_name, plate).tolist() if var_name in self._tabs
+                else [self._constants[var_name][plate]] * self.plate_sizes[plate]
+                for plate in self.plates(var_name)}
+
+    def plates(self, var_name):
+        "Plates that a variable is defined for"
+        if var_name in self._tabs:
+            return list(self._tabs[var_name].keys())
+        return list(self._constants[var_name].keys())
+
+    def plate_values(self, var_name, plate):
+        "Array of a variable's well values on a single plate (row-major order)"
+        if var_name in self._tabs:
+            return self._tabs[var_name][plate]
+        return values_to_array([self._constants[var_name][plate]] * self.plate_sizes[plate])
+
+    def to_dict(self):
+        "Convert back to {var: {plate: [val, ...]}}"
+        return {var_name: self[var_name] for var_name in self.keys()}
+
+    def to_df(self):
+        """
+        Convert into a long DataFrame with one row per well
+
+        Rows are ordered by plate number and then well name, and columns are
+        Plate_ID, each variable, Sample_Well, and "index" (if present) last.
+        Each column is built by concatenating the plates' arrays in output
+        order rather than melting and re-joining every variable.
+        """
+        self.check_plates_x_vars()
+
+        plate_sizes = self.plate_sizes
+        plates = sorted(plate_sizes.keys(), key=plate_number)
+        sizes = [plate_sizes[x] for x in plates]
+
+        # variable order matches the old melt/concat approach
+        var_names = [x for x in self.keys() if x != 'index']
+        if 'Sample_Well' not in var_names:
+            var_names.append('Sample_Well')
+        if 'index' in self:
+            var_names.append('index')
+
+        cols = {'Plate_ID': list(flatten([plate] * size for plate, size in zip(plates, sizes)))}
+        for var_name in var_names:
+            if var_name == 'Sample_Well':
+                cols[var_name] = np.concatenate([well_names(size)[well_order(size)] for size in sizes]).tolist()
+                continue
+
+            vals = [self.plate_values(var_name, plate)[well_order(size)] for plate, size in zip(plates, sizes)]
+            dtypes = set(x.dtype for x in vals)
+            if len(dtypes) == 1 and dtypes != {np.dtype(object)}:
+                # every plate has the same numeric type
+                cols[var_name] = np.concatenate(vals)
+                continue
+
+            # types are inferred plate by plate (e.g. a blank plate is object
+            # even if the others are numeric). Only stitch the plates together
+            # one at a time if they don't all hold the same simple type.
+            vals = [x.tolist() for x in vals]
+            kinds = set(pd.api.types.infer_dtype(x, skipna = False) for x in vals)
+            if len(kinds) == 1 and kinds <= SIMPLE_KINDS:
+                cols[var_name] = list(flatten(vals))
+            else:
+                cols[var_name] = pd.concat([pd.Series(x) for x in vals], ignore_index = True)
+
+        return(pd.DataFrame(cols, columns = ['Plate_ID'] + var_names))
+
+
+def values_to_array(vals):
+    """
+    Convert a plate's well values into the most compact array that converts
+    back to exactly the same values (and infers the same pandas dtype)
+
+    Input:
+    ------
+    vals :: list
+
+    Output:
+    -------
+    arr :: np.array
+        int64/float64/bool array for homogeneous numbers and an object array
+        for anything else (e.g. strings or blanks)
+    """
+    kind = pd.api.types.infer_dtype(vals, skipna = False)
+    if kind == 'integer':
+        try:
+            return np.array(vals, dtype = np.int64)
+        except OverflowError:
+            pass
+    elif kind == 'floating':
+        return np.array(vals, dtype = np.float64)
+    elif kind == 'boolean':
+        return np.array(vals, dtype = bool)
+    arr = np.empty(len(vals), dtype = object)
+    arr[:] = vals
+    return arr
 
 
 #-----------------------------------------------------------------------------
@@ -272,6 +742,65 @@ def row_letters(n):
 
     return(res)
 
+@lru_cache(maxsize=None)
+def well_names(n):
+    "Get well names (A01, A02, ...) of a plate of size n in row-major order"
+    res = np.array([f'{row}{col:02}' for row in row_letters(n) for col in range(1, ncol_pl(n) + 1)], dtype=object)
+    res.flags.writeable = False
+    return(res)
+
+@lru_cache(maxsize=None)
+def well_order(n):
+    "Get the order that sorts the well names of a plate of size n alphabetically"
+    res = np.argsort(well_names(n).astype(str), kind='stable')
+    res.flags.writeable = False
+    return(res)
+
+def well_rows_cols(wells):
+    """
+    Get the 0-based (row, col) of every well name (A01, A1, AF48, ...)
+
+    Input:
+    ------
+    wells :: list
+
+    Output:
+    -------
+    (rows, cols) :: tuple
+        int arrays
+    """
+    # a run repeats the same few hundred well names, so only parse each once
+    codes, names = pd.factorize(pd.Series(wells, dtype = object).astype(str))
+    parts = pd.Series(names, dtype = object).str.extract(r'^([A-Za-z]+)0*(\d+)$')
+    bad = parts.isna().any(axis = 1)
+    if bad.any():
+        raise ValueError('Sample_Well must look like A01 (or A1), not: {}'.format(', '.join(names[bad.to_numpy()][:5])))
+    rows = parts[0].str.upper().map({x: i for i, x in enumerate(row_letters(PLATE_SIZES[-1]))})
+    if rows.isna().any():
+        raise ValueError('Sample_Well rows must be A to AF, not: {}'.format(', '.join(parts[0][rows.isna()].unique()[:5])))
+    return rows.to_numpy(dtype = np.int64)[codes], parts[1].to_numpy(dtype = np.int64)[codes] - 1
+
+def fit_plate_size(nrow, ncol, plate_id = 'plate'):
+    "Get the smallest plate size with at least nrow rows and ncol columns"
+    for n in PLATE_SIZES:
+        if nrow_pl(n) >= nrow and ncol_pl(n) >= ncol:
+            return n
+    raise ValueError(f'{plate_id} has wells outside of a {PLATE_SIZES[-1]} well plate')
+
+def check_plate_size(size, plate_id = 'plate'):
+    "Get a plate size given as a number or text as an int, if it's valid"
+    if isinstance(size, str) and size.strip().isdigit():
+        size = int(size)
+    if isinstance(size, float) and size.is_integer():
+        size = int(size)
+    if isinstance(size, bool) or size not in PLATE_SIZES:
+        raise ValueError(f'{plate_id}: {PLATE_SIZE_COL} must be one of {", ".join(map(str, PLATE_SIZES))}, not {size}')
+    return size
+
+def plate_number(plate_id):
+    "Get the number of a plate id (e.g. Plate12 -> 12)"
+    return(int(plate_id.replace('Plate', '')))
+
 #-------------------------------------------------------------------------------
 
 def flatten(listOfLists):
@@ -13,11 +13,18 @@ import numpy as np
 from collections import defaultdict
 
 import plate_maps as pm
+import index_collisions as ic
+import metrics
 
 # easily change the required variables
 # Plate_Primer = name of plate primer, not actual sequence
 REQ_VARS = set(['bc_set', 'i5', 'i7'])
 
+# instruments that read i5 as the primer sequence vs its reverse complement
+INSTRUMENT_TYPES_I5_FWD = ['MiSeq', 'HiSeq 2X00', 'NovaSeq']
+INSTRUMENT_TYPES_I5_REV = ['iSeq', 'MiniSeq', 'NextSeq', 'HiSeq >3000']
+INSTRUMENTS = INSTRUMENT_TYPES_I5_FWD + INSTRUMENT_TYPES_I5_REV
+
 
 # silly over optimization to make a fast reverse compliment
 # see: https://bioinformatics.stackexchange.com/q/3583
@@ -57,35 +64,67 @@ def prompt_header():
     name = input('\n\nName: ')
     experiment = input('Experiment Name: ')
     date = input('Date: ')
-    instrument_types_i5_fwd = ['MiSeq', 'HiSeq 2X00', 'NovaSeq']
-    instrument_types_i5_rev = ['iSeq', 'MiniSeq', 'NextSeq', 'HiSeq >3000']
-    instrument = input(f'Instrument ({",".join(instrument_types_i5_fwd+instrument_types_i5_rev)}): ')
-    while instrument not in instrument_types_i5_fwd+instrument_types_i5_rev:
-        instrument = input(f'Instrument must be in {instrument_types_i5_fwd+instrument_types_i5_rev}.\nTry again: ')
-
-    # set reverse compliment flag depending on instrument
-    if instrument in instrument_types_i5_rev:
-        rc = True
-    else:
-        rc = False
+    instrument = input(f'Instrument ({",".join(INSTRUMENTS)}): ')
+    while instrument not in INSTRUMENTS:
+        instrument = input(f'Instrument must be in {INSTRUMENTS}.\nTry again: ')
 
     reads = input('Cycles (enter values separated by "," for paired end e.g. 151,151): ')
+    while parse_reads(reads) is None:
+        reads = input('Reads must be separated by comma for paired end.\nTry again: ')
+
+    return make_header(name, experiment, date, instrument, reads)
+
+#-------------------------------------------------------------------------------
+
+def parse_reads(reads):
+    """
+    Parse the cycles of a single or paired end run (e.g. "26" or "151,151").
+
+    Output:
+    -------
+    out_reads :: str
+        cycles of each read on its own line (None if reads is malformed)
+    """
     se = re.compile(r'^\d+$')
     pe = re.compile(r'^(\d+),(\d+)$')
     single = re.match(se, reads)
     paired = re.match(pe, reads)
     # recall ^ = xor
     if bool(single) ^ bool(paired) == False:
-        while bool(single) ^ bool(paired) == False:
-            reads = input('Reads must be separated by comma for paired end.\nTry again: ')
-            single = re.match(se, reads)
-            paired = re.match(pe, reads)
+        return None
 
     # generate reads string based on match
     if paired:
-        out_reads = '\n'.join(paired.groups())
-    else:
-        out_reads = reads
+        return '\n'.join(paired.groups())
+    return reads
+
+def make_header(name, experiment, date, instrument, reads):
+    """
+    Build the sample sheet header without prompting (see prompt_header).
+
+    Input:
+    ------
+    name, experiment, date :: str
+    instrument :: str
+        one of INSTRUMENTS - decides whether i5 is reverse complemented
+    reads :: str
+        cycles, separated by "," for paired end e.g. 151,151
+
+    Output:
+    -------
+    header :: str
+        The header section of Illumina's sample sheet
+    rc :: bool
+        Do we need to reverse compliment
+    """
+    if instrument not in INSTRUMENTS:
+        raise ValueError(f'Instrument must be in {INSTRUMENTS} (got "{instrument}")')
+    out_reads = parse_reads(str(reads))
+    if out_reads is None:
+        raise ValueError(f'Reads must be a number of cycles, separated by comma for paired end (got "{reads}")')
+
+    # set reverse compliment flag depending on instrument
+    rc = instrument in INSTRUMENT_TYPES_I5_REV
 
     # generate sample sheet header
     header = "[Header]\nIEMFileVersion,5\n" + \
@@ -153,53 +192,129 @@ def check_i5_i7_vars(plate_maps):
 #-------------------------------------------------------------------------------
 
 def expand_samplesheet(df, idx_suff):
+    """
+    Split wells with several i5/i7 pairs into one row per pair.
+
+    Input:
+    ------
+    df :: pd.DataFrame
+        one row per well with i5_<suffix>/i7_<suffix> columns
+    idx_suff :: list
+        index suffixes (see check_i5_i7_vars)
 
+    Output:
+    -------
+    df_exp :: pd.DataFrame
+        one row per well and suffix (in that order) with the indices in i5/i7
+        and the suffix appended to the Sample_ID. If a well has the same pair
+        under several suffixes, only the first is kept.
+
+    The whole suffix is appended: i5_a_b/i7_a_b give Sample_ID <well>-a_b,
+    where the melt/merge version this replaced cut suffixes at the first "_"
+    (<well>-a), so sheets with "_" in a suffix get different Sample_IDs.
+    """
     i5_cols = [f'i5_{x}' for x in idx_suff]
     i7_cols = [f'i7_{x}' for x in idx_suff]
 
-    i5_expanded_df = df.melt(id_vars = ['Sample_ID', 'Plate_ID', 'Sample_Well'], value_vars = i5_cols, value_name = 'i5', var_name = '__idx_id__')
-    i5_expanded_df['__idx_id__'] = [x.split('_')[1] for x in i5_expanded_df['__idx_id__']]
-
-    i7_expanded_df = df.melt(id_vars = ['Sample_ID', 'Plate_ID', 'Sample_Well'], value_vars = i7_cols, value_name = 'i7', var_name = '__idx_id__')
-    i7_expanded_df['__idx_id__'] = [x.split('_')[1] for x in i7_expanded_df['__idx_id__']]
+    # (n_wells, n_suffixes) grids of indices - flattening them row major gives
+    # every suffix of the first well, then the second well, ...
+    i5 = np.column_stack([df[x].to_numpy(dtype=object) for x in i5_cols])
+    i7 = np.column_stack([df[x].to_numpy(dtype=object) for x in i7_cols])
+    i5_na = pd.isna(i5)
+    i7_na = pd.isna(i7)
 
     # If there is a mixture of wells with single and multiple i5/i7 pairs,
     # remove any duplicated pairs within a well.  (Somewhere else throw an
     # error if the indices do not define a unique row in the SampleSheet)
-    i5_i7_expanded_df = pd.merge(i5_expanded_df, i7_expanded_df)
-    i5_i7_expanded_df = i5_i7_expanded_df[~i5_i7_expanded_df.duplicated(['Plate_ID', 'Sample_Well', 'i5', 'i7'])]
+    dup = np.zeros(i5.shape, dtype=bool)
+    for j in range(1, len(idx_suff)):
+        for k in range(j):
+            same_i5 = (i5[:, j] == i5[:, k]) | (i5_na[:, j] & i5_na[:, k])
+            same_i7 = (i7[:, j] == i7[:, k]) | (i7_na[:, j] & i7_na[:, k])
+            dup[:, j] |= same_i5 & same_i7
+    keep = ~dup.ravel()
+
+    rows = np.repeat(np.arange(len(df)), len(idx_suff))[keep]
+    suffixes = np.tile(np.array(idx_suff, dtype=object), len(df))[keep]
+
+    df_exp = df.drop(i5_cols + i7_cols, axis = 'columns').take(rows).reset_index(drop = True)
+    df_exp['Sample_ID'] = df_exp['Sample_ID'].to_numpy(dtype=object) + '-' + suffixes
+    df_exp['i5'] = i5.ravel()[keep]
+    df_exp['i7'] = i7.ravel()[keep]
 
-    df_exp = df.drop(i5_cols + i7_cols, axis = 'columns').merge(i5_i7_expanded_df)
+    return df_exp
 
-    df_exp['Sample_ID'] = df_exp['Sample_ID'] + '-' + df_exp['__idx_id__']
-    df_exp.drop('__idx_id__', axis = 'columns', inplace = True)
+def collapse_samplesheet(df, index_cols = ['index', 'index2']):
+    """
+    Undo expand_samplesheet on a SampleSheet's [Data] rows, as
+    collapseSampleSheet.R does: reset the Sample_ID to Plate_ID-Sample_Well
+    and join the indices of rows that agree on every other column with "-".
 
-    return df_exp
+    Input:
+    ------
+    df :: pd.DataFrame
+        SampleSheet rows (one per i5/i7 pair)
+    index_cols :: list
+        columns to collapse
 
+    Output:
+    -------
+    df_col :: pd.DataFrame
+        one row per well, sorted by the remaining columns (left to right,
+        blanks last) with the collapsed indices at the end
+    """
+    df = df.assign(Sample_ID = df['Plate_ID'].astype(str) + '-' + df['Sample_Well'].astype(str))
+    key_cols = [x for x in df.columns if x not in index_cols]
+
+    # rows of a well end up next to each other, then each run of identical
+    # keys is a group
+    df = df.sort_values(key_cols, na_position = 'last', kind = 'stable').reset_index(drop = True)
+    new_group = np.zeros(len(df), dtype=bool)
+    new_group[:1] = True
+    for col in key_cols:
+        vals = df[col].to_numpy()
+        na = pd.isna(vals)
+        new_group[1:] |= ~((vals[1:] == vals[:-1]) | (na[1:] & na[:-1]))
+    starts = np.flatnonzero(new_group)
+
+    df_col = df.loc[starts, key_cols].reset_index(drop = True)
+    for col in index_cols:
+        # prefix every index but the first of each group with "-" and let
+        # numpy concatenate each group's strings
+        vals = df[col].astype(object).where(df[col].notna(), 'NA').astype(str).to_numpy(dtype=object)
+        vals[~new_group] = '-' + vals[~new_group]
+        df_col[col] = np.add.reduceat(vals, starts) if len(vals) else vals
+
+    return df_col
 
-#===============================================================================
 
-if __name__ == '__main__':
-    parser = argparse.ArgumentParser(
-        description='')
-    parser.add_argument('sheet',
-                        type=str,
-                        help='path to the plate map *.xlsx')
-    parser.add_argument('-o',
-                        '--out-file',
-                        dest='out_file',
-                        type=argparse.FileType('w'),
-                        default='SampleSheet.csv',
-                        help='sample sheet output')
-    args = parser.parse_args()
+#-------------------------------------------------------------------------------
+
+def plate_maps_to_samplesheet(sheet, cache_dir = None, mismatches = 0):
+    """
+    Parse and check a plate map workbook and lay it out as SampleSheet rows.
+
+    Input:
+    ------
+    sheet :: str
+        path to the plate map *.xlsx
+    cache_dir :: str
+        see plate_maps.read_plate_map_set
+    mismatches :: int
+        index mismatches the demultiplexer will allow - i5/i7 pairs that
+        can't be told apart with this many mismatches are an error (default
+        0 only rejects exact duplicates, as before the collision check)
 
-    #---------------------------------------------------------------------------
+    Output:
+    -------
+    out_df :: pd.DataFrame
+        one row per i5/i7 pair (indices are not reverse complemented yet)
+    """
     # parse plates
-    plate_maps = pm.read_plate_maps(args.sheet)
-    plate_sizes = pm.get_plate_sizes(plate_maps)
+    plate_maps = pm.read_plate_map_set(sheet, cache_dir = cache_dir)
 
     # ensure the plate level vars are acceptable
-    pm.check_plates_x_vars(plate_maps)
+    plate_maps.check_plates_x_vars()
 
     # Check that i5/i7 variables are specified properly
     new_req_vars, index_suffixes = check_i5_i7_vars(plate_maps)
@@ -209,23 +324,47 @@ if __name__ == '__main__':
         raise ValueError('The following plate required variables are not present: {}\n'.format(', '.join(REQ_VARS - plate_maps.keys())))
 
     # Convert to a df
-    out_df = pm.plate_maps_to_df(plate_maps)
+    with metrics.stage('plate_maps_to_df', unit = 'wells') as m:
+        out_df = pm.plate_maps_to_df(plate_maps)
+        m.items = len(out_df)
 
-    #---------------------------------------------------------------------------
     # Format the output samplesheet
     out_df['Sample_ID'] = out_df.Plate_ID + '-' + out_df.Sample_Well
 
     # Expand the df to accommodate multiple i5/i7 pairs per well, if necessary
     if len(index_suffixes) > 0:
-        out_df = expand_samplesheet(out_df, index_suffixes)
+        with metrics.stage('expand_samplesheet', unit = 'rows') as m:
+            out_df = expand_samplesheet(out_df, index_suffixes)
+            m.items = len(out_df)
 
     # Check to make sure each i5/i7 combination uniquely defines a row
     duplicated_index_rows = np.where(out_df.duplicated(['i5', 'i7']))[0].tolist()
     if len(duplicated_index_rows) > 0:
-        dup_idx_err_str = 'i5/i7 pairs do not define unique rows in the SampleSheet! Offending duplicated rows:\n{}'.format(', '.join(duplicated_index_rows))
+        dup_idx_err_str = 'i5/i7 pairs do not define unique rows in the SampleSheet! Offending duplicated rows:\n{}'.format(', '.join(map(str, duplicated_index_rows)))
         raise ValueError(dup_idx_err_str)
 
-    sample_header, rc = prompt_header()
+    # Check that the pairs are also far enough apart to survive mismatches
+    if mismatches > 0:
+        with metrics.stage('check_collisions', unit = 'rows') as m:
+            m.items = len(out_df)
+            ic.check_collisions(out_df, mismatches)
+
+    return out_df
+
+def write_samplesheet(out_df, sample_header, rc, out_file):
+    """
+    Reverse complement the indices as needed and write the header and rows.
+
+    Input:
+    ------
+    out_df :: pd.DataFrame
+        see plate_maps_to_samplesheet
+    sample_header :: str
+    rc :: bool
+        see make_header
+    out_file :: file-like
+    """
+    out_df = out_df.copy()
 
     # reverse complement i7 - always reads the RC of the primer sequence
     out_df['i7'] = out_df.i7.map(rev_comp)
@@ -234,12 +373,58 @@ if __name__ == '__main__':
     if rc:
         out_df['i5'] = out_df.i5.map(rev_comp)
 
-    # print header
-    print(sample_header, file=args.out_file)
+    with metrics.stage('write_samplesheet', unit = 'rows') as m:
+        m.items = len(out_df)
+
+        # print header
+        print(sample_header, file=out_file)
+
+        # print the sample info
+        (out_df.assign(index = out_df.i7, index2 = out_df.i5)
+                .drop(['i5', 'i7'], axis = 'columns')
+                .to_csv(out_file, index=False)
+        )
+
+
+#===============================================================================
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='')
+    parser.add_argument('sheet',
+                        type=str,
+                        help='path to the plate map *.xlsx (or a folder of csv/tsv tabs, or a long csv/tsv/parquet table with an optional Plate_Size column)')
+    parser.add_argument('-o',
+                        '--out-file',
+                        dest='out_file',
+                        type=argparse.FileType('w'),
+                        default='SampleSheet.csv',
+                        help='sample sheet output')
+    parser.add_argument('--cache-dir',
+                        dest='cache_dir',
+                        type=str,
+                        default=pm.DEFAULT_CACHE_DIR,
+                        help=f'where to cache parsed plate maps (default = {pm.DEFAULT_CACHE_DIR})')
+    parser.add_argument('--no-cache',
+                        dest='no_cache',
+                        action='store_true',
+                        help='always reparse the workbook')
+    parser.add_argument('-m',
+                        '--mismatches',
+                        dest='mismatches',
+                        type=int,
+                        default=0,
+                        help=f'also reject i5/i7 pairs that would collide when demultiplexing with this many index mismatches (default = 0, only reject exact duplicates; demux.py allows {ic.demux.MISMATCHES})')
+    parser.add_argument('--metrics',
+                        type=str,
+                        help=f'append per-stage timings to this *.jsonl (default = ${metrics.METRICS_ENV} if set)')
+    args = parser.parse_args()
+
+    if args.metrics:
+        metrics.enable(args.metrics)
+
+    out_df = plate_maps_to_samplesheet(args.sheet, cache_dir = None if args.no_cache else args.cache_dir, mismatches = args.mismatches)
 
-    # print the sample info
-    (out_df.assign(index = out_df.i7, index2 = out_df.i5)
-            .drop(['i5', 'i7'], axis = 'columns')
-            .to_csv(args.out_file, index=False)
-    )
+    sample_header, rc = prompt_header()
 
+    write_samplesheet(out_df, sample_header, rc, args.out_file)
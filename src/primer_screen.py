@@ -0,0 +1,334 @@
+#!/usr/bin/env python3
+"""
+primer_screen.py - primer3 hairpin/dimer screening with a persistent cache
+
+A drop-in for calc_self_props and calc_well_heterodimers from
+analyses/primer-design-3/index-design-3.ipynb. Every well combination shares
+most of its (primer, primer) pairs with many others, so rather than calling
+primer3 on every pair of every well:
+
+    - each thermodynamic result is keyed by the sequences primer3 is given
+      (trimmed as the notebook trims them) and the primer3 conditions/version
+    - results are kept in an SQLite file that survives notebook reruns
+    - only pairs missing from the cache are computed, on a process pool
+    - well combinations are consumed in batches from any iterable, so a
+      generator over itertools.combinations never has to be materialized,
+      and top_well_heterodimers keeps only the k best wells
+
+Usage (in the notebook):
+
+    with PrimerScreen() as screen:
+        self_props = screen.self_props(primers)
+        wells = (((f, s2_dict['F'][f]), (r, s2_dict['R'][r])) for f, r in pairs)
+        best = screen.top_well_heterodimers(wells, k=10000)
+"""
+
+import os
+import json
+import heapq
+import sqlite3
+import itertools
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+
+# primer3 only handles one sequence > 60 nt, so (as in the notebook) the
+# primer of a hairpin/homodimer and the first primer of a heterodimer are
+# trimmed from the 5' end (dimers come from the 3' end, the common region)
+TRIM = 60
+
+# primer3's defaults, spelled out so they are part of every cache key
+DEFAULT_CONDITIONS = {
+    'mv_conc': 50.0,
+    'dv_conc': 1.5,
+    'dntp_conc': 0.6,
+    'dna_conc': 50.0,
+    'temp_c': 37.0,
+    'max_loop': 30,
+}
+
+DEFAULT_CACHE = os.path.join(os.environ.get('SWABSEQ_CACHE_DIR', str(Path.home() / '.cache' / 'swabseq')), 'primer3.sqlite')
+
+KINDS = ['hairpin', 'homodimer', 'heterodimer']
+
+# well combinations per batch, and sequences per primer3 job
+BATCH_SIZE = 1 << 14
+CHUNK_SIZE = 1 << 10
+
+# forget in-memory results past this many (they are still in the cache file)
+MAX_MEMO = 1 << 22
+
+#===============================================================================
+
+def load_primer3():
+    "{kind: primer3 function} (for both the old camelCase and new APIs)"
+    try:
+        import primer3
+    except ImportError:
+        raise RuntimeError('Screening primers requires primer3-py (pip install primer3-py)')
+    names = {'hairpin': ('calc_hairpin', 'calcHairpin'),
+             'homodimer': ('calc_homodimer', 'calcHomodimer'),
+             'heterodimer': ('calc_heterodimer', 'calcHeterodimer')}
+    return {kind: getattr(primer3, new, None) or getattr(primer3, old) for kind, (new, old) in names.items()}
+
+
+def primer3_version():
+    try:
+        import primer3
+    except ImportError:
+        return None
+    return getattr(primer3, '__version__', None)
+
+
+def conditions_key(conditions):
+    "Canonical string of the primer3 conditions (and version) for the cache"
+    return json.dumps({'primer3': primer3_version(), **conditions}, sort_keys=True)
+
+
+def seq_key(kind, a, b=''):
+    """
+    Cache key of a primer (hairpin/homodimer) or an ordered pair of primers
+    (heterodimer): the arguments primer3 is called with, as the notebook's
+    calcHeterodimer(x[-60:], y) - only the first sequence is trimmed and
+    (a, b) and (b, a) are separate keys.
+    """
+    a = a[-TRIM:]
+    if kind != 'heterodimer':
+        return (a, '')
+    return (a, b)
+
+
+def calc_chunk(kind, keys, conditions):
+    """
+    Run primer3 on a chunk of keys (in a worker process).
+
+    Output:
+    -------
+    results :: list
+        (dg, tm) for every key
+    """
+    fn = load_primer3()[kind]
+    res = []
+    for a, b in keys:
+        x = fn(a, b, **conditions) if kind == 'heterodimer' else fn(a, **conditions)
+        res.append((x.dg, x.tm))
+    return res
+
+
+class ThermoCache:
+    """
+    SQLite store of primer3 results keyed by (kind, seq1, seq2, conditions).
+
+    Input:
+    ------
+    path :: str
+        cache file (None for a throwaway in-memory cache)
+    conditions :: dict
+        primer3 conditions (see DEFAULT_CONDITIONS)
+    """
+
+    def __init__(self, path=DEFAULT_CACHE, conditions=DEFAULT_CONDITIONS):
+        if path is None:
+            path = ':memory:'
+        else:
+            Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self.conditions = conditions_key(conditions)
+        self.db = sqlite3.connect(path)
+        self.db.execute('''
+            CREATE TABLE IF NOT EXISTS thermo (
+                kind TEXT, seq1 TEXT, seq2 TEXT, conditions TEXT, dg REAL, tm REAL,
+                PRIMARY KEY (kind, seq1, seq2, conditions)
+            ) WITHOUT ROWID''')
+
+    def lookup(self, kind, keys):
+        """
+        Input:
+        ------
+        kind :: str
+        keys :: iterable
+            (seq1, seq2) keys (see seq_key)
+
+        Output:
+        -------
+        found :: dict
+            {key: (dg, tm)} for the keys in the cache
+        """
+        found = {}
+        cur = self.db.cursor()
+        for key in keys:
+            row = cur.execute('SELECT dg, tm FROM thermo WHERE kind = ? AND seq1 = ? AND seq2 = ? AND conditions = ?',
+                              (kind, key[0], key[1], self.conditions)).fetchone()
+            if row is not None:
+                found[key] = row
+        return found
+
+    def store(self, kind, results):
+        "Save {key: (dg, tm)}"
+        with self.db:
+            self.db.executemany('INSERT OR REPLACE INTO thermo VALUES (?, ?, ?, ?, ?, ?)',
+                                ((kind, a, b, self.conditions, dg, tm) for (a, b), (dg, tm) in results.items()))
+
+    def close(self):
+        self.db.close()
+
+
+class PrimerScreen:
+    """
+    Memoized, parallel primer3 screening (see the module docstring).
+
+    Input:
+    ------
+    cache_path :: str
+        SQLite cache file (None to only cache in memory)
+    conditions :: dict
+        primer3 conditions (see DEFAULT_CONDITIONS)
+    workers :: int
+        primer3 worker processes (default = number of cpus, 1 = no pool)
+    """
+
+    def __init__(self, cache_path=DEFAULT_CACHE, conditions=DEFAULT_CONDITIONS, workers=None):
+        self.conditions = dict(conditions)
+        self.cache = ThermoCache(cache_path, self.conditions)
+        self.workers = workers
+        self.memo = {kind: {} for kind in KINDS}
+        self._pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+        self.cache.close()
+
+    @property
+    def pool(self):
+        if self._pool is None:
+            self._pool = ProcessPoolExecutor(max_workers=self.workers)
+        return self._pool
+
+    def compute(self, kind, keys):
+        """
+        primer3 results for every key, from memory, the cache file, or the
+        process pool (in that order).
+
+        Input:
+        ------
+        kind :: str
+            one of KINDS
+        keys :: iterable
+            (seq1, seq2) keys (see seq_key)
+
+        Output:
+        -------
+        results :: dict
+            {key: (dg, tm)}
+        """
+        memo = self.memo[kind]
+        keys = set(keys)
+        res = {key: memo[key] for key in keys if key in memo}
+        missing = keys - res.keys()
+        if missing:
+            cached = self.cache.lookup(kind, missing)
+            res.update(cached)
+            missing = sorted(missing - cached.keys())
+        if missing:
+            chunks = [missing[i:i + CHUNK_SIZE] for i in range(0, len(missing), CHUNK_SIZE)]
+            if self.workers == 1 or len(chunks) == 1:
+                computed = [calc_chunk(kind, x, self.conditions) for x in chunks]
+            else:
+                computed = self.pool.map(calc_chunk, itertools.repeat(kind), chunks, itertools.repeat(self.conditions))
+            new = dict(zip(missing, itertools.chain.from_iterable(computed)))
+            self.cache.store(kind, new)
+            res.update(new)
+
+        if len(memo) + len(res) > MAX_MEMO:
+            memo.clear()
+        memo.update(res)
+        return res
+
+    def self_props(self, primers):
+        """
+        Hairpin and self-dimer dG/Tm of every primer (calc_self_props).
+
+        Input:
+        ------
+        primers :: iterable
+            primer sequences
+
+        Output:
+        -------
+        props :: dict
+            {primer: {'hairpin_dg', 'hairpin_tm', 'self_dg', 'self_tm'}}
+        """
+        primers = list(primers)
+        keys = {x: seq_key('hairpin', x) for x in primers}
+        hairpin = self.compute('hairpin', keys.values())
+        homodimer = self.compute('homodimer', keys.values())
+        return {x: {'hairpin_dg': hairpin[key][0], 'hairpin_tm': hairpin[key][1],
+                    'self_dg': homodimer[key][0], 'self_tm': homodimer[key][1]}
+                for x, key in keys.items()}
+
+    def iter_well_heterodimers(self, well_combos, batch_size=BATCH_SIZE):
+        """
+        Lowest heterodimer dG over every pair of primers in each well
+        (calc_well_heterodimers), streamed in input order.
+
+        Input:
+        ------
+        well_combos :: iterable
+            [(index, {name: primer}), (index, {name: primer}), ...] per well
+        batch_size :: int
+            wells to screen at a time
+
+        Output:
+        -------
+        results :: generator
+            (index1, index2, ..., dG) per well
+        """
+        well_combos = iter(well_combos)
+        while True:
+            batch = list(itertools.islice(well_combos, batch_size))
+            if not batch:
+                break
+            well_keys = []
+            for combo in batch:
+                primers = itertools.chain.from_iterable(x[1].values() for x in combo)
+                well_keys.append([seq_key('heterodimer', a, b) for a, b in itertools.combinations(primers, 2)])
+            dg = self.compute('heterodimer', itertools.chain.from_iterable(well_keys))
+            for combo, keys in zip(batch, well_keys):
+                yield (*(x[0] for x in combo), min(dg[key][0] for key in keys))
+
+    def top_well_heterodimers(self, well_combos, k, batch_size=BATCH_SIZE):
+        """
+        The k wells with the highest (least favorable) heterodimer dG, ordered
+        as the notebook sorts them (dG descending, then first index, then
+        input order), without keeping every well in memory.
+
+        Output:
+        -------
+        results :: list
+            (index1, index2, ..., dG)
+        """
+        def key(item):
+            i, res = item
+            return (res[-1], Descending(res[0]), -i)
+        best = heapq.nlargest(k, enumerate(self.iter_well_heterodimers(well_combos, batch_size)), key=key)
+        return [res for _, res in best]
+
+
+class Descending:
+    "Wrapper that inverts comparisons (for mixed ascending/descending keys)"
+    __slots__ = ['value']
+
+    def __init__(self, value):
+        self.value = value
+
+    def __lt__(self, other):
+        return other.value < self.value
+
+    def __eq__(self, other):
+        return self.value == other.value
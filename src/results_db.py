@@ -0,0 +1,317 @@
+#!/usr/bin/env python3
+"""
+results_db.py - one indexed SQLite database of every run's conditions and counts
+
+Every run lives in its own pipeline/<run>/ folder, so a question across runs
+("every Plate12 result of the last 50 runs", "S2_spike counts over a month")
+means re-reading and re-joining every run's csvs. Ingesting the runs once
+into a database answers those with an indexed query instead:
+
+    runs        run, fingerprint, counts file, n_samples, n_clusters, ingested
+    conditions  run, Sample_ID, Plate_ID, Sample_Well, bc_set, bc_len, and
+                the rest of the run's conditions columns as json (they differ
+                from run to run)
+    counts      run, Sample_ID, Centroid, Count, target, amplicon - one row
+                per cluster (not per member barcode), with the target and
+                amplicon of the centroid in the run's bc-map (NULL if none)
+
+Ingest is idempotent: a run is only (re)loaded when its fingerprint (size and
+mtime of its conditions, counts, and bc-map) differs from the one it was
+loaded with, and a run is replaced inside a single transaction.
+
+Usage: python src/results_db.py pipeline/*/ [-d pipeline/results.sqlite]
+
+    db = ResultsDB('pipeline/results.sqlite')
+    db.results(plate='Plate12', last=50)
+    db.results(amplicon='S2_spike', runs=['run01', 'run02'])
+"""
+
+import sys
+import json
+import time
+import sqlite3
+import argparse
+from itertools import repeat
+from pathlib import Path
+
+import pandas as pd
+
+import count_matrix as cm
+
+DB_FILE = 'pipeline/results.sqlite'
+
+# counts files of a run, in order of preference
+COUNTS_FILES = ['starcode.csv', 'correct.csv']
+
+# bump whenever the tables change - a database made with another version is
+# dropped and rebuilt (its runs are reloaded on the next ingest)
+SCHEMA_VERSION = 1
+
+TABLES = ['runs', 'conditions', 'counts']
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    run TEXT PRIMARY KEY,
+    fingerprint TEXT NOT NULL,
+    counts_file TEXT,
+    n_samples INTEGER,
+    n_clusters INTEGER,
+    ingested REAL
+);
+CREATE TABLE IF NOT EXISTS conditions (
+    run TEXT NOT NULL,
+    Sample_ID TEXT NOT NULL,
+    Plate_ID TEXT,
+    Sample_Well TEXT,
+    bc_set TEXT,
+    bc_len INTEGER,
+    extra TEXT,
+    PRIMARY KEY (run, Sample_ID)
+);
+CREATE TABLE IF NOT EXISTS counts (
+    run TEXT NOT NULL,
+    Sample_ID TEXT NOT NULL,
+    Centroid TEXT NOT NULL,
+    Count INTEGER NOT NULL,
+    target TEXT,
+    amplicon TEXT
+);
+CREATE INDEX IF NOT EXISTS conditions_plate ON conditions (Plate_ID, Sample_Well);
+CREATE INDEX IF NOT EXISTS conditions_well ON conditions (Sample_Well);
+CREATE INDEX IF NOT EXISTS conditions_sample ON conditions (Sample_ID);
+CREATE INDEX IF NOT EXISTS conditions_bc_set ON conditions (bc_set);
+CREATE INDEX IF NOT EXISTS counts_sample ON counts (run, Sample_ID);
+CREATE INDEX IF NOT EXISTS counts_target ON counts (target, run);
+CREATE INDEX IF NOT EXISTS counts_amplicon ON counts (amplicon, run);
+"""
+
+# conditions columns with their own column in the database
+KEY_COLUMNS = ['Sample_ID', 'Plate_ID', 'Sample_Well', 'bc_set', 'bc_len']
+
+#===============================================================================
+
+def run_files(run_dir):
+    """
+    (conditions, counts, bc-map) of a pipeline/<run>/ folder, or None if it
+    has no conditions or counts yet.
+    """
+    run_dir = Path(run_dir)
+    conds = run_dir / 'conditions.csv'
+    bc_map = run_dir / 'bc-map.csv'
+    counts = next((run_dir / x for x in COUNTS_FILES if (run_dir / x).exists()), None)
+    if not conds.exists() or counts is None:
+        return None
+    return conds, counts, bc_map
+
+
+def fingerprint(files):
+    "Everything that should trigger a reload of a run if it changes"
+    fp = {}
+    for fname in files:
+        if fname.exists():
+            st = fname.stat()
+            fp[fname.name] = [st.st_size, st.st_mtime_ns]
+    return json.dumps(fp, sort_keys=True)
+
+
+class ResultsDB:
+    """
+    Ingest runs into, and query, a results database.
+
+    Input:
+    ------
+    path :: str
+        SQLite file (created if it doesn't exist)
+    """
+
+    def __init__(self, path=DB_FILE):
+        self.path = str(path)
+        self.con = sqlite3.connect(self.path)
+        self._create()
+
+    def _create(self):
+        "Create the tables, dropping any made with another SCHEMA_VERSION"
+        version, = self.con.execute('PRAGMA user_version').fetchone()
+        if version != SCHEMA_VERSION:
+            with self.con:
+                for table in TABLES:
+                    self.con.execute(f'DROP TABLE IF EXISTS {table}')
+        self.con.executescript(SCHEMA)
+        self.con.execute(f'PRAGMA user_version = {SCHEMA_VERSION}')
+
+    def close(self):
+        self.con.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    #---------------------------------------------------------------------------
+    # ingest
+
+    def ingest(self, run_dir, run=None, force=False):
+        """
+        Load a pipeline/<run>/ folder, unless it is already loaded and
+        unchanged.
+
+        Input:
+        ------
+        run_dir :: str
+            folder with conditions.csv, starcode.csv (or correct.csv), and
+            bc-map.csv
+        run :: str
+            run id (default = the folder name)
+        force :: bool
+            reload even if unchanged
+
+        Output:
+        -------
+        loaded :: bool
+            False if the run was skipped
+        """
+        run = run or Path(run_dir).resolve().name
+        files = run_files(run_dir)
+        if files is None:
+            raise FileNotFoundError(f'{run_dir} has no conditions.csv and {" or ".join(COUNTS_FILES)}')
+        conds_file, counts_file, bc_map_file = files
+        fp = fingerprint(files)
+        old = self.con.execute('SELECT fingerprint FROM runs WHERE run = ?', (run,)).fetchone()
+        if old is not None and old[0] == fp and not force:
+            return False
+
+        conds = pd.read_csv(conds_file, dtype=str, keep_default_na=False)
+        missing = [x for x in ['Sample_ID', 'bc_set'] if x not in conds.columns]
+        if missing:
+            raise ValueError(f'{conds_file} has no {", ".join(missing)} column')
+        extra_cols = [x for x in conds.columns if x not in KEY_COLUMNS]
+        cond_rows = [
+            (run, row['Sample_ID'], row.get('Plate_ID'), row.get('Sample_Well'), row['bc_set'],
+             int(row['bc_len']) if row.get('bc_len') else None, json.dumps({x: row[x] for x in extra_cols}))
+            for row in conds.to_dict('records')
+        ]
+
+        # target/amplicon of every centroid in the run's barcode map
+        labels = {}
+        if bc_map_file.exists():
+            for row in pd.read_csv(bc_map_file, dtype=str).drop_duplicates('sequence').itertuples():
+                labels[row.sequence] = (row.target, row.amplicon)
+
+        with self.con:
+            self._delete(run)
+            self.con.executemany('INSERT INTO conditions VALUES (?, ?, ?, ?, ?, ?, ?)', cond_rows)
+            n_clusters = 0
+            for chunk in cm.read_clusters(counts_file):
+                centroids = chunk['Centroid'].tolist()
+                label = [labels.get(x, (None, None)) for x in centroids]
+                self.con.executemany('INSERT INTO counts VALUES (?, ?, ?, ?, ?, ?)',
+                                     zip(repeat(run), chunk['Sample_ID'].tolist(), centroids, chunk['Count'].tolist(),
+                                         [x[0] for x in label], [x[1] for x in label]))
+                n_clusters += len(chunk)
+            self.con.execute('INSERT INTO runs VALUES (?, ?, ?, ?, ?, ?)',
+                             (run, fp, counts_file.name, len(cond_rows), n_clusters, time.time()))
+        return True
+
+    def _delete(self, run):
+        for table in TABLES:
+            self.con.execute(f'DELETE FROM {table} WHERE run = ?', (run,))
+
+    def drop(self, run):
+        "Remove a run"
+        with self.con:
+            self._delete(run)
+
+    #---------------------------------------------------------------------------
+    # query
+
+    def query(self, sql, params=()):
+        "Any SQL as a DataFrame"
+        return pd.read_sql_query(sql, self.con, params=params)
+
+    def runs(self):
+        "Every loaded run, in run id order"
+        return self.query('SELECT run, counts_file, n_samples, n_clusters, ingested FROM runs ORDER BY run')
+
+    def results(self, plate=None, well=None, sample_id=None, target=None, amplicon=None, bc_set=None,
+                runs=None, last=None, conditions=False):
+        """
+        Cluster counts joined to their conditions, across runs.
+
+        Input:
+        ------
+        plate, well, sample_id, bc_set :: str
+            only these Plate_ID / Sample_Well / Sample_ID / bc_set
+        target, amplicon :: str
+            only clusters whose centroid is this target / amplicon
+        runs :: list
+            only these runs
+        last :: int
+            only the last runs (in run id order)
+        conditions :: bool
+            add every conditions column of the run (from the json)
+
+        Output:
+        -------
+        df :: pd.DataFrame
+            run, Sample_ID, Plate_ID, Sample_Well, bc_set, Centroid, Count,
+            target, amplicon (plus the conditions columns)
+        """
+        where, params = [], []
+        for col, value in [('c.Plate_ID', plate), ('c.Sample_Well', well), ('c.Sample_ID', sample_id), ('c.bc_set', bc_set),
+                           ('n.target', target), ('n.amplicon', amplicon)]:
+            if value is not None:
+                where.append(f'{col} = ?')
+                params.append(value)
+        if last is not None:
+            recent = [x for (x,) in self.con.execute('SELECT run FROM runs ORDER BY run DESC LIMIT ?', (int(last),))]
+            runs = recent if runs is None else [x for x in runs if x in recent]
+        if runs is not None:
+            runs = list(runs)
+            where.append(f'c.run IN ({", ".join("?" * len(runs))})' if runs else '0')
+            params.extend(runs)
+
+        sql = ('SELECT c.run, c.Sample_ID, c.Plate_ID, c.Sample_Well, c.bc_set, n.Centroid, n.Count, n.target, n.amplicon'
+               + (', c.extra' if conditions else '')
+               + ' FROM conditions c JOIN counts n ON n.run = c.run AND n.Sample_ID = c.Sample_ID'
+               + (' WHERE ' + ' AND '.join(where) if where else '')
+               + ' ORDER BY c.run, c.Sample_ID, n.Count DESC')
+        df = self.query(sql, params)
+        if conditions:
+            extra = pd.DataFrame([json.loads(x) for x in df.pop('extra')], index=df.index)
+            df = pd.concat([df, extra], axis=1)
+        return df
+
+
+#===============================================================================
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Load runs (pipeline/<run>/ folders) into the cross-run results database')
+    parser.add_argument('run_dirs',
+                        type=str,
+                        nargs='+',
+                        help='pipeline/<run>/ folders (runs without counts yet are skipped)')
+    parser.add_argument('-d',
+                        '--db',
+                        type=str,
+                        default=DB_FILE,
+                        help=f'database file (default = {DB_FILE})')
+    parser.add_argument('-f',
+                        '--force',
+                        action='store_true',
+                        help='reload runs even if they haven\'t changed')
+    args = parser.parse_args()
+
+    n_loaded = 0
+    with ResultsDB(args.db) as db:
+        for run_dir in args.run_dirs:
+            if run_files(run_dir) is None:
+                print(f'Skipping {run_dir}: no conditions/counts yet', file=sys.stderr)
+                continue
+            start = time.perf_counter()
+            if db.ingest(run_dir, force=args.force):
+                n_loaded += 1
+                print(f'Loaded {run_dir} in {time.perf_counter() - start:.1f}s', file=sys.stderr)
+        n_runs = len(db.runs())
+    print(f'{n_loaded} run(s) loaded, {n_runs} run(s) in {args.db}', file=sys.stderr)
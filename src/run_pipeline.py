@@ -0,0 +1,393 @@
+#!/usr/bin/env python3
+"""
+run_pipeline.py - count (and cluster/correct) the barcodes of every sample in
+a sequencing run on a process pool
+
+Replaces the `parallel ... :::: conditions.csv` recipes in the Makefile. The
+conditions table is read once, and every Sample_ID becomes a job that counts
+its fastqs with count_bcs.py and then either clusters them with starcode
+(--method starcode, the starcode.csv recipe) or corrects them against its
+bc_set (--method correct, the correct.csv recipe). Jobs are scheduled largest
+fastq first so one big sample doesn't hold up the end of the run.
+
+Every sample's rows are checkpointed under <checkpoint-dir>/<Sample_ID>.csv
+along with a fingerprint of its inputs (fastq sizes/mtimes, bc_len, bc_set,
+method). A rerun only redoes samples whose checkpoint is missing or stale, and
+a failed sample no longer throws away the rest of the run. The checkpoints are
+merged into a single Sample_ID,Centroid,Count,barcode table once every sample
+has finished.
+"""
+
+import os
+import sys
+import csv
+import json
+import argparse
+import subprocess
+import importlib.util
+from pathlib import Path
+from functools import lru_cache
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import count_bcs as cb
+import correct_bcs as cc
+import fastq_manifest as fm
+import metrics
+
+# bump whenever the per-sample output changes to invalidate old checkpoints
+CHECKPOINT_VERSION = 1
+
+HEADER = 'Sample_ID,Centroid,Count,barcode\n'
+
+# same as the starcode.csv recipe
+STARCODE_CMD = ['starcode', '-d2', '-t1', '--sphere', '--print-clusters']
+
+#===============================================================================
+
+def read_conditions(fname):
+    """
+    Parse conditions.csv into one dict per Sample_ID.
+
+    Input:
+    ------
+    fname :: str
+        path to conditions.csv (see conditions.py)
+
+    Output:
+    -------
+    conds :: list
+        [{column: value}, ...] in file order
+    """
+    with open(fname, newline='') as fh:
+        return list(csv.DictReader(fh))
+
+
+def fingerprint(job):
+    """
+    Everything that should trigger a rerun of a sample if it changes.
+
+    Input:
+    ------
+    job :: dict
+        see make_jobs
+
+    Output:
+    -------
+    fp :: dict
+        json-able summary of the job's inputs
+    """
+    fastqs = []
+    for fname in job['fastqs']:
+        st = os.stat(fname)
+        fastqs.append([os.path.basename(fname), st.st_size, st.st_mtime_ns])
+    return {
+        'version': CHECKPOINT_VERSION,
+        'method': job['method'],
+        'bc_len': job['bc_len'],
+        'bc_set': job['bc_set'],
+        'targets': job['targets'],
+        'dist': job['dist'],
+        'fastqs': fastqs,
+    }
+
+
+def make_jobs(conds, run_dir, method, bc_sets=None, dist=cc.MAX_DIST, manifest=None):
+    """
+    Turn the conditions table into one job per Sample_ID, largest input first.
+
+    Input:
+    ------
+    conds :: list
+        see read_conditions
+    run_dir :: str
+        folder of the run's fastqs
+    method :: str
+        'starcode' or 'correct'
+    bc_sets :: dict
+        see correct_bcs.read_bc_map (only needed for 'correct')
+    dist :: int
+        maximum edit distance to correct
+    manifest :: fastq_manifest.Manifest
+        the run's fastqs (default = fastq_manifest.load(run_dir))
+
+    Output:
+    -------
+    jobs :: list
+        [{'sample_id', 'fastqs', 'size', 'bc_len', 'bc_set', 'targets', 'method', 'dist'}, ...]
+    """
+    if manifest is None:
+        manifest = fm.load(run_dir)
+    jobs = []
+    for row in conds:
+        targets = None
+        if method == 'correct':
+            if row['bc_set'] not in bc_sets:
+                raise ValueError(f'bc_set "{row["bc_set"]}" of {row["Sample_ID"]} is not in the barcode map. Options: {", ".join(bc_sets)}')
+            targets = bc_sets[row['bc_set']]
+        jobs.append({
+            'sample_id': row['Sample_ID'],
+            'fastqs': manifest.fastqs(row['Sample_ID']),
+            'size': manifest.size(row['Sample_ID']),
+            'bc_len': int(row['bc_len']),
+            'bc_set': row['bc_set'],
+            'targets': targets,
+            'method': method,
+            'dist': dist if method == 'correct' else None,
+        })
+    jobs.sort(key=lambda x: -x['size'])
+    return jobs
+
+
+def checkpoint_files(checkpoint_dir, sample_id):
+    "(rows, fingerprint) paths of a sample's checkpoint"
+    base = Path(checkpoint_dir) / sample_id
+    return base.with_name(base.name + '.csv'), base.with_name(base.name + '.json')
+
+
+def is_done(job, checkpoint_dir):
+    "True if the sample has a checkpoint that matches its current inputs"
+    rows_file, fp_file = checkpoint_files(checkpoint_dir, job['sample_id'])
+    if not (rows_file.exists() and fp_file.exists()):
+        return False
+    try:
+        with open(fp_file) as fh:
+            return json.load(fh) == fingerprint(job)
+    except (ValueError, OSError):
+        return False
+
+
+@lru_cache(maxsize=None)
+def load_tidy_star():
+    "tidy-star.py can't be imported by name - load it once per process"
+    spec = importlib.util.spec_from_file_location('tidy_star', Path(__file__).resolve().parent / 'tidy-star.py')
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def starcode_rows(sample_id, counts):
+    """
+    Cluster barcode counts with starcode and tidy the clusters into csv rows.
+
+    Output:
+    -------
+    rows :: str
+        "Sample_ID,Centroid,Count,barcode" lines (no header)
+    """
+    tidy_star = load_tidy_star()
+    # cpu_s of this stage doesn't include starcode itself (a child process)
+    with metrics.stage('starcode', sample=sample_id, unit='barcodes') as m:
+        m.items = len(counts)
+        proc = subprocess.run(STARCODE_CMD,
+                              input=''.join(f'{bc} {n}\n' for bc, n in counts.items()),
+                              stdout=subprocess.PIPE,
+                              stderr=subprocess.DEVNULL,
+                              universal_newlines=True,
+                              check=True)
+    lines = proc.stdout.splitlines(keepends=True)
+    if not lines:
+        return ''
+    with metrics.stage('tidy_star', sample=sample_id, unit='clusters') as m:
+        m.items = len(lines)
+        return tidy_star.tidy_text(lines, sample_id)
+
+
+@lru_cache(maxsize=None)
+def bc_set_index(targets, dist):
+    "correct_bcs.build_index of a bc_set's targets (a tuple), once per process"
+    return cc.build_index(list(targets), dist)[0]
+
+
+def correct_rows(sample_id, counts, targets, dist):
+    """
+    Correct barcode counts against the bc_set's expected sequences.
+
+    Output:
+    -------
+    rows :: str
+        "Sample_ID,Centroid,Count,barcode" lines (no header)
+    """
+    with metrics.stage('correct', sample=sample_id, unit='barcodes') as m:
+        m.items = len(counts)
+        index = bc_set_index(tuple(targets), dist)
+        clusters = cc.correct_counts(counts, index)
+        return ''.join(f'{s},{c},{n},{bc}\n' for s, c, n, bc in cc.tidy_clusters(sample_id, clusters))
+
+
+def run_job(job, checkpoint_dir):
+    """
+    Count, cluster/correct, and checkpoint a single sample.
+
+    Output:
+    -------
+    sample_id :: str
+    """
+    fp = fingerprint(job)
+    with metrics.stage('sample', sample=job['sample_id'], unit='reads', method=job['method']) as m:
+        if job['fastqs']:
+            counts = cb.count_barcodes(job['fastqs'], job['bc_len'])
+        else:
+            counts = {}
+        m.items = sum(counts.values())
+
+        if not counts:
+            rows = ''
+        elif job['method'] == 'starcode':
+            rows = starcode_rows(job['sample_id'], counts)
+        else:
+            rows = correct_rows(job['sample_id'], counts, job['targets'], job['dist'])
+
+    # rows first, then the fingerprint that marks them as done, both written
+    # via rename so an interrupted job just looks unfinished
+    rows_file, fp_file = checkpoint_files(checkpoint_dir, job['sample_id'])
+    tmp_file = rows_file.with_name(rows_file.name + '.tmp')
+    with open(tmp_file, 'w') as fh:
+        fh.write(rows)
+    os.replace(tmp_file, rows_file)
+    tmp_file = fp_file.with_name(fp_file.name + '.tmp')
+    with open(tmp_file, 'w') as fh:
+        json.dump(fp, fh)
+    os.replace(tmp_file, fp_file)
+
+    return job['sample_id']
+
+
+def merge_checkpoints(sample_ids, checkpoint_dir, out_file):
+    "Concatenate every sample's rows (in conditions order) under a single header"
+    tmp_file = f'{out_file}.tmp'
+    with open(tmp_file, 'w') as out:
+        out.write(HEADER)
+        for sample_id in sample_ids:
+            rows_file, _ = checkpoint_files(checkpoint_dir, sample_id)
+            with open(rows_file) as fh:
+                while True:
+                    chunk = fh.read(cb.BLOCK_SIZE)
+                    if not chunk:
+                        break
+                    out.write(chunk)
+    os.replace(tmp_file, out_file)
+
+
+def run(jobs, checkpoint_dir, workers=None, force=False):
+    """
+    Run every unfinished job on a process pool.
+
+    Input:
+    ------
+    jobs :: list
+        see make_jobs
+    checkpoint_dir :: str
+        where to keep each sample's rows
+    workers :: int
+        size of the process pool (default = number of cpus)
+    force :: bool
+        rerun samples even if their checkpoint is up to date
+
+    Output:
+    -------
+    failed :: dict
+        {sample_id: error message}
+    """
+    Path(checkpoint_dir).mkdir(parents=True, exist_ok=True)
+    todo = [job for job in jobs if force or not is_done(job, checkpoint_dir)]
+    print(f'{len(jobs) - len(todo)} of {len(jobs)} samples are up to date, running {len(todo)}', file=sys.stderr)
+
+    failed = {}
+    if not todo:
+        return failed
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(run_job, job, checkpoint_dir): job for job in todo}
+        for i, future in enumerate(as_completed(futures), 1):
+            sample_id = futures[future]['sample_id']
+            try:
+                future.result()
+                if not futures[future]['fastqs']:
+                    print(f'No fastqs found for {sample_id}', file=sys.stderr)
+            except Exception as e:
+                failed[sample_id] = f'{type(e).__name__}: {e}'
+                print(f'{sample_id} failed ({failed[sample_id]})', file=sys.stderr)
+            print(f'[{i}/{len(todo)}] {sample_id}', file=sys.stderr)
+    return failed
+
+
+#===============================================================================
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Count and cluster/correct the barcodes of every sample in a run, with per-sample checkpoints')
+    parser.add_argument('run_dir',
+                        type=str,
+                        help='folder of the run\'s fastqs (e.g. data/seq-runs/<run>)')
+    parser.add_argument('conditions',
+                        type=str,
+                        help='path to the run\'s conditions.csv')
+    parser.add_argument('-m',
+                        '--method',
+                        dest='method',
+                        choices=['starcode', 'correct'],
+                        default='starcode',
+                        help='cluster with starcode or correct against the barcode map (default = starcode)')
+    parser.add_argument('-b',
+                        '--bc-map',
+                        dest='bc_map',
+                        type=str,
+                        help='path to bc-map.csv (required for --method correct)')
+    parser.add_argument('-d',
+                        '--dist',
+                        dest='dist',
+                        type=int,
+                        default=cc.MAX_DIST,
+                        help='maximum edit distance to correct (default = 2)')
+    parser.add_argument('-o',
+                        '--out-file',
+                        dest='out_file',
+                        type=str,
+                        help='merged output (default = <method>.csv next to the conditions)')
+    parser.add_argument('-c',
+                        '--checkpoint-dir',
+                        dest='checkpoint_dir',
+                        type=str,
+                        help='where to keep per-sample results (default = <method>/ next to the conditions)')
+    parser.add_argument('-j',
+                        '--jobs',
+                        dest='jobs',
+                        type=int,
+                        help='number of worker processes (default = number of cpus)')
+    parser.add_argument('-f',
+                        '--force',
+                        action='store_true',
+                        help='rerun every sample, ignoring checkpoints')
+    parser.add_argument('--metrics',
+                        type=str,
+                        help=f'append per-stage/per-sample timings to this *.jsonl (default = ${metrics.METRICS_ENV} if set)')
+    args = parser.parse_args()
+
+    if args.metrics:
+        metrics.enable(args.metrics)
+
+    out_dir = Path(args.conditions).parent
+    out_file = args.out_file or str(out_dir / f'{args.method}.csv')
+    checkpoint_dir = args.checkpoint_dir or str(out_dir / args.method)
+
+    bc_sets = None
+    if args.method == 'correct':
+        if args.bc_map is None:
+            parser.error('--method correct requires --bc-map')
+        bc_sets = cc.read_bc_map(args.bc_map)
+
+    conds = read_conditions(args.conditions)
+    jobs = make_jobs(conds, args.run_dir, args.method, bc_sets, args.dist)
+
+    with metrics.stage('run', unit='samples', method=args.method) as m:
+        m.items = len(jobs)
+        failed = run(jobs, checkpoint_dir, args.jobs, args.force)
+    if failed:
+        print(f'{len(failed)} sample(s) failed, not writing {out_file}. Rerun to retry just these:', file=sys.stderr)
+        for sample_id, err in failed.items():
+            print(f'\t{sample_id}\t{err}', file=sys.stderr)
+        sys.exit(1)
+
+    with metrics.stage('merge', unit='samples') as m:
+        m.items = len(conds)
+        merge_checkpoints([row['Sample_ID'] for row in conds], checkpoint_dir, out_file)
@@ -3,6 +3,7 @@ strip-windows.py - strip the pesky ^M's from any file
 Nathan Lubock
 """
 
+import io
 import sys
 import argparse
 from signal import signal, SIGPIPE, SIG_DFL
@@ -11,27 +12,103 @@ from signal import signal, SIGPIPE, SIG_DFL
 # see: https://stackoverflow.com/a/30091579
 signal(SIGPIPE, SIG_DFL)
 
+# characters to read/write at a time
+CHUNK_SIZE = 1 << 20
+
+#===============================================================================
+
+def line_ending(text):
+    "The line ending style of text: \\r\\n, else \\r, else \\n (None if it has none)"
+    if '\r\n' in text:
+        return '\r\n'
+    if '\r' in text:
+        return '\r'
+    if '\n' in text:
+        return '\n'
+    return None
+
+
+def normalize_chunks(chunks):
+    """
+    Convert the input's line endings to \\n chunk by chunk.
+
+    The style is detected once, from the first chunk with a line ending (see
+    line_ending), and only that style is converted - a lone \\r inside a
+    \\r\\n file is left alone. A \\r at the very end of a chunk is held back
+    until the next chunk arrives so a \\r\\n split across the boundary isn't
+    mistaken for a lone \\r.
+
+    Input:
+    ------
+    chunks :: iterable
+        strings read from the input
+
+    Output:
+    -------
+    out :: generator
+        normalized strings (the BOM, if any, is removed from the first one)
+    """
+    first = True
+    carry = ''
+    delim = None
+    for chunk in chunks:
+        if first:
+            # remove weird unicode garbage
+            if chunk.startswith('\ufeff'):
+                chunk = chunk[1:]
+            first = False
+        chunk = carry + chunk
+        carry = ''
+        if chunk.endswith('\r') and delim != '\r':
+            chunk, carry = chunk[:-1], '\r'
+        if delim is None:
+            # a held back \r may still make this a \r file - a chunk without
+            # any \r reads the same either way, so wait for the next one
+            delim = line_ending(chunk)
+            if delim == '\n' and carry:
+                delim = None
+        if delim == '\r\n':
+            chunk = chunk.replace('\r\n', '\n')
+        elif delim == '\r':
+            chunk = chunk.replace('\r', '\n')
+        if chunk:
+            yield chunk
+    if carry:
+        # a \r at the very end is a line ending only if it's the input's style
+        yield '\n' if delim in (None, '\r') else carry
+
+
+def read_chunks(infile, chunk_size=CHUNK_SIZE):
+    "Yield chunk_size characters at a time"
+    while True:
+        chunk = infile.read(chunk_size)
+        if not chunk:
+            break
+        yield chunk
+
+
+#===============================================================================
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(
         description='Strip any ^M and leave normal \n in place')
     parser.add_argument('infile',
-                        type=argparse.FileType('r'),
-                        default=sys.stdin,
+                        type=str,
+                        default='-',
                         nargs='?',
                         help='path to file (or stdin if none)')
     args = parser.parse_args()
-    slurp = args.infile.read()
-
-    # remove weird unicode garbage
-    if slurp[0] == '\ufeff':
-        slurp = slurp[1:]
 
-    # test the three lind ending cases
-    if '\r\n' in slurp:
-        delim = '\r\n'
-    elif '\r' in slurp:
-        delim = '\r'
+    # newline='' so we see the raw line endings instead of python's
+    # universal newline translation
+    if args.infile == '-':
+        infile = io.TextIOWrapper(sys.stdin.buffer, newline='')
     else:
-        delim = '\n'
-    for line in slurp.split(delim):
-        print(line, file=sys.stdout)
+        infile = open(args.infile, newline='')
+    out = open(sys.stdout.fileno(), 'w', buffering=CHUNK_SIZE, newline='', closefd=False)
+
+    with infile, out:
+        for chunk in normalize_chunks(read_chunks(infile)):
+            out.write(chunk)
+        # every line (including the last) is followed by a newline
+        out.write('\n')
@@ -11,6 +11,118 @@ from signal import signal, SIGPIPE, SIG_DFL
 # see: https://stackoverflow.com/a/30091579
 signal(SIGPIPE, SIG_DFL)
 
+import metrics
+
+# roughly how many bytes of starcode output to parse at once
+BATCH_SIZE = 1 << 22
+
+#===============================================================================
+
+def read_batches(infile, batch_size=BATCH_SIZE):
+    "Yield lists of whole lines, roughly batch_size bytes at a time"
+    while True:
+        lines = infile.readlines(batch_size)
+        if not lines:
+            break
+        yield lines
+
+
+class CountedBatches:
+    "Pass batches of lines through, counting the lines"
+
+    def __init__(self, batches):
+        self.batches = batches
+        self.n_lines = 0
+
+    def __iter__(self):
+        for lines in self.batches:
+            self.n_lines += len(lines)
+            yield lines
+
+
+def tidy_text(lines, sample_id=None):
+    """
+    Expand a batch of starcode --print-clusters lines into one line per
+    cluster member.
+
+    Input:
+    ------
+    lines :: list
+        "centroid\\tcount\\tbc1,bc2,..." lines
+    sample_id :: str
+        if given, prepend it to every line and switch to comma separators
+        (the rows of starcode.csv)
+
+    Output:
+    -------
+    out :: str
+        the tidied lines, newline terminated
+    """
+    if sample_id is None:
+        sep, prefix = '\t', ''
+    else:
+        sep, prefix = ',', sample_id + ','
+    out = []
+    for raw_line in lines:
+        line = raw_line.rstrip().split('\t')
+        head = prefix + line[0] + sep + line[1] + sep
+        # one join per cluster instead of one format/print per member
+        out.append(head + ('\n' + head).join(line[2].split(',')))
+    out.append('')
+    return '\n'.join(out)
+
+
+def tidy_arrow(lines, sample_id):
+    """
+    Expand a batch of starcode --print-clusters lines into an arrow table with
+    dictionary encoded Sample_ID and Centroid columns.
+    """
+    import numpy as np
+    import pyarrow as pa
+
+    centroids = []
+    counts = []
+    members = []
+    n_members = []
+    for raw_line in lines:
+        line = raw_line.rstrip().split('\t')
+        bcs = line[2].split(',')
+        centroids.append(line[0])
+        counts.append(int(line[1]))
+        members.extend(bcs)
+        n_members.append(len(bcs))
+
+    cluster = np.repeat(np.arange(len(centroids), dtype=np.int32), n_members)
+    return pa.table({
+        'Sample_ID': pa.DictionaryArray.from_arrays(
+            np.zeros(len(members), dtype=np.int32), pa.array([sample_id])),
+        'Centroid': pa.DictionaryArray.from_arrays(cluster, pa.array(centroids)),
+        'Count': pa.array(np.repeat(np.array(counts, dtype=np.int64), n_members)),
+        'barcode': pa.array(members, type=pa.string()),
+    })
+
+
+def write_parquet(batches, sample_id, out_path):
+    "Write every batch of starcode lines to a single parquet file"
+    try:
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise RuntimeError('Writing parquet requires pyarrow (conda install -c conda-forge pyarrow)')
+
+    writer = None
+    try:
+        for lines in batches:
+            tab = tidy_arrow(lines, sample_id)
+            if writer is None:
+                writer = pq.ParquetWriter(out_path, tab.schema, use_dictionary=['Sample_ID', 'Centroid'])
+            writer.write_table(tab)
+    finally:
+        if writer is not None:
+            writer.close()
+
+
+#===============================================================================
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(
         description='Tidy up starcode\'s --print-cluster column')
@@ -19,10 +131,29 @@ if __name__ == '__main__':
                         default=sys.stdin,
                         nargs='?',
                         help='path to a file of the reads (or stdin if none)')
+    parser.add_argument('-s',
+                        '--sample-id',
+                        dest='sample_id',
+                        type=str,
+                        help='prepend this Sample_ID to every line and write csv (no header)')
+    parser.add_argument('-p',
+                        '--parquet',
+                        dest='parquet',
+                        type=str,
+                        help='write parquet with dictionary encoded Sample_ID/Centroid here instead (requires -s)')
     args = parser.parse_args()
 
-    # starcode always outputs a tsv with the third column split by ,'s
-    for raw_line in args.infile:
-        line = raw_line.rstrip().split('\t')
-        for bc in line[2].split(','):
-            print('{}\t{}\t{}'.format(line[0], line[1], bc), file=sys.stdout)
+    if args.parquet and args.sample_id is None:
+        parser.error('--parquet requires --sample-id')
+
+    with metrics.stage('tidy_star', sample=args.sample_id, unit='clusters') as m:
+        batches = CountedBatches(read_batches(args.infile))
+        if args.parquet:
+            write_parquet(batches, args.sample_id, args.parquet)
+        else:
+            # starcode always outputs a tsv with the third column split by ,'s
+            out = sys.stdout
+            for lines in batches:
+                out.write(tidy_text(lines, args.sample_id))
+            out.flush()
+        m.items = batches.n_lines